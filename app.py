@@ -1,34 +1,276 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, session
+from flask import Flask, render_template, request, redirect, url_for, flash, send_file, send_from_directory, abort, session, g, jsonify, has_app_context, Response, stream_with_context, make_response
+from werkzeug.http import is_resource_modified
 import sqlite3
 import os
+import sys
+import time
+import queue
+import threading
 import uuid
 import pandas as pd
+import openpyxl
 import smtplib
 import unicodedata
 import io
+import json
+import base64
+import csv
+import hashlib
+import secrets
+import gzip
 from email.message import EmailMessage
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
+from datetime import datetime, timedelta, timezone
 from functools import wraps
 
+# Pillow es opcional: sin él las imágenes se guardan y se sirven solo en tamaño original
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
 app = Flask(__name__)
 app.config["UPLOAD_FOLDER"] = os.path.join(app.root_path, "static", "uploads")
 app.secret_key = "LSI-Inventario-SecretKey-2025-VerySecure"
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
+app.config["ITEMS_POR_PAGINA"] = int(os.environ.get("ITEMS_POR_PAGINA", 50))
+app.config["IMPORTACION_TAMANO_BLOQUE"] = int(os.environ.get("IMPORTACION_TAMANO_BLOQUE", 5000))
+app.config["IMPORTACION_MAX_ERRORES"] = 1000
+
+# Imágenes de productos: lado máximo (px) de cada versión reducida
+app.config["IMAGEN_TAMANOS"] = {'miniatura': 160, 'mediana': 800}
+app.config["IMAGEN_CALIDAD"] = int(os.environ.get("IMAGEN_CALIDAD", 82))
+app.config["IMAGEN_CACHE_DIAS"] = int(os.environ.get("IMAGEN_CACHE_DIAS", 365))
+app.config["IMAGENES_GRACIA_MIN"] = int(os.environ.get("IMAGENES_GRACIA_MIN", 60))
+
+# Trabajos en segundo plano (importaciones y exportaciones)
+app.config["RESULTADOS_FOLDER"] = os.environ.get("RESULTADOS_FOLDER", os.path.join(app.root_path, "resultados"))
+app.config["RESULTADOS_TTL_HORAS"] = float(os.environ.get("RESULTADOS_TTL_HORAS", 24))
+app.config["RESULTADOS_MAX_MB"] = float(os.environ.get("RESULTADOS_MAX_MB", 500))
+app.config["TRABAJOS_WORKERS"] = int(os.environ.get("TRABAJOS_WORKERS", 2))
+
+# Correo de alertas de stock bajo
+app.config["SMTP_HOST"] = os.environ.get("SMTP_HOST", "smtp.gmail.com")
+app.config["SMTP_PORT"] = int(os.environ.get("SMTP_PORT", 587))
+app.config["SMTP_USER"] = os.environ.get("SMTP_USER")
+app.config["SMTP_PASS"] = os.environ.get("SMTP_PASS")
+app.config["SMTP_FROM"] = os.environ.get("SMTP_FROM")
+app.config["SMTP_STARTTLS"] = os.environ.get("SMTP_STARTTLS", "1") == "1"
+app.config["SMTP_TIMEOUT"] = float(os.environ.get("SMTP_TIMEOUT", 30))
+app.config["ALERTAS_DESTINATARIO"] = os.environ.get("ALERTAS_DESTINATARIO")
+app.config["ALERTAS_VENTANA_MIN"] = int(os.environ.get("ALERTAS_VENTANA_MIN", 60))
+app.config["ALERTAS_ESPERA_LOTE"] = float(os.environ.get("ALERTAS_ESPERA_LOTE", 30))
+app.config["ALERTAS_INTERVALO"] = float(os.environ.get("ALERTAS_INTERVALO", 60))
+app.config["ALERTAS_MAX_INTENTOS"] = int(os.environ.get("ALERTAS_MAX_INTENTOS", 5))
+app.config["ALERTAS_REINTENTO_BASE"] = float(os.environ.get("ALERTAS_REINTENTO_BASE", 60))
+
+# Base de datos y pool de conexiones
+app.config["DB_PATH"] = os.environ.get("INVENTARIO_DB", "inventario.db")
+app.config["DB_POOL_SIZE"] = int(os.environ.get("DB_POOL_SIZE", 8))
+app.config["DB_POOL_TIMEOUT"] = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+app.config["DB_MMAP_SIZE"] = int(os.environ.get("DB_MMAP_SIZE", 256 * 1024 * 1024))
+app.config["DB_CACHE_KB"] = int(os.environ.get("DB_CACHE_KB", 64 * 1024))
+app.config["DB_BUSY_TIMEOUT"] = float(os.environ.get("DB_BUSY_TIMEOUT", 5))
+app.config["DB_REINTENTOS"] = int(os.environ.get("DB_REINTENTOS", 3))
+app.config["DB_WAL_AUTOCHECKPOINT"] = int(os.environ.get("DB_WAL_AUTOCHECKPOINT", 1000))
+app.config["DB_WAL_LIMITE_MB"] = int(os.environ.get("DB_WAL_LIMITE_MB", 64))
+
+# Servidor (python app.py, wsgi.py y gunicorn.conf.py)
+app.config["SERVIDOR_HOST"] = os.environ.get("SERVIDOR_HOST", "0.0.0.0")
+app.config["SERVIDOR_PUERTO"] = int(os.environ.get("SERVIDOR_PUERTO", 5000))
+app.config["SERVIDOR_HILOS"] = int(os.environ.get("SERVIDOR_HILOS", 8))
+app.config["SERVIDOR_PROCESOS"] = int(os.environ.get("SERVIDOR_PROCESOS", 2))  # solo gunicorn
+app.config["INICIALIZAR_DB"] = os.environ.get("INICIALIZAR_DB", "1") == "1"
+
+# API JSON para integraciones (lectores de código de barras, sincronización con el ERP)
+app.config["API_LIMITE_PAGINA"] = int(os.environ.get("API_LIMITE_PAGINA", 100))
+app.config["API_LIMITE_MAXIMO"] = int(os.environ.get("API_LIMITE_MAXIMO", 1000))
+app.config["API_MAX_LOTE"] = int(os.environ.get("API_MAX_LOTE", 1000))
+app.config["API_GZIP_MINIMO"] = int(os.environ.get("API_GZIP_MINIMO", 1024))
 
 def quitar_acentos(txt):
     if txt is None:
         return ''
     return ''.join(c for c in unicodedata.normalize('NFD', txt) if unicodedata.category(c) != 'Mn')
 
-def get_db_connection():
-    conn = sqlite3.connect("inventario.db")
+def normalizar_busqueda(txt):
+    """Texto sin acentos y en minúsculas, tal como se guarda en el índice de búsqueda"""
+    if txt is None:
+        return ''
+    return quitar_acentos(str(txt)).lower()
+
+def abrir_conexion():
+    """Abre una conexión nueva a la base con los pragmas de rendimiento"""
+    conn = sqlite3.connect(
+        app.config["DB_PATH"],
+        timeout=app.config["DB_BUSY_TIMEOUT"],
+        check_same_thread=False
+    )
     conn.row_factory = sqlite3.Row
-    conn.create_function("quitar_acentos", 1, quitar_acentos)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute(f"PRAGMA mmap_size = {int(app.config['DB_MMAP_SIZE'])}")
+    conn.execute(f"PRAGMA cache_size = -{int(app.config['DB_CACHE_KB'])}")
+    # Con varios procesos leyendo siempre hay alguien en el WAL: el límite lo recorta
+    # después de cada checkpoint para que no crezca sin fin
+    conn.execute(f"PRAGMA wal_autocheckpoint = {int(app.config['DB_WAL_AUTOCHECKPOINT'])}")
+    conn.execute(f"PRAGMA journal_size_limit = {int(app.config['DB_WAL_LIMITE_MB']) * 1024 * 1024}")
     return conn
 
-def obtener_ubicaciones():
-    conn = get_db_connection()
+class PoolConexiones:
+    """Pool de conexiones SQLite reutilizables entre peticiones (una por request)"""
+    
+    def __init__(self, tamano, espera_maxima):
+        self.tamano = tamano
+        self.espera_maxima = espera_maxima
+        self._libres = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._creadas = 0
+        self._en_uso = 0
+        self._prestamos = 0
+        self._esperas = 0
+        self._agotado = 0
+        self._espera_total = 0.0
+        self._espera_max = 0.0
+    
+    def obtener(self):
+        inicio = time.perf_counter()
+        try:
+            conn = self._libres.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                crear = self._creadas < self.tamano
+                if crear:
+                    self._creadas += 1
+            if crear:
+                try:
+                    conn = abrir_conexion()
+                except Exception:
+                    with self._lock:
+                        self._creadas -= 1
+                    raise
+            else:
+                try:
+                    conn = self._libres.get(timeout=self.espera_maxima)
+                except queue.Empty:
+                    with self._lock:
+                        self._agotado += 1
+                    raise sqlite3.OperationalError(
+                        f"Pool de conexiones agotado tras {self.espera_maxima}s de espera"
+                    )
+                with self._lock:
+                    self._esperas += 1
+        espera = time.perf_counter() - inicio
+        with self._lock:
+            self._en_uso += 1
+            self._prestamos += 1
+            self._espera_total += espera
+            self._espera_max = max(self._espera_max, espera)
+        return conn
+    
+    def devolver(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # Conexión inservible: se descarta y se abrirá otra cuando haga falta
+            with self._lock:
+                self._creadas -= 1
+                self._en_uso -= 1
+            return
+        with self._lock:
+            self._en_uso -= 1
+        self._libres.put(conn)
+    
+    def metricas(self):
+        with self._lock:
+            return {
+                'tamano': self.tamano,
+                'abiertas': self._creadas,
+                'en_uso': self._en_uso,
+                'libres': self._libres.qsize(),
+                'prestamos': self._prestamos,
+                'esperas': self._esperas,
+                'agotado': self._agotado,
+                'espera_promedio_ms': round(self._espera_total / self._prestamos * 1000, 3) if self._prestamos else 0.0,
+                'espera_maxima_ms': round(self._espera_max * 1000, 3),
+            }
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def obtener_pool():
+    """Retorna el pool del proceso actual (se recrea tras un fork de workers)"""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = PoolConexiones(app.config["DB_POOL_SIZE"], app.config["DB_POOL_TIMEOUT"])
+                _pool_pid = os.getpid()
+    return _pool
+
+def get_db_connection():
+    """Retorna la conexión de la petición actual, tomada del pool.
+    
+    Fuera de un contexto de Flask (scripts) abre una conexión propia que el
+    llamador debe cerrar.
+    """
+    if not has_app_context():
+        return abrir_conexion()
+    if 'db' not in g:
+        g.db = obtener_pool().obtener()
+    return g.db
+
+@app.teardown_appcontext
+def liberar_conexion(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        obtener_pool().devolver(conn)
+
+class CacheVersionada:
+    """Cache en memoria de un valor que solo cambia cuando sube su contador en la tabla versiones.
+    
+    Leer el contador es una búsqueda por clave primaria; como vive en la base, la
+    invalidación funciona también entre varios procesos que comparten el archivo.
+    """
+    
+    def __init__(self, clave, cargar):
+        self.clave = clave
+        self._cargar = cargar
+        self._lock = threading.Lock()
+        self._version = None
+        self._valor = None
+        self.aciertos = 0
+        self.recargas = 0
+    
+    def obtener(self, conn):
+        version = leer_version(conn, self.clave)
+        with self._lock:
+            if self._version is not None and self._version == version:
+                self.aciertos += 1
+                return self._valor
+        valor = self._cargar(conn)
+        with self._lock:
+            self._version = version
+            self._valor = valor
+            self.recargas += 1
+        return valor
+    
+    def metricas(self):
+        with self._lock:
+            return {'version': self._version, 'aciertos': self.aciertos, 'recargas': self.recargas}
+
+def leer_version(conn, clave):
+    fila = conn.execute("SELECT version FROM versiones WHERE clave = ?", (clave,)).fetchone()
+    return fila["version"] if fila else 0
+
+def cargar_ubicaciones(conn):
     ubicaciones_fijas = conn.execute("""
         SELECT nombre AS NOMBRE
         FROM ubicaciones
@@ -41,12 +283,78 @@ def obtener_ubicaciones():
         WHERE tipo = 'PROYECTO' AND activa = 1
         ORDER BY nombre
     """).fetchall()
-    conn.close()
     return ubicaciones_fijas, proyectos
 
-def init_db():
-    conn = get_db_connection()
+cache_ubicaciones = CacheVersionada('ubicaciones', cargar_ubicaciones)
+
+def obtener_ubicaciones():
+    return cache_ubicaciones.obtener(get_db_connection())
+
+# ============================================
+# 🗄️ MIGRACIONES DEL ESQUEMA
+# ============================================
+
+# Versión del esquema -> función que lleva la base desde la versión anterior.
+# La versión aplicada se guarda en PRAGMA user_version de la propia base.
+MIGRACIONES = {}
+
+def migracion(version):
+    """Decorador que registra una migración del esquema (la descripción es su docstring)"""
+    def registrar(funcion):
+        MIGRACIONES[version] = funcion
+        return funcion
+    return registrar
+
+def ejecutar_script(conn, script):
+    """Ejecuta varias sentencias dentro de la transacción actual.
+    
+    A diferencia de executescript() no hace COMMIT antes de empezar, así una
+    migración con triggers se aplica completa o no se aplica.
+    """
+    sentencia = ""
+    for linea in script.splitlines(keepends=True):
+        sentencia += linea
+        if sqlite3.complete_statement(sentencia):
+            conn.execute(sentencia)
+            sentencia = ""
+    if sentencia.strip():
+        conn.execute(sentencia)
+
+def version_esquema(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def aplicar_migraciones(conn):
+    """Aplica en orden las migraciones pendientes, cada una en su propia transacción.
+    
+    Las claves foráneas se desactivan mientras corren porque reconstruir una
+    tabla lo exige; la migración que las toca debe verificarlas antes de
+    terminar. Retorna la lista de versiones aplicadas.
+    """
+    actual = version_esquema(conn)
+    pendientes = [v for v in sorted(MIGRACIONES) if v > actual]
+    if not pendientes:
+        return []
+    
+    conn.commit()
+    conn.execute("PRAGMA foreign_keys = OFF")
+    try:
+        for version in pendientes:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                MIGRACIONES[version](conn)
+                conn.execute(f"PRAGMA user_version = {int(version)}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    finally:
+        conn.execute("PRAGMA foreign_keys = ON")
     
+    return pendientes
+
+@migracion(1)
+def esquema_inicial(conn):
+    """Tablas, triggers e índice de búsqueda (bases creadas antes de las migraciones)"""
     # Tabla inventario
     conn.execute("""
     CREATE TABLE IF NOT EXISTS inventario (
@@ -62,9 +370,117 @@ def init_db():
         PRECIO_DIST REAL,
         PRECIO_INT REAL,
         PRECIO_GENERAL REAL,
-        IMAGEN TEXT
+        IMAGEN TEXT,
+        CODIGO_N TEXT,
+        DESCRIPCION_N TEXT,
+        MARCA_N TEXT,
+        UBICACION_N TEXT
+    )
+    """)
+    
+    # Columnas normalizadas para búsqueda (bases anteriores a su incorporación)
+    rellenados = asegurar_columnas_busqueda(conn)
+    
+    # Contadores del tablero (una sola fila) mantenidos por triggers en cada escritura
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS resumen_inventario (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        total_productos INTEGER NOT NULL DEFAULT 0,
+        bajo_stock INTEGER NOT NULL DEFAULT 0,
+        unidades INTEGER NOT NULL DEFAULT 0,
+        valor_costo REAL NOT NULL DEFAULT 0,
+        valor_dist REAL NOT NULL DEFAULT 0,
+        valor_int REAL NOT NULL DEFAULT 0,
+        valor_general REAL NOT NULL DEFAULT 0
+    )
+    """)
+    ejecutar_script(conn, """
+    CREATE TRIGGER IF NOT EXISTS resumen_inventario_ai AFTER INSERT ON inventario BEGIN
+        UPDATE resumen_inventario SET
+            total_productos = total_productos + 1,
+            bajo_stock = bajo_stock + COALESCE(new.CANTIDAD <= new.MINIMO, 0),
+            unidades = unidades + COALESCE(new.CANTIDAD, 0),
+            valor_costo = valor_costo + COALESCE(new.CANTIDAD * new.PRECIO_COSTO, 0),
+            valor_dist = valor_dist + COALESCE(new.CANTIDAD * new.PRECIO_DIST, 0),
+            valor_int = valor_int + COALESCE(new.CANTIDAD * new.PRECIO_INT, 0),
+            valor_general = valor_general + COALESCE(new.CANTIDAD * new.PRECIO_GENERAL, 0)
+        WHERE id = 1;
+    END;
+    
+    CREATE TRIGGER IF NOT EXISTS resumen_inventario_ad AFTER DELETE ON inventario BEGIN
+        UPDATE resumen_inventario SET
+            total_productos = total_productos - 1,
+            bajo_stock = bajo_stock - COALESCE(old.CANTIDAD <= old.MINIMO, 0),
+            unidades = unidades - COALESCE(old.CANTIDAD, 0),
+            valor_costo = valor_costo - COALESCE(old.CANTIDAD * old.PRECIO_COSTO, 0),
+            valor_dist = valor_dist - COALESCE(old.CANTIDAD * old.PRECIO_DIST, 0),
+            valor_int = valor_int - COALESCE(old.CANTIDAD * old.PRECIO_INT, 0),
+            valor_general = valor_general - COALESCE(old.CANTIDAD * old.PRECIO_GENERAL, 0)
+        WHERE id = 1;
+    END;
+    
+    CREATE TRIGGER IF NOT EXISTS resumen_inventario_au
+    AFTER UPDATE OF CANTIDAD, MINIMO, PRECIO_COSTO, PRECIO_DIST, PRECIO_INT, PRECIO_GENERAL ON inventario BEGIN
+        UPDATE resumen_inventario SET
+            bajo_stock = bajo_stock - COALESCE(old.CANTIDAD <= old.MINIMO, 0) + COALESCE(new.CANTIDAD <= new.MINIMO, 0),
+            unidades = unidades - COALESCE(old.CANTIDAD, 0) + COALESCE(new.CANTIDAD, 0),
+            valor_costo = valor_costo - COALESCE(old.CANTIDAD * old.PRECIO_COSTO, 0) + COALESCE(new.CANTIDAD * new.PRECIO_COSTO, 0),
+            valor_dist = valor_dist - COALESCE(old.CANTIDAD * old.PRECIO_DIST, 0) + COALESCE(new.CANTIDAD * new.PRECIO_DIST, 0),
+            valor_int = valor_int - COALESCE(old.CANTIDAD * old.PRECIO_INT, 0) + COALESCE(new.CANTIDAD * new.PRECIO_INT, 0),
+            valor_general = valor_general - COALESCE(old.CANTIDAD * old.PRECIO_GENERAL, 0) + COALESCE(new.CANTIDAD * new.PRECIO_GENERAL, 0)
+        WHERE id = 1;
+    END;
+    """)
+    
+    # Lista de productos en bajo stock (CANTIDAD <= MINIMO) y su historial de entradas/salidas.
+    # CANTIDAD <= MINIMO compara dos columnas y no puede usar un índice: los triggers
+    # mantienen el conjunto para que el filtro y el reporte sean búsquedas por clave.
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS bajo_stock (
+        inventario_id INTEGER PRIMARY KEY,
+        desde TEXT NOT NULL
     )
     """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS historial_bajo_stock (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        inventario_id INTEGER NOT NULL,
+        entrada TEXT NOT NULL,
+        salida TEXT
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_historial_bajo_stock_producto ON historial_bajo_stock(inventario_id, salida)")
+    ejecutar_script(conn, """
+    CREATE TRIGGER IF NOT EXISTS bajo_stock_ai AFTER INSERT ON inventario
+    WHEN new.CANTIDAD <= new.MINIMO BEGIN
+        INSERT OR IGNORE INTO bajo_stock (inventario_id, desde)
+        VALUES (new.id, datetime('now', 'localtime'));
+        INSERT INTO historial_bajo_stock (inventario_id, entrada)
+        VALUES (new.id, datetime('now', 'localtime'));
+    END;
+    
+    CREATE TRIGGER IF NOT EXISTS bajo_stock_au_entra AFTER UPDATE OF CANTIDAD, MINIMO ON inventario
+    WHEN new.CANTIDAD <= new.MINIMO AND NOT COALESCE(old.CANTIDAD <= old.MINIMO, 0) BEGIN
+        INSERT OR IGNORE INTO bajo_stock (inventario_id, desde)
+        VALUES (new.id, datetime('now', 'localtime'));
+        INSERT INTO historial_bajo_stock (inventario_id, entrada)
+        VALUES (new.id, datetime('now', 'localtime'));
+    END;
+    
+    CREATE TRIGGER IF NOT EXISTS bajo_stock_au_sale AFTER UPDATE OF CANTIDAD, MINIMO ON inventario
+    WHEN old.CANTIDAD <= old.MINIMO AND NOT COALESCE(new.CANTIDAD <= new.MINIMO, 0) BEGIN
+        DELETE FROM bajo_stock WHERE inventario_id = old.id;
+        UPDATE historial_bajo_stock SET salida = datetime('now', 'localtime')
+        WHERE inventario_id = old.id AND salida IS NULL;
+    END;
+    
+    CREATE TRIGGER IF NOT EXISTS bajo_stock_ad AFTER DELETE ON inventario
+    WHEN old.CANTIDAD <= old.MINIMO BEGIN
+        DELETE FROM bajo_stock WHERE inventario_id = old.id;
+        UPDATE historial_bajo_stock SET salida = datetime('now', 'localtime')
+        WHERE inventario_id = old.id AND salida IS NULL;
+    END;
+    """)
     
     # Tabla movimientos
     conn.execute("""
@@ -95,6 +511,30 @@ def init_db():
     )
     """)
     
+    # Contadores de versión para invalidar caches (compartidos entre procesos)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS versiones (
+        clave TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    conn.execute("INSERT OR IGNORE INTO versiones (clave, version) VALUES ('ubicaciones', 0)")
+    
+    # Cualquier alta, baja o cambio de ubicaciones/proyectos invalida la cache
+    ejecutar_script(conn, """
+    CREATE TRIGGER IF NOT EXISTS ubicaciones_version_ai AFTER INSERT ON ubicaciones BEGIN
+        UPDATE versiones SET version = version + 1 WHERE clave = 'ubicaciones';
+    END;
+    
+    CREATE TRIGGER IF NOT EXISTS ubicaciones_version_au AFTER UPDATE ON ubicaciones BEGIN
+        UPDATE versiones SET version = version + 1 WHERE clave = 'ubicaciones';
+    END;
+    
+    CREATE TRIGGER IF NOT EXISTS ubicaciones_version_ad AFTER DELETE ON ubicaciones BEGIN
+        UPDATE versiones SET version = version + 1 WHERE clave = 'ubicaciones';
+    END;
+    """)
+    
     # Tabla proyecto_items (productos asignados a proyectos)
     conn.execute("""
     CREATE TABLE IF NOT EXISTS proyecto_items (
@@ -109,6 +549,59 @@ def init_db():
     )
     """)
     
+    # Índice de búsqueda (FTS5 trigram) sobre las columnas normalizadas de inventario
+    fts = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE name = 'inventario_fts'"
+    ).fetchone()
+    reconstruir_indice = rellenados > 0
+    if fts and "content='inventario'" not in fts["sql"]:
+        conn.execute("DROP TABLE inventario_fts")
+        fts = None
+    if not fts:
+        conn.execute("""
+        CREATE VIRTUAL TABLE inventario_fts USING fts5(
+            CODIGO_N,
+            DESCRIPCION_N,
+            MARCA_N,
+            UBICACION_N,
+            content = 'inventario',
+            content_rowid = 'id',
+            tokenize = 'trigram'
+        )
+        """)
+        reconstruir_indice = True
+    
+    # Bandera para que las cargas masivas indexen al final con un solo INSERT ... SELECT
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS banderas (
+        clave TEXT PRIMARY KEY,
+        activa INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    conn.execute("INSERT OR IGNORE INTO banderas (clave, activa) VALUES ('fts_diferido', 0)")
+    
+    ejecutar_script(conn, """
+    DROP TRIGGER IF EXISTS inventario_fts_ai;
+    CREATE TRIGGER inventario_fts_ai AFTER INSERT ON inventario
+    WHEN (SELECT activa FROM banderas WHERE clave = 'fts_diferido') IS NOT 1 BEGIN
+        INSERT INTO inventario_fts (rowid, CODIGO_N, DESCRIPCION_N, MARCA_N, UBICACION_N)
+        VALUES (new.id, new.CODIGO_N, new.DESCRIPCION_N, new.MARCA_N, new.UBICACION_N);
+    END;
+    
+    CREATE TRIGGER IF NOT EXISTS inventario_fts_ad AFTER DELETE ON inventario BEGIN
+        INSERT INTO inventario_fts (inventario_fts, rowid, CODIGO_N, DESCRIPCION_N, MARCA_N, UBICACION_N)
+        VALUES ('delete', old.id, old.CODIGO_N, old.DESCRIPCION_N, old.MARCA_N, old.UBICACION_N);
+    END;
+    
+    CREATE TRIGGER IF NOT EXISTS inventario_fts_au
+    AFTER UPDATE OF CODIGO_N, DESCRIPCION_N, MARCA_N, UBICACION_N ON inventario BEGIN
+        INSERT INTO inventario_fts (inventario_fts, rowid, CODIGO_N, DESCRIPCION_N, MARCA_N, UBICACION_N)
+        VALUES ('delete', old.id, old.CODIGO_N, old.DESCRIPCION_N, old.MARCA_N, old.UBICACION_N);
+        INSERT INTO inventario_fts (rowid, CODIGO_N, DESCRIPCION_N, MARCA_N, UBICACION_N)
+        VALUES (new.id, new.CODIGO_N, new.DESCRIPCION_N, new.MARCA_N, new.UBICACION_N);
+    END;
+    """)
+    
     # Tabla de usuarios
     conn.execute("""
     CREATE TABLE IF NOT EXISTS usuarios (
@@ -122,76 +615,1691 @@ def init_db():
         debe_cambiar_password INTEGER DEFAULT 1
     )
     """)
-    
-    # Insertar ubicaciones fijas por defecto
-    ubicaciones_default = ['BODEGA', 'OFICINA', 'ALMACEN', 'TALLER']
-    for ub in ubicaciones_default:
+    columnas = [col[1] for col in conn.execute("PRAGMA table_info(usuarios)").fetchall()]
+    if 'debe_cambiar_password' not in columnas:
+        conn.execute("ALTER TABLE usuarios ADD COLUMN debe_cambiar_password INTEGER DEFAULT 1")
+    
+    # Bandeja de salida de alertas de stock (la vacía EnviadorAlertas)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS bandeja_alertas (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        inventario_id INTEGER,
+        CODIGO TEXT,
+        DESCRIPCION TEXT,
+        CANTIDAD INTEGER,
+        MINIMO INTEGER,
+        creado TEXT,
+        estado TEXT NOT NULL DEFAULT 'pendiente',
+        intentos INTEGER NOT NULL DEFAULT 0,
+        proximo_intento TEXT,
+        enviado TEXT,
+        error TEXT
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bandeja_alertas_estado ON bandeja_alertas(estado, proximo_intento)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bandeja_alertas_producto ON bandeja_alertas(inventario_id, creado)")
+    
+    # Tabla de trabajos en segundo plano (importaciones y exportaciones)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS trabajos (
+        id TEXT PRIMARY KEY,
+        tipo TEXT NOT NULL,
+        estado TEXT NOT NULL DEFAULT 'pendiente',
+        parametros TEXT,
+        procesados INTEGER DEFAULT 0,
+        mensaje TEXT,
+        resultado TEXT,
+        archivo TEXT,
+        nombre_descarga TEXT,
+        usuario TEXT,
+        creado TEXT,
+        actualizado TEXT
+    )
+    """)
+    
+    if reconstruir_indice:
+        conn.execute("INSERT INTO inventario_fts (inventario_fts) VALUES ('rebuild')")
+
+@migracion(2)
+def indices_proyectos_y_movimientos(conn):
+    """Índices para el detalle/exportación de proyectos, movimientos y la lista de proyectos"""
+    ejecutar_script(conn, """
+    -- Detalle y exportación de un proyecto: el índice cubre todo lo que se lee de proyecto_items
+    CREATE INDEX IF NOT EXISTS idx_proyecto_items_proyecto
+        ON proyecto_items(proyecto_id, fecha_asignacion, inventario_id, cantidad_asignada, observacion);
+    CREATE INDEX IF NOT EXISTS idx_proyecto_items_inventario ON proyecto_items(inventario_id);
+    
+    CREATE INDEX IF NOT EXISTS idx_movimientos_inventario ON movimientos(inventario_id, fecha);
+    CREATE INDEX IF NOT EXISTS idx_movimientos_fecha ON movimientos(fecha);
+    
+    -- crear_proyecto lista los proyectos por fecha de inicio
+    CREATE INDEX IF NOT EXISTS idx_ubicaciones_tipo_fecha ON ubicaciones(tipo, fecha_inicio, nombre);
+    """)
+
+@migracion(3)
+def claves_foraneas(conn):
+    """Claves foráneas con acciones: asignaciones en cascada y movimientos sin producto"""
+    # Referencias que ya estaban rotas (las claves nunca se habían exigido)
+    conn.execute("""
+        DELETE FROM proyecto_items
+        WHERE proyecto_id IS NULL OR inventario_id IS NULL
+           OR proyecto_id NOT IN (SELECT id FROM ubicaciones)
+           OR inventario_id NOT IN (SELECT id FROM inventario)
+    """)
+    conn.execute("""
+        UPDATE movimientos SET inventario_id = NULL
+        WHERE inventario_id NOT IN (SELECT id FROM inventario)
+    """)
+    
+    # SQLite no permite cambiar una FOREIGN KEY: se reconstruyen las tablas
+    ejecutar_script(conn, """
+    CREATE TABLE proyecto_items_nueva (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        proyecto_id INTEGER NOT NULL REFERENCES ubicaciones(id) ON DELETE CASCADE,
+        inventario_id INTEGER NOT NULL REFERENCES inventario(id) ON DELETE CASCADE,
+        cantidad_asignada INTEGER,
+        fecha_asignacion TEXT,
+        observacion TEXT
+    );
+    INSERT INTO proyecto_items_nueva (id, proyecto_id, inventario_id, cantidad_asignada, fecha_asignacion, observacion)
+        SELECT id, proyecto_id, inventario_id, cantidad_asignada, fecha_asignacion, observacion FROM proyecto_items;
+    DROP TABLE proyecto_items;
+    ALTER TABLE proyecto_items_nueva RENAME TO proyecto_items;
+    CREATE INDEX idx_proyecto_items_proyecto
+        ON proyecto_items(proyecto_id, fecha_asignacion, inventario_id, cantidad_asignada, observacion);
+    CREATE INDEX idx_proyecto_items_inventario ON proyecto_items(inventario_id);
+    
+    CREATE TABLE movimientos_nueva (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        inventario_id INTEGER REFERENCES inventario(id) ON DELETE SET NULL,
+        tipo TEXT,
+        cantidad INTEGER,
+        fecha TEXT,
+        observacion TEXT,
+        proyecto TEXT
+    );
+    INSERT INTO movimientos_nueva (id, inventario_id, tipo, cantidad, fecha, observacion, proyecto)
+        SELECT id, inventario_id, tipo, cantidad, fecha, observacion, proyecto FROM movimientos;
+    DROP TABLE movimientos;
+    ALTER TABLE movimientos_nueva RENAME TO movimientos;
+    CREATE INDEX idx_movimientos_inventario ON movimientos(inventario_id, fecha);
+    CREATE INDEX idx_movimientos_fecha ON movimientos(fecha);
+    """)
+    
+    violaciones = conn.execute("PRAGMA foreign_key_check").fetchall()
+    if violaciones:
+        raise sqlite3.IntegrityError(
+            f"Quedan {len(violaciones)} referencias rotas (primera en la tabla {violaciones[0][0]})"
+        )
+
+@migracion(4)
+def indice_movimientos_por_proyecto(conn):
+    """Historial por producto filtrado por proyecto y fechas vacías normalizadas para paginar"""
+    # La paginación compara (fecha, id): una fecha NULL quedaría fuera de todas las páginas
+    conn.execute("UPDATE movimientos SET fecha = '' WHERE fecha IS NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_movimientos_inventario_proyecto ON movimientos(inventario_id, proyecto, fecha)")
+
+@migracion(5)
+def acumulados_de_movimientos(conn):
+    """Acumulados diarios y mensuales de movimientos (producto x día/mes x tipo x proyecto)"""
+    ejecutar_script(conn, """
+    CREATE TABLE IF NOT EXISTS movimientos_diarios (
+        dia TEXT NOT NULL,
+        inventario_id INTEGER NOT NULL,
+        tipo TEXT NOT NULL,
+        proyecto TEXT NOT NULL,
+        cantidad INTEGER NOT NULL DEFAULT 0,
+        movimientos INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (dia, inventario_id, tipo, proyecto)
+    ) WITHOUT ROWID;
+    
+    CREATE TABLE IF NOT EXISTS movimientos_mensuales (
+        mes TEXT NOT NULL,
+        inventario_id INTEGER NOT NULL,
+        tipo TEXT NOT NULL,
+        proyecto TEXT NOT NULL,
+        cantidad INTEGER NOT NULL DEFAULT 0,
+        movimientos INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (mes, inventario_id, tipo, proyecto)
+    ) WITHOUT ROWID;
+    
+    -- Cubre consumo_por_proyecto: agrupa por proyecto y producto recorriendo el índice en orden
+    CREATE INDEX IF NOT EXISTS idx_movimientos_mensuales_proyecto
+        ON movimientos_mensuales(proyecto, inventario_id, mes, tipo, cantidad);
+    
+    -- Cada movimiento suma en su día y su mes, escriba quien escriba (registrar_movimiento,
+    -- registrar_movimientos o los INSERT ... SELECT de proyectos)
+    CREATE TRIGGER IF NOT EXISTS movimientos_acumulados_ai AFTER INSERT ON movimientos BEGIN
+        INSERT INTO movimientos_diarios (dia, inventario_id, tipo, proyecto, cantidad, movimientos)
+        VALUES (substr(COALESCE(new.fecha, ''), 1, 10), COALESCE(new.inventario_id, 0),
+                COALESCE(new.tipo, ''), COALESCE(new.proyecto, ''), COALESCE(new.cantidad, 0), 1)
+        ON CONFLICT (dia, inventario_id, tipo, proyecto) DO UPDATE SET
+            cantidad = cantidad + excluded.cantidad,
+            movimientos = movimientos + 1;
+        INSERT INTO movimientos_mensuales (mes, inventario_id, tipo, proyecto, cantidad, movimientos)
+        VALUES (substr(COALESCE(new.fecha, ''), 1, 7), COALESCE(new.inventario_id, 0),
+                COALESCE(new.tipo, ''), COALESCE(new.proyecto, ''), COALESCE(new.cantidad, 0), 1)
+        ON CONFLICT (mes, inventario_id, tipo, proyecto) DO UPDATE SET
+            cantidad = cantidad + excluded.cantidad,
+            movimientos = movimientos + 1;
+    END;
+    """)
+    reconstruir_acumulados(conn)
+
+@migracion(6)
+def referencias_de_imagenes(conn):
+    """Cantidad de productos que usan cada archivo de imagen (mantenida por triggers)"""
+    ejecutar_script(conn, """
+    CREATE TABLE IF NOT EXISTS imagenes (
+        nombre TEXT PRIMARY KEY,
+        referencias INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID;
+    
+    CREATE TRIGGER IF NOT EXISTS imagenes_ai AFTER INSERT ON inventario
+    WHEN COALESCE(new.IMAGEN, '') != '' BEGIN
+        INSERT INTO imagenes (nombre, referencias) VALUES (new.IMAGEN, 1)
+        ON CONFLICT (nombre) DO UPDATE SET referencias = referencias + 1;
+    END;
+    
+    CREATE TRIGGER IF NOT EXISTS imagenes_au AFTER UPDATE OF IMAGEN ON inventario
+    WHEN old.IMAGEN IS NOT new.IMAGEN BEGIN
+        UPDATE imagenes SET referencias = referencias - 1 WHERE nombre = old.IMAGEN;
+        INSERT INTO imagenes (nombre, referencias)
+        SELECT new.IMAGEN, 1 WHERE COALESCE(new.IMAGEN, '') != ''
+        ON CONFLICT (nombre) DO UPDATE SET referencias = referencias + 1;
+    END;
+    
+    CREATE TRIGGER IF NOT EXISTS imagenes_ad AFTER DELETE ON inventario
+    WHEN COALESCE(old.IMAGEN, '') != '' BEGIN
+        UPDATE imagenes SET referencias = referencias - 1 WHERE nombre = old.IMAGEN;
+    END;
+    """)
+    recalcular_referencias_imagenes(conn)
+
+# Tabla -> clave de versiones que sube con cada escritura (ETag, Last-Modified y exportaciones)
+TABLAS_VERSIONADAS = {'ubicaciones': 'ubicaciones', 'inventario': 'inventario', 'proyecto_items': 'proyectos'}
+
+def crear_triggers_version(conn, tabla, clave):
+    """Triggers que suben la versión de clave con cada INSERT, UPDATE o DELETE en tabla"""
+    for sufijo, evento in (('ai', 'INSERT'), ('au', 'UPDATE'), ('ad', 'DELETE')):
+        conn.execute(f"DROP TRIGGER IF EXISTS {tabla}_version_{sufijo}")
+        conn.execute(f"""
+        CREATE TRIGGER {tabla}_version_{sufijo} AFTER {evento} ON {tabla} BEGIN
+            UPDATE versiones SET version = version + 1, actualizado = datetime('now') WHERE clave = '{clave}';
+        END
+        """)
+
+@migracion(7)
+def sellos_de_datos(conn):
+    """Versión y fecha del último cambio de inventario y proyectos (ETag, Last-Modified y exportaciones)"""
+    conn.execute("ALTER TABLE versiones ADD COLUMN actualizado TEXT")
+    conn.execute("INSERT OR IGNORE INTO versiones (clave, version) VALUES ('inventario', 0), ('proyectos', 0)")
+    conn.execute("UPDATE versiones SET actualizado = datetime('now')")
+    
+    # Cualquier escritura en estas tablas sube su contador (la fecha va en UTC, como en HTTP)
+    for tabla, clave in TABLAS_VERSIONADAS.items():
+        crear_triggers_version(conn, tabla, clave)
+    
+    # Una exportación ya generada para la misma versión de los datos se reutiliza
+    conn.execute("ALTER TABLE trabajos ADD COLUMN huella TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_trabajos_huella ON trabajos(huella)")
+
+@migracion(8)
+def tokens_de_api(conn):
+    """Tokens de acceso a la API JSON (se guarda solo su hash)"""
+    ejecutar_script(conn, """
+    CREATE TABLE IF NOT EXISTS api_tokens (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        token_hash TEXT NOT NULL UNIQUE,
+        usuario_id INTEGER NOT NULL REFERENCES usuarios(id) ON DELETE CASCADE,
+        nombre TEXT NOT NULL DEFAULT '',
+        creado TEXT NOT NULL,
+        ultimo_uso TEXT,
+        activo INTEGER NOT NULL DEFAULT 1
+    );
+    
+    CREATE INDEX IF NOT EXISTS idx_api_tokens_usuario ON api_tokens(usuario_id);
+    """)
+
+@migracion(9)
+def orden_sin_nulos(conn):
+    """Índices de orden sobre COALESCE(columna): la paginación por cursor no pierde filas con NULL"""
+    for indice in ('idx_inventario_descripcion_n', 'idx_inventario_marca_n',
+                   'idx_inventario_ubicacion_n', 'idx_inventario_cantidad'):
+        conn.execute(f"DROP INDEX IF EXISTS {indice}")
+    asegurar_columnas_busqueda(conn)
+
+def respaldar_asignaciones_huerfanas(conn):
+    """Copia a proyecto_items_huerfanos las asignaciones sin proyecto o sin producto y las quita.
+    
+    Retorna cuántas se movieron.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS proyecto_items_huerfanos (
+            id INTEGER PRIMARY KEY,
+            proyecto_id INTEGER,
+            inventario_id INTEGER,
+            cantidad_asignada INTEGER,
+            fecha_asignacion TEXT,
+            observacion TEXT,
+            respaldado TEXT NOT NULL
+        )
+    """)
+    huerfanas = """
+        FROM proyecto_items
+        WHERE proyecto_id IS NULL OR inventario_id IS NULL
+           OR proyecto_id NOT IN (SELECT id FROM ubicaciones)
+           OR inventario_id NOT IN (SELECT id FROM inventario)
+    """
+    conn.execute(f"""
+        INSERT OR REPLACE INTO proyecto_items_huerfanos
+            (id, proyecto_id, inventario_id, cantidad_asignada, fecha_asignacion, observacion, respaldado)
+        SELECT id, proyecto_id, inventario_id, cantidad_asignada, fecha_asignacion, observacion, datetime('now', 'localtime')
+        {huerfanas}
+    """)
+    movidas = conn.execute(f"DELETE {huerfanas}").rowcount
+    if movidas:
+        print(f"⚠️  {movidas} asignaciones sin proyecto o sin producto copiadas a proyecto_items_huerfanos")
+    return movidas
+
+def reconstruir_proyecto_items(conn):
+    """Reconstruye proyecto_items con sus claves foráneas (SQLite no permite cambiarlas).
+    
+    Eliminar un proyecto elimina sus asignaciones; un producto con asignaciones
+    no se puede eliminar (RESTRICT): el stock que está en una obra no desaparece
+    sin un movimiento.
+    """
+    ejecutar_script(conn, """
+    CREATE TABLE proyecto_items_nueva (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        proyecto_id INTEGER NOT NULL REFERENCES ubicaciones(id) ON DELETE CASCADE,
+        inventario_id INTEGER NOT NULL REFERENCES inventario(id) ON DELETE RESTRICT,
+        cantidad_asignada INTEGER,
+        fecha_asignacion TEXT,
+        observacion TEXT
+    );
+    INSERT INTO proyecto_items_nueva (id, proyecto_id, inventario_id, cantidad_asignada, fecha_asignacion, observacion)
+        SELECT id, proyecto_id, inventario_id, cantidad_asignada, fecha_asignacion, observacion FROM proyecto_items;
+    DROP TABLE proyecto_items;
+    ALTER TABLE proyecto_items_nueva RENAME TO proyecto_items;
+    CREATE INDEX idx_proyecto_items_proyecto
+        ON proyecto_items(proyecto_id, fecha_asignacion, inventario_id, cantidad_asignada, observacion);
+    CREATE INDEX idx_proyecto_items_inventario ON proyecto_items(inventario_id);
+    """)
+
+@migracion(10)
+def asignaciones_sin_cascada(conn):
+    """Un producto asignado a proyectos ya no se elimina en cascada con sus asignaciones"""
+    claves = conn.execute("PRAGMA foreign_key_list(proyecto_items)").fetchall()
+    if all(clave['on_delete'] == 'RESTRICT' for clave in claves if clave['table'] == 'inventario'):
+        return
+    respaldar_asignaciones_huerfanas(conn)
+    reconstruir_proyecto_items(conn)
+    # Los triggers de la tabla anterior se fueron con ella
+    crear_triggers_version(conn, 'proyecto_items', TABLAS_VERSIONADAS['proyecto_items'])
+    
+    violaciones = conn.execute("PRAGMA foreign_key_check(proyecto_items)").fetchall()
+    if violaciones:
+        raise sqlite3.IntegrityError(f"Quedan {len(violaciones)} asignaciones con referencias rotas")
+
+@migracion(11)
+def acumulados_sin_fecha_vacia(conn):
+    """Los movimientos sin fecha no entran en los acumulados (antes sumaban en un día y un mes vacíos)"""
+    ejecutar_script(conn, """
+    DROP TRIGGER IF EXISTS movimientos_acumulados_ai;
+    CREATE TRIGGER movimientos_acumulados_ai AFTER INSERT ON movimientos
+    WHEN COALESCE(new.fecha, '') != '' BEGIN
+        INSERT INTO movimientos_diarios (dia, inventario_id, tipo, proyecto, cantidad, movimientos)
+        VALUES (substr(new.fecha, 1, 10), COALESCE(new.inventario_id, 0),
+                COALESCE(new.tipo, ''), COALESCE(new.proyecto, ''), COALESCE(new.cantidad, 0), 1)
+        ON CONFLICT (dia, inventario_id, tipo, proyecto) DO UPDATE SET
+            cantidad = cantidad + excluded.cantidad,
+            movimientos = movimientos + 1;
+        INSERT INTO movimientos_mensuales (mes, inventario_id, tipo, proyecto, cantidad, movimientos)
+        VALUES (substr(new.fecha, 1, 7), COALESCE(new.inventario_id, 0),
+                COALESCE(new.tipo, ''), COALESCE(new.proyecto, ''), COALESCE(new.cantidad, 0), 1)
+        ON CONFLICT (mes, inventario_id, tipo, proyecto) DO UPDATE SET
+            cantidad = cantidad + excluded.cantidad,
+            movimientos = movimientos + 1;
+    END;
+    
+    DELETE FROM movimientos_diarios WHERE dia = '';
+    DELETE FROM movimientos_mensuales WHERE mes = '';
+    """)
+
+def init_db():
+    conn = abrir_conexion()
+    aplicar_migraciones(conn)
+    
+    # Columnas normalizadas de filas cargadas por fuera de la app
+    if asegurar_columnas_busqueda(conn):
+        conn.execute("INSERT INTO inventario_fts (inventario_fts) VALUES ('rebuild')")
+    
+    # Al arrancar se recalculan desde cero: corrige cambios hechos por fuera de la app
+    recalcular_resumen(conn)
+    sincronizar_bajo_stock(conn)
+    
+    # Los trabajos que quedaron a medias en una ejecución anterior ya no van a terminar
+    conn.execute("""
+        UPDATE trabajos SET estado = 'error', mensaje = 'Interrumpido por un reinicio del servidor'
+        WHERE estado IN ('pendiente', 'en_proceso')
+    """)
+    
+    # Insertar ubicaciones fijas por defecto
+    ubicaciones_default = ['BODEGA', 'OFICINA', 'ALMACEN', 'TALLER']
+    for ub in ubicaciones_default:
+        try:
+            conn.execute(
+                "INSERT OR IGNORE INTO ubicaciones (nombre, tipo) VALUES (?, 'FIJA')",
+                (ub,)
+            )
+        except:
+            pass
+    
+    # Insertar usuarios por defecto
+    fecha_actual = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    
+    usuarios_default = [
+        ('vvillavicencio', 'LSI2025!', 'Victor Villavicencio', 'admin'),
+        ('edasilva', 'LSI2025!', 'Edith Da Silva', 'admin'),
+        ('mrodriguez', 'LSI2025!', 'Mayeli Rodriguez', 'admin')
+    ]
+    
+    for username, password, nombre, rol in usuarios_default:
+        try:
+            conn.execute("""
+                INSERT OR IGNORE INTO usuarios (username, password, nombre_completo, rol, fecha_creacion, debe_cambiar_password)
+                VALUES (?, ?, ?, ?, ?, 1)
+            """, (username, password, nombre, rol, fecha_actual))
+        except:
+            pass
+    
+    conn.commit()
+    conn.close()
+
+def to_int(value, default=0):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+def to_float(value, default=0.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+# ============================================
+# 📥 IMPORTACIÓN MASIVA (VECTORIZADA)
+# ============================================
+
+COLUMNAS_IMPORTACION = [
+    'MARCA', 'CODIGO', 'DESCRIPCION', 'CANTIDAD', 'MINIMO', 'UBICACION', 'SERIAL',
+    'PRECIO_COSTO', 'PRECIO_DIST', 'PRECIO_INT', 'PRECIO_GENERAL'
+]
+
+def limpiar_texto(serie, default=''):
+    """Equivalente vectorizado de str(valor).strip() con NaN/'nan' como vacío"""
+    texto = serie.astype(str).str.strip()
+    return texto.mask(serie.isna() | (texto == 'nan') | (texto == ''), default)
+
+def limpiar_entero(serie):
+    """Equivalente vectorizado de to_int(): lo no numérico queda en 0"""
+    numeros = pd.to_numeric(serie, errors='coerce')
+    numeros = numeros.where(numeros.abs() != float('inf'))
+    return numeros.fillna(0).astype('int64')
+
+def limpiar_decimal(serie):
+    """Equivalente vectorizado de to_float(): lo no numérico queda en 0.0"""
+    return pd.to_numeric(serie, errors='coerce').fillna(0.0).astype('float64')
+
+def normalizar_serie(serie):
+    """Aplica normalizar_busqueda una sola vez por valor distinto de la columna"""
+    mapa = {valor: normalizar_busqueda(valor) for valor in serie.unique()}
+    return serie.map(mapa)
+
+def preparar_importacion(df):
+    """Limpia y tipa en bloque las columnas del Excel.
+    
+    Retorna (validos, errores): un DataFrame listo para insertar (con la columna
+    'fila' del Excel) y la lista de filas rechazadas con su motivo.
+    """
+    def columna(nombre):
+        if nombre in df.columns:
+            return df[nombre]
+        return pd.Series(None, index=df.index, dtype=object)
+    
+    datos = pd.DataFrame({
+        'MARCA': limpiar_texto(columna('MARCA')),
+        'CODIGO': limpiar_texto(columna('CODIGO')),
+        'DESCRIPCION': limpiar_texto(columna('DESCRIPCION')),
+        'CANTIDAD': limpiar_entero(columna('CANTIDAD')),
+        'MINIMO': limpiar_entero(columna('MINIMO')),
+        'UBICACION': limpiar_texto(columna('UBICACION'), 'BODEGA'),
+        'SERIAL': limpiar_texto(columna('SERIAL')),
+        'PRECIO_COSTO': limpiar_decimal(columna('PRECIO_COSTO')),
+        'PRECIO_DIST': limpiar_decimal(columna('PRECIO_DIST')),
+        'PRECIO_INT': limpiar_decimal(columna('PRECIO_INT')),
+        'PRECIO_GENERAL': limpiar_decimal(columna('PRECIO_GENERAL')),
+    }, index=df.index)
+    datos['fila'] = df.index + 2
+    
+    # Motivo de rechazo por fila (el primero que aplique)
+    motivo = pd.Series('', index=df.index)
+    motivo = motivo.mask((motivo == '') & (datos['CODIGO'] == ''), 'Falta el CODIGO')
+    motivo = motivo.mask((motivo == '') & (datos['DESCRIPCION'] == ''), 'Falta la DESCRIPCION')
+    motivo = motivo.mask(
+        (motivo == '') & ((datos['CANTIDAD'] < 0) | (datos['MINIMO'] < 0)),
+        'Cantidad y mínimo no pueden ser negativos'
+    )
+    invalidos = motivo != ''
+    
+    errores = [
+        {
+            'fila': fila,
+            'marca': marca,
+            'codigo': codigo,
+            'descripcion': descripcion[:50],
+            'motivo': texto,
+        }
+        for fila, marca, codigo, descripcion, texto in zip(
+            datos.loc[invalidos, 'fila'].tolist(),
+            datos.loc[invalidos, 'MARCA'].tolist(),
+            datos.loc[invalidos, 'CODIGO'].tolist(),
+            datos.loc[invalidos, 'DESCRIPCION'].tolist(),
+            motivo[invalidos].tolist(),
+        )
+    ]
+    
+    validos = datos[~invalidos].copy()
+    for campo in CAMPOS_BUSQUEDA:
+        validos[f"{campo}_N"] = normalizar_serie(validos[campo])
+    return validos, errores
+
+def filas_para_sql(df, columnas):
+    """Convierte columnas de un DataFrame en tuplas con tipos nativos de Python"""
+    return list(zip(*(df[c].tolist() for c in columnas)))
+
+def insertar_productos(conn, validos, tamano_lote=1000):
+    """Inserta los productos preparados con executemany por lotes.
+    
+    Si un lote falla se reintenta fila por fila para reportar solo las filas con
+    error. Retorna (insertados, errores).
+    """
+    columnas = COLUMNAS_IMPORTACION + [f"{c}_N" for c in CAMPOS_BUSQUEDA]
+    sql = f"""
+        INSERT INTO inventario ({', '.join(columnas)})
+        VALUES ({', '.join(['?'] * len(columnas))})
+    """
+    filas = filas_para_sql(validos, columnas)
+    numeros_fila = validos['fila'].tolist()
+    insertados = 0
+    errores = []
+    
+    # Todo el bloque va en una sola transacción; los SAVEPOINT solo aíslan cada lote.
+    # Mientras dura, el trigger de inventario_fts queda en pausa y las filas nuevas se
+    # indexan al final de una vez (la bandera nunca se ve fuera de esta transacción).
+    # IMMEDIATE: con un BEGIN diferido, leer MAX(id) y luego escribir falla con
+    # SQLITE_BUSY_SNAPSHOT si otro proceso escribió entre medio, y eso no se reintenta.
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    ultimo_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM inventario").fetchone()[0]
+    conn.execute("UPDATE banderas SET activa = 1 WHERE clave = 'fts_diferido'")
+    
+    for inicio in range(0, len(filas), tamano_lote):
+        lote = filas[inicio:inicio + tamano_lote]
+        conn.execute("SAVEPOINT lote_importacion")
+        try:
+            conn.executemany(sql, lote)
+            conn.execute("RELEASE SAVEPOINT lote_importacion")
+            insertados += len(lote)
+            continue
+        except sqlite3.Error:
+            conn.execute("ROLLBACK TO SAVEPOINT lote_importacion")
+            conn.execute("RELEASE SAVEPOINT lote_importacion")
+        
+        for fila, numero in zip(lote, numeros_fila[inicio:inicio + tamano_lote]):
+            try:
+                conn.execute(sql, fila)
+                insertados += 1
+            except sqlite3.Error as e:
+                errores.append({
+                    'fila': numero,
+                    'marca': fila[0],
+                    'codigo': fila[1],
+                    'descripcion': fila[2][:50],
+                    'motivo': f'Error: {str(e)}'
+                })
+    
+    conn.execute("""
+        INSERT INTO inventario_fts (rowid, CODIGO_N, DESCRIPCION_N, MARCA_N, UBICACION_N)
+        SELECT id, CODIGO_N, DESCRIPCION_N, MARCA_N, UBICACION_N FROM inventario WHERE id > ?
+    """, (ultimo_id,))
+    conn.execute("UPDATE banderas SET activa = 0 WHERE clave = 'fts_diferido'")
+    return insertados, errores
+
+
+def leer_existentes(conn, codigos, tamano_lote=500):
+    """Lectura por clave de los productos con esos códigos, en un DataFrame.
+    
+    Si hay varios registros con el mismo (CODIGO, SERIAL) se toma el de menor id.
+    """
+    columnas = ['id'] + COLUMNAS_IMPORTACION
+    filas = []
+    for inicio in range(0, len(codigos), tamano_lote):
+        bloque = codigos[inicio:inicio + tamano_lote]
+        filas += conn.execute(f"""
+            SELECT {', '.join(columnas)} FROM inventario
+            WHERE CODIGO IN ({', '.join(['?'] * len(bloque))})
+            ORDER BY id
+        """, bloque).fetchall()
+    existentes = pd.DataFrame([tuple(f) for f in filas], columns=columnas)
+    for campo in ['MARCA', 'CODIGO', 'DESCRIPCION', 'UBICACION', 'SERIAL']:
+        existentes[campo] = existentes[campo].fillna('').astype(str)
+    for campo in ['CANTIDAD', 'MINIMO']:
+        existentes[campo] = pd.to_numeric(existentes[campo]).fillna(0).astype('int64')
+    for campo in ['PRECIO_COSTO', 'PRECIO_DIST', 'PRECIO_INT', 'PRECIO_GENERAL']:
+        existentes[campo] = pd.to_numeric(existentes[campo]).fillna(0.0).astype('float64')
+    return existentes.drop_duplicates(subset=['CODIGO', 'SERIAL'], keep='first')
+
+def actualizar_o_insertar_productos(conn, validos, registrar_cambios_stock=False):
+    """Importación por CODIGO (+ SERIAL): actualiza los que cambiaron e inserta los nuevos.
+    
+    El cruce se hace en bloque: una lectura por clave de los existentes y una
+    comparación de columnas con pandas. Retorna (insertados, actualizados,
+    sin_cambios, errores).
+    """
+    errores = []
+    
+    # Claves repetidas dentro del archivo: gana la última fila
+    repetidas = validos.duplicated(subset=['CODIGO', 'SERIAL'], keep='last')
+    for fila, codigo, marca, descripcion in zip(
+        validos.loc[repetidas, 'fila'].tolist(), validos.loc[repetidas, 'CODIGO'].tolist(),
+        validos.loc[repetidas, 'MARCA'].tolist(), validos.loc[repetidas, 'DESCRIPCION'].tolist()
+    ):
+        errores.append({
+            'fila': fila, 'marca': marca, 'codigo': codigo, 'descripcion': descripcion[:50],
+            'motivo': 'CODIGO/SERIAL repetido en el archivo (se usó la última fila)'
+        })
+    validos = validos[~repetidas]
+    
+    # El cruce con los existentes se lee ya con el bloqueo de escritura tomado
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    existentes = leer_existentes(conn, validos['CODIGO'].unique().tolist())
+    cruce = validos.merge(
+        existentes, on=['CODIGO', 'SERIAL'], how='left', suffixes=('', '_actual'), indicator=True
+    )
+    
+    nuevos = cruce[cruce['_merge'] == 'left_only'][validos.columns]
+    coincidentes = cruce[cruce['_merge'] == 'both']
+    
+    comparables = [c for c in COLUMNAS_IMPORTACION if c not in ('CODIGO', 'SERIAL')]
+    cambio = pd.Series(False, index=coincidentes.index)
+    for campo in comparables:
+        cambio |= coincidentes[campo] != coincidentes[f"{campo}_actual"]
+    cambiados = coincidentes[cambio].copy()
+    cambiados['id'] = cambiados['id'].astype('int64')
+    
+    columnas = comparables + [f"{c}_N" for c in CAMPOS_BUSQUEDA]
+    conn.executemany(f"""
+        UPDATE inventario SET {', '.join(f'{c} = ?' for c in columnas)}
+        WHERE id = ?
+    """, filas_para_sql(cambiados, columnas + ['id']))
+    
+    if registrar_cambios_stock:
+        diferencias = cambiados[cambiados['CANTIDAD'] != cambiados['CANTIDAD_actual']].copy()
+        diferencias['delta'] = diferencias['CANTIDAD'] - diferencias['CANTIDAD_actual']
+        diferencias['tipo'] = diferencias['delta'].gt(0).map({True: 'entrada', False: 'salida'})
+        diferencias['delta'] = diferencias['delta'].abs()
+        diferencias['observacion'] = 'Ajuste por importación de Excel'
+        diferencias['proyecto'] = ''
+        registrar_movimientos(conn, filas_para_sql(
+            diferencias, ['id', 'tipo', 'delta', 'observacion', 'proyecto']
+        ))
+    
+    insertados, errores_insercion = insertar_productos(conn, nuevos)
+    errores += errores_insercion
+    return insertados, len(cambiados), len(coincidentes) - len(cambiados), errores
+
+
+EXTENSIONES_IMPORTACION = ('.xlsx', '.xls', '.csv')
+
+def leer_bloques(archivo, nombre, tamano_bloque):
+    """Lee el archivo de importación por bloques sin cargarlo entero en memoria.
+    
+    Retorna (columnas, bloques): los encabezados y un generador de DataFrames de
+    hasta tamano_bloque filas cuyo índice es la posición de la fila de datos (la
+    fila de Excel es índice + 2). .xlsx se lee con openpyxl en modo read_only y
+    .csv con pandas por chunks; .xls (formato antiguo) no admite lectura por
+    streaming y se carga completo.
+    """
+    extension = os.path.splitext(nombre)[1].lower()
+    
+    if extension == '.csv':
+        lector = pd.read_csv(
+            archivo, chunksize=tamano_bloque, dtype=str,
+            sep=None, engine='python', encoding='utf-8-sig'
+        )
+        primero = next(lector, None)
+        if primero is None:
+            return [], iter(())
+        primero.columns = [str(c).strip() for c in primero.columns]
+        columnas = list(primero.columns)
+        
+        def bloques_csv():
+            yield primero
+            for bloque in lector:
+                bloque.columns = columnas
+                yield bloque
+        return columnas, bloques_csv()
+    
+    if extension == '.xlsx':
+        libro = openpyxl.load_workbook(archivo, read_only=True, data_only=True)
+        filas = libro.active.iter_rows(values_only=True)
+        encabezado = next(filas, None) or ()
+        columnas = [str(c).strip() if c is not None else f"Unnamed: {i}" for i, c in enumerate(encabezado)]
+        
+        def bloques_xlsx():
+            datos, indices = [], []
+            try:
+                for posicion, fila in enumerate(filas):
+                    if all(valor is None for valor in fila):
+                        continue
+                    fila = tuple(fila[:len(columnas)])
+                    datos.append(fila + (None,) * (len(columnas) - len(fila)))
+                    indices.append(posicion)
+                    if len(datos) >= tamano_bloque:
+                        yield pd.DataFrame(datos, columns=columnas, index=indices)
+                        datos, indices = [], []
+                if datos:
+                    yield pd.DataFrame(datos, columns=columnas, index=indices)
+            finally:
+                libro.close()
+        return columnas, bloques_xlsx()
+    
+    df = pd.read_excel(archivo)
+    df.columns = [str(c).strip() for c in df.columns]
+    return list(df.columns), (df.iloc[i:i + tamano_bloque] for i in range(0, len(df), tamano_bloque))
+
+def importar_bloques(conn, bloques, modo="insertar", registrar_cambios_stock=False, progreso=None):
+    """Valida e inserta cada bloque a medida que llega, confirmando por bloque.
+    
+    progreso(filas_procesadas) se llama al terminar cada bloque. Retorna un
+    resumen con totales y, como máximo, IMPORTACION_MAX_ERRORES errores detallados.
+    """
+    resumen = {
+        'total_filas': 0, 'insertados': 0, 'actualizados': 0, 'sin_cambios': 0,
+        'omitidos': 0, 'errores': []
+    }
+    max_errores = app.config["IMPORTACION_MAX_ERRORES"]
+    
+    for df in bloques:
+        validos, errores = preparar_importacion(df)
+        
+        def importar(conn):
+            if modo == "actualizar":
+                return actualizar_o_insertar_productos(conn, validos, registrar_cambios_stock)
+            insertados, errores_insercion = insertar_productos(conn, validos)
+            return insertados, 0, 0, errores_insercion
+        
+        # Cada bloque con BEGIN IMMEDIATE: si la base sigue ocupada se reintenta el bloque completo
+        insertados, actualizados, sin_cambios, errores_insercion = en_transaccion_inmediata(conn, importar)
+        resumen['actualizados'] += actualizados
+        resumen['sin_cambios'] += sin_cambios
+        
+        errores = sorted(errores + errores_insercion, key=lambda e: e['fila'])
+        resumen['insertados'] += insertados
+        resumen['omitidos'] += len(errores)
+        resumen['errores'] += errores[:max(max_errores - len(resumen['errores']), 0)]
+        resumen['total_filas'] += len(df)
+        if progreso:
+            progreso(resumen['total_filas'])
+    
+    return resumen
+
+def mensajes_resumen_importacion(resumen, modo):
+    """Helper con los mensajes (categoría, texto) que resumen una importación"""
+    mensajes = []
+    total_filas = resumen['total_filas']
+    if modo == "actualizar":
+        mensajes.append(("success",
+            f"✅ Importación completa: {resumen['insertados']} nuevos, {resumen['actualizados']} actualizados y "
+            f"{resumen['sin_cambios']} sin cambios de {total_filas} filas"
+        ))
+    else:
+        mensajes.append(("success", f"✅ Importación completa: {resumen['insertados']} productos insertados de {total_filas} filas"))
+    
+    if resumen['omitidos'] > 0:
+        mensajes.append(("warning", f"⚠️ Se omitieron {resumen['omitidos']} filas con errores"))
+        
+        for error in resumen['errores'][:10]:
+            mensajes.append(("warning", f"Fila {error['fila']}: {error['motivo']}"))
+        
+        if resumen['omitidos'] > 10:
+            mensajes.append(("info", f"... y {resumen['omitidos'] - 10} errores más"))
+    return mensajes
+
+
+# ============================================
+# 📤 EXPORTACIÓN POR STREAMING
+# ============================================
+
+MIMETYPE_XLSX = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Columnas propias de inventario (sin las normalizadas de búsqueda)
+COLUMNAS_EXPORTACION = ['id'] + COLUMNAS_IMPORTACION + ['IMAGEN']
+
+def filas_cursor(cursor, tamano_lote=1000):
+    """Recorre un cursor de a tamano_lote filas sin traerlo entero a memoria"""
+    while True:
+        filas = cursor.fetchmany(tamano_lote)
+        if not filas:
+            return
+        yield from filas
+
+def escribir_excel(cursor, destino, hoja, anchos=None, progreso=None, cada=5000):
+    """Vuelca las filas del cursor a un .xlsx en modo write_only.
+    
+    Cada fila se escribe y se descarta, así la memoria no crece con el tamaño de
+    la exportación. anchos (opcional) fija el ancho de cada columna; debe
+    conocerse antes de escribir la primera fila. Retorna las filas escritas.
+    """
+    columnas = [descripcion[0] for descripcion in cursor.description]
+    libro = openpyxl.Workbook(write_only=True)
+    hoja_excel = libro.create_sheet(hoja)
+    for idx, ancho in enumerate(anchos or [], start=1):
+        hoja_excel.column_dimensions[get_column_letter(idx)].width = ancho
+    
+    encabezado = []
+    for columna in columnas:
+        celda = WriteOnlyCell(hoja_excel, value=columna)
+        celda.font = Font(bold=True)
+        encabezado.append(celda)
+    hoja_excel.append(encabezado)
+    
+    total = 0
+    for fila in filas_cursor(cursor):
+        hoja_excel.append(tuple(fila))
+        total += 1
+        if progreso and total % cada == 0:
+            progreso(total)
+    
+    libro.save(destino)
+    return total
+
+def generar_csv(cursor, tamano_lote=1000):
+    """Generador de CSV (UTF-8 con BOM, legible por Excel) a partir de un cursor"""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    buffer.write('\ufeff')
+    escritor.writerow([descripcion[0] for descripcion in cursor.description])
+    
+    while True:
+        filas = cursor.fetchmany(tamano_lote)
+        if not filas:
+            break
+        escritor.writerows(filas)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+    
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def respuesta_csv(cursor, nombre_archivo):
+    """Helper para enviar un cursor como descarga CSV por streaming"""
+    return Response(
+        stream_with_context(generar_csv(cursor)),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename="{nombre_archivo}"'}
+    )
+
+def consulta_exportacion(busqueda=""):
+    """Cursor con las columnas exportables de los productos que coinciden con la búsqueda"""
+    query, params, orden = consulta_busqueda(busqueda, ", ".join(f"i.{c}" for c in COLUMNAS_EXPORTACION))
+    return get_db_connection().execute(query + orden, params)
+
+def consulta_plantilla():
+    """Cursor con todo el inventario en el formato de la plantilla de importación"""
+    return get_db_connection().execute(
+        f"SELECT {', '.join(COLUMNAS_IMPORTACION)} FROM inventario ORDER BY id"
+    )
+
+
+# ============================================
+# ⚙️ TRABAJOS EN SEGUNDO PLANO
+# ============================================
+
+# Tipos de trabajo registrados: tipo -> función(conn, trabajo_id, **parametros)
+TRABAJOS = {}
+ESTADOS_FINALES = ('completado', 'error')
+
+_ejecutor = None
+_ejecutor_pid = None
+_ejecutor_lock = threading.Lock()
+
+def trabajo(tipo):
+    """Registra una función como tipo de trabajo ejecutable en segundo plano"""
+    def registrar(funcion):
+        TRABAJOS[tipo] = funcion
+        return funcion
+    return registrar
+
+def obtener_ejecutor():
+    """Retorna el pool de hilos del proceso actual (se recrea tras un fork de workers)"""
+    global _ejecutor, _ejecutor_pid
+    if _ejecutor is None or _ejecutor_pid != os.getpid():
+        with _ejecutor_lock:
+            if _ejecutor is None or _ejecutor_pid != os.getpid():
+                _ejecutor = ThreadPoolExecutor(
+                    max_workers=app.config["TRABAJOS_WORKERS"], thread_name_prefix="trabajo"
+                )
+                _ejecutor_pid = os.getpid()
+    return _ejecutor
+
+def ruta_resultado(nombre):
+    os.makedirs(app.config["RESULTADOS_FOLDER"], exist_ok=True)
+    return os.path.join(app.config["RESULTADOS_FOLDER"], nombre)
+
+def actualizar_trabajo(trabajo_id, **campos):
+    """Actualiza el registro del trabajo con una conexión propia.
+    
+    Así el progreso se confirma de inmediato sin tocar la transacción del trabajo.
+    """
+    campos['actualizado'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn = abrir_conexion()
+    try:
+        conn.execute(
+            f"UPDATE trabajos SET {', '.join(f'{c} = ?' for c in campos)} WHERE id = ?",
+            (*campos.values(), trabajo_id)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def limpiar_resultados():
+    """Borra archivos de resultados y trabajos terminados más antiguos que el TTL.
+    
+    Los archivos de trabajos que todavía no terminan (el archivo subido de una
+    importación en cola, la exportación que se está escribiendo) no se tocan.
+    Si los resultados de trabajos completados superan RESULTADOS_MAX_MB, se
+    borran primero los que hace más tiempo no se descargan (cada descarga renueva
+    su fecha).
+    """
+    limite = time.time() - app.config["RESULTADOS_TTL_HORAS"] * 3600
+    carpeta = app.config["RESULTADOS_FOLDER"]
+    conn = get_db_connection()
+    
+    en_uso = set()
+    completados = set()
+    for fila in conn.execute("SELECT estado, archivo, parametros FROM trabajos"):
+        if fila['estado'] == 'completado':
+            if fila['archivo']:
+                completados.add(fila['archivo'])
+        elif fila['estado'] not in ESTADOS_FINALES:
+            if fila['archivo']:
+                en_uso.add(fila['archivo'])
+            ruta = json.loads(fila['parametros'] or '{}').get('ruta')
+            if ruta:
+                en_uso.add(os.path.basename(ruta))
+    
+    if os.path.isdir(carpeta):
+        vigentes = []
+        for entrada in os.scandir(carpeta):
+            try:
+                if not entrada.is_file() or entrada.name in en_uso:
+                    continue
+                datos = entrada.stat()
+                if datos.st_mtime < limite:
+                    os.remove(entrada.path)
+                elif entrada.name in completados:
+                    vigentes.append((datos.st_mtime, datos.st_size, entrada.path))
+            except OSError:
+                pass
+        
+        sobrante = sum(tamano for _, tamano, _ in vigentes) - app.config["RESULTADOS_MAX_MB"] * 1024 * 1024
+        for _, tamano, ruta in sorted(vigentes):
+            if sobrante <= 0:
+                break
+            try:
+                os.remove(ruta)
+                sobrante -= tamano
+            except OSError:
+                pass
+    
+    conn.execute(
+        f"DELETE FROM trabajos WHERE estado IN ({', '.join('?' * len(ESTADOS_FINALES))}) AND actualizado < ?",
+        (*ESTADOS_FINALES, datetime.fromtimestamp(limite).strftime("%Y-%m-%d %H:%M:%S"))
+    )
+    conn.commit()
+
+def renovar_resultado(conn, trabajo_id, archivo):
+    """Marca el resultado de un trabajo como recién usado: la limpieza no borra ni el archivo
+    (por antigüedad o por tamaño) ni la fila del trabajo. Retorna False si el archivo ya no existe.
+    """
+    try:
+        os.utime(ruta_resultado(archivo))
+    except OSError:
+        return False
+    conn.execute(
+        "UPDATE trabajos SET actualizado = ? WHERE id = ?",
+        (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), trabajo_id)
+    )
+    conn.commit()
+    return True
+
+def encolar_trabajo(tipo, claves_datos=None, **parametros):
+    """Registra el trabajo y lo envía al pool de hilos. Retorna su id de inmediato.
+    
+    Con claves_datos (tablas de las que sale el resultado), si ya hay un trabajo
+    igual para la misma versión de esos datos, en curso o con su archivo todavía
+    en disco, se retorna ese en lugar de generar otro.
+    """
+    conn = get_db_connection()
+    
+    huella = None
+    if claves_datos:
+        huella = f"{tipo}|{json.dumps(parametros, sort_keys=True)}|{sello_datos(conn, claves_datos)[0]}"
+        previo = conn.execute("""
+            SELECT id, estado, archivo FROM trabajos
+            WHERE huella = ? AND estado != 'error'
+            ORDER BY creado DESC LIMIT 1
+        """, (huella,)).fetchone()
+        if previo and previo['estado'] != 'completado':
+            return previo['id']
+        if previo and previo['archivo'] and renovar_resultado(conn, previo['id'], previo['archivo']):
+            return previo['id']
+    
+    # Solo cuando se va a generar algo nuevo: reutilizar un resultado no recorre la carpeta
+    limpiar_resultados()
+    
+    trabajo_id = uuid.uuid4().hex
+    ahora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn.execute("""
+        INSERT INTO trabajos (id, tipo, estado, parametros, usuario, creado, actualizado, huella)
+        VALUES (?, ?, 'pendiente', ?, ?, ?, ?, ?)
+    """, (trabajo_id, tipo, json.dumps(parametros), session.get('username'), ahora, ahora, huella))
+    conn.commit()
+    
+    obtener_ejecutor().submit(ejecutar_trabajo, trabajo_id)
+    return trabajo_id
+
+def ejecutar_trabajo(trabajo_id):
+    """Corre un trabajo dentro de un contexto de la app (con su conexión del pool)"""
+    with app.app_context():
+        conn = get_db_connection()
+        fila = conn.execute("SELECT tipo, parametros FROM trabajos WHERE id = ?", (trabajo_id,)).fetchone()
+        if fila is None:
+            return
+        
+        actualizar_trabajo(trabajo_id, estado='en_proceso')
+        try:
+            resultado = TRABAJOS[fila['tipo']](conn, trabajo_id, **json.loads(fila['parametros']))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            app.logger.exception("Falló el trabajo %s (%s)", trabajo_id, fila['tipo'])
+            actualizar_trabajo(trabajo_id, estado='error', mensaje=str(e))
+            return
+        
+        actualizar_trabajo(
+            trabajo_id,
+            estado='completado',
+            archivo=resultado.pop('archivo', None),
+            nombre_descarga=resultado.pop('nombre_descarga', None),
+            resultado=json.dumps(resultado)
+        )
+
+@trabajo('importacion')
+def trabajo_importacion(conn, trabajo_id, ruta, nombre, modo, registrar_cambios_stock):
+    try:
+        with open(ruta, 'rb') as archivo:
+            columnas, bloques = leer_bloques(archivo, nombre, app.config["IMPORTACION_TAMANO_BLOQUE"])
+            
+            columnas_requeridas = ['MARCA', 'CODIGO', 'DESCRIPCION']
+            columnas_faltantes = [col for col in columnas_requeridas if col not in columnas]
+            if columnas_faltantes:
+                raise ValueError(f"Faltan columnas requeridas: {', '.join(columnas_faltantes)}")
+            
+            resumen = importar_bloques(
+                conn, bloques, modo, registrar_cambios_stock,
+                progreso=lambda filas: actualizar_trabajo(trabajo_id, procesados=filas)
+            )
+    finally:
+        os.remove(ruta)
+    
+    resumen['modo'] = modo
+    resumen['mensajes'] = mensajes_resumen_importacion(resumen, modo)
+    return resumen
+
+@trabajo('exportar')
+def trabajo_exportar(conn, trabajo_id, busqueda):
+    archivo = f"{trabajo_id}.xlsx"
+    filas = escribir_excel(
+        consulta_exportacion(busqueda), ruta_resultado(archivo), 'Inventario',
+        progreso=lambda total: actualizar_trabajo(trabajo_id, procesados=total)
+    )
+    actualizar_trabajo(trabajo_id, procesados=filas)
+    return {'filas': filas, 'archivo': archivo, 'nombre_descarga': 'export_inventario.xlsx'}
+
+@trabajo('plantilla')
+def trabajo_plantilla(conn, trabajo_id):
+    archivo = f"{trabajo_id}.xlsx"
+    filas = escribir_excel(
+        consulta_plantilla(), ruta_resultado(archivo), 'Inventario',
+        progreso=lambda total: actualizar_trabajo(trabajo_id, procesados=total)
+    )
+    actualizar_trabajo(trabajo_id, procesados=filas)
+    return {'filas': filas, 'archivo': archivo, 'nombre_descarga': 'inventario_LSI.xlsx'}
+
+@trabajo('proyecto')
+def trabajo_exportar_proyecto(conn, trabajo_id, proyecto_id):
+    proyecto = conn.execute("SELECT nombre FROM ubicaciones WHERE id = ?", (proyecto_id,)).fetchone()
+    columnas = [
+        ('i.CODIGO', 'CODIGO'),
+        ('i.MARCA', 'MARCA'),
+        ('i.DESCRIPCION', 'DESCRIPCION'),
+        ('pi.cantidad_asignada', 'CANTIDAD_ASIGNADA'),
+        ('i.CANTIDAD', 'STOCK_ACTUAL'),
+        ('i.UBICACION', 'UBICACION'),
+        ('pi.fecha_asignacion', 'FECHA_ASIGNACION'),
+        ('pi.observacion', 'OBSERVACION'),
+    ]
+    desde = """
+        FROM proyecto_items pi
+        JOIN inventario i ON pi.inventario_id = i.id
+        WHERE pi.proyecto_id = ?
+    """
+    
+    # Anchos de columna calculados en SQL: en modo write_only van antes de las filas
+    largos = ", ".join(f"MAX(LENGTH(COALESCE({expr}, '')))" for expr, _ in columnas)
+    maximos = conn.execute(f"SELECT {largos} {desde}", (proyecto_id,)).fetchone()
+    anchos = [max(maximo or 0, len(alias)) + 2 for maximo, (_, alias) in zip(maximos, columnas)]
+    
+    cursor = conn.execute(
+        f"SELECT {', '.join(f'{expr} AS {alias}' for expr, alias in columnas)} {desde} ORDER BY i.CODIGO",
+        (proyecto_id,)
+    )
+    archivo = f"{trabajo_id}.xlsx"
+    filas = escribir_excel(cursor, ruta_resultado(archivo), 'Productos Asignados', anchos=anchos)
+    actualizar_trabajo(trabajo_id, procesados=filas)
+    return {
+        'filas': filas,
+        'archivo': archivo,
+        'nombre_descarga': f"Proyecto_{proyecto['nombre'].replace(' ', '_')}.xlsx",
+    }
+
+
+# ============================================
+# 📧 ALERTAS DE STOCK (BANDEJA DE SALIDA)
+# ============================================
+
+def destinatario_alertas():
+    return app.config["ALERTAS_DESTINATARIO"] or app.config["SMTP_USER"]
+
+def encolar_alerta_stock(conn, producto):
+    """Deja la alerta en la bandeja de salida, dentro de la transacción del cambio de stock.
+    
+    Si el producto ya tuvo una alerta dentro de ALERTAS_VENTANA_MIN no se crea
+    otra: solo se actualiza la cantidad de la que sigue pendiente. El envío lo
+    hace el hilo EnviadorAlertas, que agrupa las pendientes en un solo correo.
+    """
+    if not destinatario_alertas():
+        print("⚠ SMTP no configurado. Se omite la alerta de stock.")
+        return
+    
+    ahora = datetime.now()
+    desde = (ahora - timedelta(minutes=app.config["ALERTAS_VENTANA_MIN"])).strftime("%Y-%m-%d %H:%M:%S")
+    reciente = conn.execute("""
+        SELECT id, estado FROM bandeja_alertas
+        WHERE inventario_id = ? AND creado >= ?
+        ORDER BY id DESC LIMIT 1
+    """, (producto['id'], desde)).fetchone()
+    
+    if reciente:
+        if reciente['estado'] == 'pendiente':
+            conn.execute(
+                "UPDATE bandeja_alertas SET CANTIDAD = ?, MINIMO = ? WHERE id = ?",
+                (producto['CANTIDAD'], producto['MINIMO'], reciente['id'])
+            )
+        return
+    
+    ahora = ahora.strftime("%Y-%m-%d %H:%M:%S")
+    conn.execute("""
+        INSERT INTO bandeja_alertas
+        (inventario_id, CODIGO, DESCRIPCION, CANTIDAD, MINIMO, creado, proximo_intento)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (producto['id'], producto['CODIGO'], producto['DESCRIPCION'],
+          producto['CANTIDAD'], producto['MINIMO'], ahora, ahora))
+    obtener_enviador().avisar()
+
+def alertar_si_entra_en_bajo_stock(conn, antes, despues):
+    """Encola la alerta si una edición de CANTIDAD o MINIMO deja el producto en bajo stock y antes no lo estaba"""
+    def bajo(producto):
+        return (producto['CANTIDAD'] is not None and producto['MINIMO'] is not None
+                and producto['CANTIDAD'] <= producto['MINIMO'])
+    if bajo(despues) and not bajo(antes):
+        encolar_alerta_stock(conn, despues)
+
+def armar_correo_alertas(alertas):
+    """Arma un único correo con todas las alertas pendientes"""
+    msg = EmailMessage()
+    if len(alertas) == 1:
+        msg["Subject"] = f"⚠️ Alerta de stock bajo: {alertas[0]['DESCRIPCION']}"
+    else:
+        msg["Subject"] = f"⚠️ Alerta de stock bajo: {len(alertas)} productos"
+    msg["From"] = app.config["SMTP_FROM"] or app.config["SMTP_USER"] or destinatario_alertas()
+    msg["To"] = destinatario_alertas()
+    
+    lineas = ["Los siguientes productos están por debajo del stock mínimo:", ""]
+    for alerta in alertas:
+        lineas.append(
+            f"- {alerta['DESCRIPCION']} (Código {alerta['CODIGO']}) | "
+            f"Cantidad actual: {alerta['CANTIDAD']} | Stock mínimo: {alerta['MINIMO']}"
+        )
+    msg.set_content("\n".join(lineas))
+    return msg
+
+class EnviadorAlertas:
+    """Hilo que vacía la bandeja de salida con una conexión SMTP persistente.
+    
+    Espera un aviso (o ALERTAS_INTERVALO segundos), deja pasar ALERTAS_ESPERA_LOTE
+    segundos para juntar las alertas que llegan en ráfaga y las envía en un solo
+    correo. Si el envío falla, reintenta con espera exponencial hasta
+    ALERTAS_MAX_INTENTOS y luego las marca como fallidas.
+    """
+    
+    def __init__(self):
+        self._evento = threading.Event()
+        self._lock = threading.Lock()
+        self._smtp = None
+        self._hilo = None
+        self.correos = 0
+        self.alertas = 0
+        self.fallos = 0
+    
+    def iniciar(self):
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=self._bucle, name="enviador-alertas", daemon=True)
+            self._hilo.start()
+    
+    def avisar(self):
+        self._evento.set()
+    
+    def _bucle(self):
+        while True:
+            self._evento.wait(app.config["ALERTAS_INTERVALO"])
+            self._evento.clear()
+            time.sleep(app.config["ALERTAS_ESPERA_LOTE"])
+            try:
+                self.procesar()
+            except Exception as e:
+                print("❌ Error procesando alertas de stock:", e)
+    
+    def _conexion(self):
+        """Reutiliza la conexión SMTP abierta si sigue viva; si no, abre otra"""
+        if self._smtp is not None:
+            try:
+                if self._smtp.noop()[0] == 250:
+                    return self._smtp
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.cerrar()
+        
+        smtp = smtplib.SMTP(app.config["SMTP_HOST"], app.config["SMTP_PORT"], timeout=app.config["SMTP_TIMEOUT"])
+        try:
+            if app.config["SMTP_STARTTLS"]:
+                smtp.starttls()
+            if app.config["SMTP_USER"] and app.config["SMTP_PASS"]:
+                smtp.login(app.config["SMTP_USER"], app.config["SMTP_PASS"])
+        except Exception:
+            smtp.close()
+            raise
+        self._smtp = smtp
+        return smtp
+    
+    def cerrar(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self._smtp.close()
+            self._smtp = None
+    
+    def procesar(self):
+        """Envía en un solo correo las alertas pendientes cuyo reintento ya venció.
+        
+        Retorna la cantidad de alertas enviadas.
+        """
+        with self._lock:
+            conn = abrir_conexion()
+            try:
+                ahora = datetime.now()
+                # Con varios workers cada uno tiene su enviador: las alertas se reservan
+                # corriendo su próximo intento, así ningún otro proceso las toma mientras
+                # tanto (y si este muere a mitad del envío, vuelven a salir después)
+                reserva = ahora + timedelta(seconds=app.config["SMTP_TIMEOUT"] * 2)
+                alertas = sorted(conn.execute("""
+                    UPDATE bandeja_alertas SET proximo_intento = ?
+                    WHERE estado = 'pendiente' AND proximo_intento <= ?
+                    RETURNING *
+                """, (reserva.strftime("%Y-%m-%d %H:%M:%S"), ahora.strftime("%Y-%m-%d %H:%M:%S"))).fetchall(),
+                    key=lambda alerta: alerta['id'])
+                conn.commit()
+                if not alertas:
+                    return 0
+                
+                try:
+                    self._conexion().send_message(armar_correo_alertas(alertas))
+                except (smtplib.SMTPException, OSError) as e:
+                    print("❌ Error enviando correo:", e)
+                    self.cerrar()
+                    self.fallos += 1
+                    conn.executemany("""
+                        UPDATE bandeja_alertas
+                        SET intentos = intentos + 1,
+                            estado = CASE WHEN intentos + 1 >= ? THEN 'fallido' ELSE 'pendiente' END,
+                            proximo_intento = ?,
+                            error = ?
+                        WHERE id = ?
+                    """, [(
+                        app.config["ALERTAS_MAX_INTENTOS"],
+                        (ahora + timedelta(
+                            seconds=app.config["ALERTAS_REINTENTO_BASE"] * 2 ** alerta['intentos']
+                        )).strftime("%Y-%m-%d %H:%M:%S"),
+                        str(e),
+                        alerta['id'],
+                    ) for alerta in alertas])
+                    conn.commit()
+                    return 0
+                
+                conn.executemany(
+                    "UPDATE bandeja_alertas SET estado = 'enviado', enviado = ?, error = NULL WHERE id = ?",
+                    [(ahora.strftime("%Y-%m-%d %H:%M:%S"), alerta['id']) for alerta in alertas]
+                )
+                conn.commit()
+                self.correos += 1
+                self.alertas += len(alertas)
+                print(f"✅ Correo de alerta enviado correctamente ({len(alertas)} productos)")
+                return len(alertas)
+            finally:
+                conn.close()
+    
+    def metricas(self):
+        return {
+            'activo': self._hilo is not None and self._hilo.is_alive(),
+            'correos': self.correos,
+            'alertas': self.alertas,
+            'fallos': self.fallos,
+        }
+
+_enviador = None
+_enviador_pid = None
+_enviador_lock = threading.Lock()
+
+def obtener_enviador():
+    """Retorna el enviador de alertas del proceso actual, iniciando su hilo si hace falta"""
+    global _enviador, _enviador_pid
+    if _enviador is None or _enviador_pid != os.getpid():
+        with _enviador_lock:
+            if _enviador is None or _enviador_pid != os.getpid():
+                _enviador = EnviadorAlertas()
+                _enviador_pid = os.getpid()
+    if destinatario_alertas():
+        _enviador.iniciar()
+    return _enviador
+
+@app.before_request
+def iniciar_enviador_alertas():
+    # Las alertas que quedaron pendientes antes de un reinicio salen sin esperar a una nueva
+    obtener_enviador()
+
+
+# ============================================
+# 🖼️ IMÁGENES DE PRODUCTOS
+# ============================================
+
+# El original se guarda como <hash del contenido><ext> en UPLOAD_FOLDER y sus versiones
+# reducidas (JPEG) en UPLOAD_FOLDER/<tamaño>/<hash>.jpg. Como el nombre solo cambia si
+# cambia el contenido, el navegador puede guardarlas en caché sin volver a preguntar.
+
+def ruta_imagen(nombre, tamano='original'):
+    if tamano == 'original':
+        return os.path.join(app.config["UPLOAD_FOLDER"], nombre)
+    return os.path.join(app.config["UPLOAD_FOLDER"], tamano, os.path.splitext(nombre)[0] + ".jpg")
+
+def hash_archivo(ruta):
+    resumen = hashlib.sha256()
+    with open(ruta, "rb") as origen:
+        for bloque in iter(lambda: origen.read(1024 * 1024), b""):
+            resumen.update(bloque)
+    return resumen.hexdigest()[:32]
+
+def guardar_imagen(archivo):
+    """Guarda la imagen subida con el hash de su contenido como nombre y genera sus versiones.
+    
+    Subir dos veces la misma foto reutiliza el archivo que ya existe. Retorna el nombre.
+    """
+    os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+    temporal = os.path.join(app.config["UPLOAD_FOLDER"], f".subida-{uuid.uuid4().hex}")
+    resumen = hashlib.sha256()
+    with open(temporal, "wb") as destino:
+        for bloque in iter(lambda: archivo.stream.read(1024 * 1024), b""):
+            resumen.update(bloque)
+            destino.write(bloque)
+    
+    nombre = resumen.hexdigest()[:32] + os.path.splitext(archivo.filename)[1].lower()
+    if os.path.exists(ruta_imagen(nombre)):
+        os.remove(temporal)
+        # Recién usado otra vez: que la limpieza no lo tome por abandonado
+        os.utime(ruta_imagen(nombre))
+    else:
+        os.replace(temporal, ruta_imagen(nombre))
+    generar_versiones(nombre)
+    return nombre
+
+def es_imagen_legible(nombre):
+    """Si Pillow sabe abrir archivos con esa extensión (un PDF, por ejemplo, solo lo sabe escribir)"""
+    formato = Image.registered_extensions().get(os.path.splitext(nombre)[1].lower())
+    return formato in Image.OPEN
+
+def generar_versiones(nombre):
+    """Crea las versiones reducidas que falten. Retorna cuántas generó.
+    
+    Si Pillow no está instalado o el archivo no es una imagen no genera nada y
+    se sigue sirviendo el original.
+    """
+    if Image is None or not es_imagen_legible(nombre):
+        return 0
+    tamanos = app.config["IMAGEN_TAMANOS"]
+    faltantes = sorted(
+        (t for t in tamanos if not os.path.exists(ruta_imagen(nombre, t))),
+        key=lambda t: tamanos[t], reverse=True
+    )
+    if not faltantes:
+        return 0
+    
+    try:
+        with Image.open(ruta_imagen(nombre)) as original:
+            # Un JPEG se decodifica ya reducido al tamaño más grande que hace falta
+            original.draft("RGB", (tamanos[faltantes[0]], tamanos[faltantes[0]]))
+            imagen = ImageOps.exif_transpose(original)
+            if imagen.mode in ("RGBA", "LA", "P"):
+                imagen = imagen.convert("RGBA")
+                fondo = Image.new("RGB", imagen.size, "white")
+                fondo.paste(imagen, mask=imagen.getchannel("A"))
+                imagen = fondo
+            else:
+                imagen = imagen.convert("RGB")
+            
+            # De la más grande a la más chica: cada una se reduce desde la anterior
+            for tamano in faltantes:
+                imagen.thumbnail((tamanos[tamano], tamanos[tamano]), Image.LANCZOS)
+                ruta = ruta_imagen(nombre, tamano)
+                os.makedirs(os.path.dirname(ruta), exist_ok=True)
+                temporal = f"{ruta}.{uuid.uuid4().hex}.tmp"
+                imagen.save(temporal, "JPEG", quality=app.config["IMAGEN_CALIDAD"], optimize=True, progressive=True)
+                os.replace(temporal, ruta)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        print(f"⚠️  No se pudieron generar las versiones de {nombre}: {e}")
+        return 0
+    return len(faltantes)
+
+def recalcular_referencias_imagenes(conn):
+    """Recuenta desde inventario cuántos productos usan cada imagen"""
+    conn.execute("DELETE FROM imagenes")
+    conn.execute("""
+        INSERT INTO imagenes (nombre, referencias)
+        SELECT IMAGEN, COUNT(*) FROM inventario
+        WHERE COALESCE(IMAGEN, '') != ''
+        GROUP BY IMAGEN
+    """)
+
+def borrar_archivos_imagen(nombre):
+    """Borra el original y sus versiones. Retorna los bytes liberados"""
+    liberados = 0
+    for tamano in ('original', *app.config["IMAGEN_TAMANOS"]):
+        ruta = ruta_imagen(nombre, tamano)
         try:
-            conn.execute(
-                "INSERT OR IGNORE INTO ubicaciones (nombre, tipo) VALUES (?, 'FIJA')",
-                (ub,)
-            )
-        except:
+            tamano_archivo = os.path.getsize(ruta)
+            os.remove(ruta)
+            liberados += tamano_archivo
+        except OSError:
             pass
+    return liberados
+
+def liberar_imagen(conn, nombre):
+    """Quita la imagen del registro si ningún producto la usa, dentro de la transacción del llamador.
     
-    # Insertar usuarios por defecto
-    fecha_actual = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    No confirma ni borra archivos: retorna el nombre liberado (o None) para
+    pasarlo a borrar_imagenes_liberadas después del commit. Si el commit no
+    llega, la fila vuelve y los archivos siguen ahí.
+    """
+    if not nombre:
+        return None
+    fila = conn.execute(
+        "DELETE FROM imagenes WHERE nombre = ? AND referencias <= 0 RETURNING nombre", (nombre,)
+    ).fetchone()
+    return fila['nombre'] if fila else None
+
+def borrar_imagenes_liberadas(conn, nombres):
+    """Borra del disco las imágenes que liberar_imagen quitó del registro (después del commit).
     
-    usuarios_default = [
-        ('vvillavicencio', 'LSI2025!', 'Victor Villavicencio', 'admin'),
-        ('edasilva', 'LSI2025!', 'Edith Da Silva', 'admin'),
-        ('mrodriguez', 'LSI2025!', 'Mayeli Rodriguez', 'admin')
-    ]
+    Se saltan las que otro producto volvió a tomar mientras tanto y las que una
+    subida reutilizó hace menos de IMAGENES_GRACIA_MIN (guardar_imagen renueva la
+    fecha antes de que el producto se guarde); esas quedan para recolectar_imagenes.
+    """
+    gracia = time.time() - app.config["IMAGENES_GRACIA_MIN"] * 60
+    for nombre in {n for n in nombres if n}:
+        if conn.execute("SELECT 1 FROM imagenes WHERE nombre = ?", (nombre,)).fetchone():
+            continue
+        try:
+            if os.path.getmtime(ruta_imagen(nombre)) >= gracia:
+                continue
+        except OSError:
+            continue
+        borrar_archivos_imagen(nombre)
+
+def recolectar_imagenes(conn, limite=None):
+    """Borra los archivos de UPLOAD_FOLDER que ningún producto usa.
     
-    for username, password, nombre, rol in usuarios_default:
+    Compara el contenido de la carpeta (originales y versiones) con el conjunto de
+    nombres en inventario.IMAGEN. Los archivos más nuevos que IMAGENES_GRACIA_MIN
+    se respetan: pueden ser de una subida cuyo producto todavía no se guardó.
+    Con limite se borran como máximo esa cantidad de originales por pasada.
+    Retorna {'revisados', 'borrados', 'bytes', 'pendientes'}.
+    """
+    carpeta = app.config["UPLOAD_FOLDER"]
+    resultado = {'revisados': 0, 'borrados': 0, 'bytes': 0, 'pendientes': 0}
+    if not os.path.isdir(carpeta):
+        return resultado
+    
+    recalcular_referencias_imagenes(conn)
+    conn.commit()
+    en_uso = {fila[0] for fila in conn.execute("SELECT nombre FROM imagenes")}
+    usados_sin_extension = {os.path.splitext(nombre)[0] for nombre in en_uso}
+    gracia = time.time() - app.config["IMAGENES_GRACIA_MIN"] * 60
+    
+    def antiguo(entrada):
         try:
-            conn.execute("""
-                INSERT OR IGNORE INTO usuarios (username, password, nombre_completo, rol, fecha_creacion, debe_cambiar_password)
-                VALUES (?, ?, ?, ?, ?, 1)
-            """, (username, password, nombre, rol, fecha_actual))
-        except:
-            pass
+            return entrada.is_file() and entrada.stat().st_mtime < gracia
+        except OSError:
+            return False
+    
+    # Originales: lo que hay en la carpeta menos lo que usa algún producto
+    archivos = {}
+    for entrada in os.scandir(carpeta):
+        if entrada.is_file():
+            resultado['revisados'] += 1
+            archivos[entrada.name] = entrada
+    for nombre in sorted(archivos.keys() - en_uso):
+        if not antiguo(archivos[nombre]):
+            continue
+        if limite is not None and resultado['borrados'] >= limite:
+            resultado['pendientes'] += 1
+            continue
+        resultado['bytes'] += borrar_archivos_imagen(nombre)
+        resultado['borrados'] += 1
+    
+    # Versiones cuyo original ya no se usa (o que quedaron a medio escribir)
+    for tamano in app.config["IMAGEN_TAMANOS"]:
+        subcarpeta = os.path.join(carpeta, tamano)
+        if not os.path.isdir(subcarpeta):
+            continue
+        for entrada in os.scandir(subcarpeta):
+            resultado['revisados'] += 1
+            if os.path.splitext(entrada.name)[0] not in usados_sin_extension and antiguo(entrada):
+                try:
+                    resultado['bytes'] += entrada.stat().st_size
+                    os.remove(entrada.path)
+                except OSError:
+                    pass
     
+    conn.execute("DELETE FROM imagenes WHERE referencias <= 0")
     conn.commit()
-    conn.close()
+    return resultado
 
-def to_int(value, default=0):
-    try:
-        return int(value)
-    except (TypeError, ValueError):
-        return default
+def normalizar_imagen(conn, nombre):
+    """Renombra una imagen antigua (nombre aleatorio) al hash de su contenido y genera sus versiones.
+    
+    Los productos que la usan pasan al nombre nuevo; si ya existía un archivo con
+    ese contenido, el duplicado se borra. Retorna (nombre nuevo, versiones generadas)
+    o (None, 0) si el archivo no existe.
+    """
+    ruta = ruta_imagen(nombre)
+    if not os.path.exists(ruta):
+        return None, 0
+    nuevo = hash_archivo(ruta) + os.path.splitext(nombre)[1].lower()
+    if nuevo != nombre:
+        if os.path.exists(ruta_imagen(nuevo)):
+            os.remove(ruta)
+        else:
+            os.replace(ruta, ruta_imagen(nuevo))
+        conn.execute("UPDATE inventario SET IMAGEN = ? WHERE IMAGEN = ?", (nuevo, nombre))
+        conn.commit()
+    return nuevo, generar_versiones(nuevo)
 
-def to_float(value, default=0.0):
-    try:
-        return float(value)
-    except (TypeError, ValueError):
-        return default
+@app.template_global()
+def url_imagen(nombre, tamano='mediana'):
+    return url_for('imagen_producto', tamano=tamano, nombre=nombre)
 
-def enviar_alerta_stock(producto):
-    try:
-        smtp_user = os.environ.get("SMTP_USER")
-        smtp_pass = os.environ.get("SMTP_PASS")
-        smtp_host = os.environ.get("SMTP_HOST", "smtp.gmail.com")
-        smtp_port = int(os.environ.get("SMTP_PORT", 587))
-        if not smtp_user or not smtp_pass:
-            print("⚠ SMTP credentials not configured. Skipping enviar_alerta_stock.")
-            return
-        msg = EmailMessage()
-        msg["Subject"] = f"⚠️ Alerta de stock bajo: {producto['DESCRIPCION']}"
-        msg["From"] = smtp_user
-        msg["To"] = smtp_user
-        msg.set_content(
-            f"El producto {producto['DESCRIPCION']} (Código {producto['CODIGO']}) "
-            f"está por debajo del stock mínimo.\n"
-            f"Cantidad actual: {producto['CANTIDAD']} | Stock mínimo: {producto['MINIMO']}"
-        )
-        with smtplib.SMTP(smtp_host, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_pass)
-            server.send_message(msg)
-        print("✅ Correo de alerta enviado correctamente")
-    except Exception as e:
-        print("❌ Error enviando correo:", e)
+
+# ============================================
+# 📊 ACUMULADOS DE MOVIMIENTOS (REPORTES)
+# ============================================
+
+# Los reportes leen movimientos_diarios / movimientos_mensuales (mantenidos por el
+# trigger movimientos_acumulados_ai): su costo depende del período, no del historial.
+
+def reconstruir_acumulados(conn):
+    """Recalcula los acumulados desde cero a partir de movimientos.
+    
+    Lo usa la migración que crea las tablas y reconstruir_acumulados.py para
+    corregir cambios hechos por fuera de la app. Los movimientos sin fecha no
+    caen en ningún día ni mes y se dejan fuera. Retorna las filas diarias creadas.
+    """
+    conn.execute("DELETE FROM movimientos_diarios")
+    conn.execute("DELETE FROM movimientos_mensuales")
+    conn.execute("""
+        INSERT INTO movimientos_diarios (dia, inventario_id, tipo, proyecto, cantidad, movimientos)
+        SELECT substr(fecha, 1, 10), COALESCE(inventario_id, 0), COALESCE(tipo, ''),
+               COALESCE(proyecto, ''), SUM(COALESCE(cantidad, 0)), COUNT(*)
+        FROM movimientos
+        WHERE COALESCE(fecha, '') != ''
+        GROUP BY 1, 2, 3, 4
+    """)
+    conn.execute("""
+        INSERT INTO movimientos_mensuales (mes, inventario_id, tipo, proyecto, cantidad, movimientos)
+        SELECT substr(dia, 1, 7), inventario_id, tipo, proyecto, SUM(cantidad), SUM(movimientos)
+        FROM movimientos_diarios
+        GROUP BY 1, 2, 3, 4
+    """)
+    return conn.execute("SELECT COUNT(*) FROM movimientos_diarios").fetchone()[0]
+
+def inicio_periodo(dias):
+    """Primer día (AAAA-MM-DD) de una ventana de N días que termina hoy"""
+    return (datetime.now() - timedelta(days=dias - 1)).strftime("%Y-%m-%d")
+
+def inicio_meses(meses):
+    """Primer mes (AAAA-MM) de una ventana de N meses que termina en el mes actual"""
+    hoy = datetime.now()
+    total = hoy.year * 12 + hoy.month - 1 - (meses - 1)
+    return f"{total // 12:04d}-{total % 12 + 1:02d}"
+
+def top_movidos(conn, dias=30, limite=10):
+    """Productos con más unidades movidas (entradas + salidas) en los últimos N días"""
+    return conn.execute("""
+        SELECT a.inventario_id AS id, i.CODIGO, i.DESCRIPCION, i.MARCA, i.CANTIDAD,
+               a.entradas, a.salidas, a.total, a.movimientos
+        FROM (
+            SELECT inventario_id,
+                   SUM(CASE WHEN tipo = 'entrada' THEN cantidad ELSE 0 END) AS entradas,
+                   SUM(CASE WHEN tipo = 'salida' THEN cantidad ELSE 0 END) AS salidas,
+                   SUM(cantidad) AS total,
+                   SUM(movimientos) AS movimientos
+            FROM movimientos_diarios
+            WHERE dia >= ?
+            GROUP BY inventario_id
+            ORDER BY total DESC
+            LIMIT ?
+        ) a
+        JOIN inventario i ON i.id = a.inventario_id
+        ORDER BY a.total DESC
+    """, (inicio_periodo(dias), limite)).fetchall()
+
+def consumo_por_proyecto(conn, meses=12):
+    """Unidades y costo que salieron hacia cada proyecto (descontando devoluciones) en N meses"""
+    # Primero por proyecto y producto (sigue el índice, sin ordenar), así el precio
+    # se busca una vez por producto y no por cada fila mensual
+    return conn.execute("""
+        SELECT p.proyecto,
+               SUM(p.salidas) AS salidas,
+               SUM(p.devoluciones) AS devoluciones,
+               SUM(p.salidas - p.devoluciones) AS neto,
+               SUM((p.salidas - p.devoluciones) * COALESCE(i.PRECIO_COSTO, 0)) AS costo_neto,
+               COUNT(*) AS productos
+        FROM (
+            SELECT proyecto, inventario_id,
+                   SUM(CASE WHEN tipo = 'salida' THEN cantidad ELSE 0 END) AS salidas,
+                   SUM(CASE WHEN tipo = 'entrada' THEN cantidad ELSE 0 END) AS devoluciones
+            FROM movimientos_mensuales
+            WHERE mes >= ? AND proyecto != '' AND tipo IN ('entrada', 'salida')
+            GROUP BY proyecto, inventario_id
+        ) p
+        LEFT JOIN inventario i ON i.id = p.inventario_id
+        GROUP BY p.proyecto
+        ORDER BY neto DESC
+    """, (inicio_meses(meses),)).fetchall()
+
+def velocidad_stock(conn, dias=90, limite=20):
+    """Consumo diario promedio (salidas) y días de cobertura del stock actual, los más urgentes primero"""
+    return conn.execute("""
+        SELECT i.id, i.CODIGO, i.DESCRIPCION, i.CANTIDAD, i.MINIMO,
+               v.salidas,
+               ROUND(v.salidas * 1.0 / ?, 2) AS consumo_diario,
+               CAST(i.CANTIDAD / (v.salidas * 1.0 / ?) AS INTEGER) AS dias_cobertura
+        FROM (
+            SELECT inventario_id, SUM(cantidad) AS salidas
+            FROM movimientos_diarios
+            WHERE dia >= ? AND tipo = 'salida'
+            GROUP BY inventario_id
+        ) v
+        JOIN inventario i ON i.id = v.inventario_id
+        WHERE v.salidas > 0
+        ORDER BY dias_cobertura, v.salidas DESC
+        LIMIT ?
+    """, (dias, dias, inicio_periodo(dias), limite)).fetchall()
+
+def movimientos_recientes(conn, limite=10):
+    """Últimos movimientos registrados (recorrido por id descendente)"""
+    return conn.execute("""
+        SELECT m.id, m.inventario_id, m.tipo, m.cantidad, m.fecha, m.proyecto, i.CODIGO, i.DESCRIPCION
+        FROM movimientos m
+        LEFT JOIN inventario i ON i.id = m.inventario_id
+        ORDER BY m.id DESC
+        LIMIT ?
+    """, (limite,)).fetchall()
 
 
 # ============================================
@@ -216,21 +2324,435 @@ def registrar_movimiento(conn, inventario_id, tipo, cantidad, observacion="", pr
         VALUES (?, ?, ?, ?, ?, ?)
     """, (inventario_id, tipo, cantidad, fecha, observacion, proyecto))
 
-def actualizar_stock_y_verificar(conn, inventario_id, nueva_cantidad):
-    """Helper para actualizar stock y enviar alerta si es necesario"""
-    conn.execute("UPDATE inventario SET CANTIDAD = ? WHERE id = ?", (nueva_cantidad, inventario_id))
-    producto = conn.execute("SELECT * FROM inventario WHERE id = ?", (inventario_id,)).fetchone()
+def registrar_movimientos(conn, movimientos):
+    """Helper para registrar en bloque (inventario_id, tipo, cantidad, observacion, proyecto)"""
+    fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn.executemany("""
+        INSERT INTO movimientos (inventario_id, tipo, cantidad, fecha, observacion, proyecto)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [(i, tipo, cantidad, fecha, observacion, proyecto)
+          for i, tipo, cantidad, observacion, proyecto in movimientos])
+
+def reponer_stock(conn, inventario_id, cantidad):
+    """Helper para sumar stock en una sola sentencia; retorna el stock nuevo o None si el producto no existe"""
+    fila = conn.execute("""
+        UPDATE inventario SET CANTIDAD = CANTIDAD + ?
+        WHERE id = ?
+        RETURNING CANTIDAD
+    """, (cantidad, inventario_id)).fetchall()
+    return fila[0]['CANTIDAD'] if fila else None
+
+def descontar_stock_y_verificar(conn, inventario_id, cantidad):
+    """Helper para descontar stock solo si alcanza y enviar alerta si es necesario.
+    
+    El chequeo y el descuento son una sola sentencia condicional, así dos
+    asignaciones simultáneas no pueden dejar el stock negativo. Retorna
+    (restante, stock_bajo); restante es None si no había stock suficiente.
+    """
+    fila = conn.execute("""
+        UPDATE inventario SET CANTIDAD = CANTIDAD - ?
+        WHERE id = ? AND CANTIDAD >= ?
+        RETURNING CANTIDAD
+    """, (cantidad, inventario_id, cantidad)).fetchall()
+    if not fila:
+        return None, False
+    
+    producto = conn.execute("""
+        SELECT i.* FROM bajo_stock b JOIN inventario i ON i.id = b.inventario_id
+        WHERE b.inventario_id = ?
+    """, (inventario_id,)).fetchone()
+    
+    if producto:
+        encolar_alerta_stock(conn, producto)
+    return fila[0]['CANTIDAD'], producto is not None
+
+def asignar_lote(conn, proyecto, lineas, parcial=False):
+    """Helper que asigna N líneas (producto, cantidad) a un proyecto en una sola transacción.
+    
+    El stock de todas las líneas se valida con una sola consulta (las líneas del
+    mismo producto se suman). Sin parcial, si alguna línea no alcanza no se
+    aplica ninguna; con parcial se aplican las que alcanzan. Debe correr dentro
+    de en_transaccion_inmediata. Retorna (asignadas, rechazadas, stock_bajo).
+    """
+    rechazadas = []
+    validas = []
+    for numero, linea in enumerate(lineas, start=1):
+        inventario_id = to_int(linea.get('inventario_id'), None)
+        cantidad = to_int(linea.get('cantidad'), 0)
+        if inventario_id is None or cantidad <= 0:
+            rechazadas.append({'linea': numero, 'inventario_id': inventario_id, 'motivo': 'Producto o cantidad inválida'})
+            continue
+        validas.append({
+            'linea': numero,
+            'inventario_id': inventario_id,
+            'cantidad': cantidad,
+            'observacion': str(linea.get('observacion') or '').strip().upper(),
+        })
+    
+    # Validación de stock de todo el lote en una consulta
+    disponibles = {
+        fila['inventario_id']: fila for fila in conn.execute("""
+            SELECT p.inventario_id, p.solicitado, i.CANTIDAD AS disponible
+            FROM (
+                SELECT json_extract(value, '$.inventario_id') AS inventario_id,
+                       SUM(json_extract(value, '$.cantidad')) AS solicitado
+                FROM json_each(?)
+                GROUP BY 1
+            ) p
+            LEFT JOIN inventario i ON i.id = p.inventario_id
+        """, (json.dumps(validas),))
+    }
+    
+    aceptadas = []
+    for linea in validas:
+        fila = disponibles[linea['inventario_id']]
+        if fila['disponible'] is None:
+            rechazadas.append({**linea, 'motivo': 'Producto no encontrado'})
+        elif fila['disponible'] < fila['solicitado']:
+            rechazadas.append({
+                **linea, 'motivo': f"Stock insuficiente. Disponible: {fila['disponible']}",
+                'disponible': fila['disponible'],
+            })
+        else:
+            aceptadas.append(linea)
+    
+    if rechazadas and not parcial:
+        return [], sorted(rechazadas, key=lambda r: r['linea']), []
+    
+    fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    totales = {}
+    for linea in aceptadas:
+        totales[linea['inventario_id']] = totales.get(linea['inventario_id'], 0) + linea['cantidad']
+    
+    # El bloqueo de BEGIN IMMEDIATE mantiene válida la validación; el WHERE es la red de seguridad
+    conn.executemany(
+        "UPDATE inventario SET CANTIDAD = CANTIDAD - ? WHERE id = ? AND CANTIDAD >= ?",
+        [(total, inventario_id, total) for inventario_id, total in totales.items()]
+    )
+    conn.executemany("""
+        INSERT INTO proyecto_items (proyecto_id, inventario_id, cantidad_asignada, fecha_asignacion, observacion)
+        VALUES (?, ?, ?, ?, ?)
+    """, [(proyecto['id'], l['inventario_id'], l['cantidad'], fecha, l['observacion']) for l in aceptadas])
+    registrar_movimientos(conn, [
+        (l['inventario_id'], 'salida', l['cantidad'], f"Asignado a proyecto: {l['observacion']}", proyecto['nombre'])
+        for l in aceptadas
+    ])
+    
+    # Un solo resumen de bajo stock: las alertas van a la bandeja y salen en un mismo correo
+    stock_bajo = []
+    if totales:
+        stock_bajo = conn.execute(f"""
+            SELECT i.* FROM bajo_stock b JOIN inventario i ON i.id = b.inventario_id
+            WHERE b.inventario_id IN ({', '.join('?' * len(totales))})
+        """, list(totales)).fetchall()
+        for producto in stock_bajo:
+            encolar_alerta_stock(conn, producto)
+    
+    return aceptadas, sorted(rechazadas, key=lambda r: r['linea']), stock_bajo
+
+def devolver_stock_proyecto(conn, proyecto, observacion):
+    """Helper que devuelve al stock todo lo asignado a un proyecto con dos sentencias.
+    
+    Suma las líneas por producto en un solo UPDATE ... FROM y registra un
+    movimiento de entrada por línea con un solo INSERT ... SELECT. Debe correr
+    dentro de en_transaccion_inmediata. Retorna las unidades devueltas.
+    """
+    fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn.execute("""
+        INSERT INTO movimientos (inventario_id, tipo, cantidad, fecha, observacion, proyecto)
+        SELECT pi.inventario_id, 'entrada', pi.cantidad_asignada, ?, ?, ?
+        FROM proyecto_items pi
+        JOIN inventario i ON i.id = pi.inventario_id
+        WHERE pi.proyecto_id = ? AND pi.cantidad_asignada > 0
+        ORDER BY pi.id
+    """, (fecha, observacion, proyecto['nombre'], proyecto['id']))
+    
+    devueltas = conn.execute("""
+        SELECT COALESCE(SUM(pi.cantidad_asignada), 0) FROM proyecto_items pi
+        JOIN inventario i ON i.id = pi.inventario_id
+        WHERE pi.proyecto_id = ? AND pi.cantidad_asignada > 0
+    """, (proyecto['id'],)).fetchone()[0]
+    
+    conn.execute("""
+        UPDATE inventario SET CANTIDAD = inventario.CANTIDAD + d.total
+        FROM (
+            SELECT inventario_id, SUM(cantidad_asignada) AS total
+            FROM proyecto_items
+            WHERE proyecto_id = ? AND cantidad_asignada > 0
+            GROUP BY inventario_id
+        ) AS d
+        WHERE inventario.id = d.inventario_id
+    """, (proyecto['id'],))
+    
+    return devueltas
+
+def en_transaccion_inmediata(conn, operacion):
+    """Ejecuta operacion(conn) dentro de BEGIN IMMEDIATE y confirma.
+    
+    BEGIN IMMEDIATE toma el bloqueo de escritura al empezar, antes de cualquier
+    lectura. Si la base sigue ocupada después del busy timeout se reintenta con
+    espera creciente hasta DB_REINTENTOS veces.
+    """
+    reintentos = app.config["DB_REINTENTOS"]
+    for intento in range(reintentos + 1):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            resultado = operacion(conn)
+            conn.commit()
+            return resultado
+        except sqlite3.OperationalError as e:
+            if conn.in_transaction:
+                conn.rollback()
+            ocupada = 'locked' in str(e) or 'busy' in str(e)
+            if not ocupada or intento == reintentos:
+                raise
+            time.sleep(0.05 * 2 ** intento)
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+
+def recalcular_resumen(conn):
+    """Recalcula los contadores del tablero con un solo recorrido de inventario"""
+    conn.execute("INSERT OR IGNORE INTO resumen_inventario (id) VALUES (1)")
+    conn.execute("""
+        UPDATE resumen_inventario SET
+            (total_productos, bajo_stock, unidades, valor_costo, valor_dist, valor_int, valor_general) = (
+                SELECT
+                    COUNT(*),
+                    COALESCE(SUM(CANTIDAD <= MINIMO), 0),
+                    COALESCE(SUM(CANTIDAD), 0),
+                    COALESCE(SUM(CANTIDAD * PRECIO_COSTO), 0),
+                    COALESCE(SUM(CANTIDAD * PRECIO_DIST), 0),
+                    COALESCE(SUM(CANTIDAD * PRECIO_INT), 0),
+                    COALESCE(SUM(CANTIDAD * PRECIO_GENERAL), 0)
+                FROM inventario
+            )
+        WHERE id = 1
+    """)
+
+def sincronizar_bajo_stock(conn):
+    """Alinea la lista de bajo stock con inventario (bases anteriores o cambios hechos por fuera)"""
+    ahora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn.execute("""
+        UPDATE historial_bajo_stock SET salida = ?
+        WHERE salida IS NULL AND inventario_id IN (
+            SELECT b.inventario_id FROM bajo_stock b
+            LEFT JOIN inventario i ON i.id = b.inventario_id
+            WHERE NOT COALESCE(i.CANTIDAD <= i.MINIMO, 0)
+        )
+    """, (ahora,))
+    conn.execute("""
+        DELETE FROM bajo_stock WHERE inventario_id NOT IN (
+            SELECT id FROM inventario WHERE CANTIDAD <= MINIMO
+        )
+    """)
+    conn.execute("""
+        INSERT INTO historial_bajo_stock (inventario_id, entrada)
+        SELECT id, ? FROM inventario
+        WHERE CANTIDAD <= MINIMO AND id NOT IN (SELECT inventario_id FROM bajo_stock)
+    """, (ahora,))
+    conn.execute("""
+        INSERT INTO bajo_stock (inventario_id, desde)
+        SELECT id, ? FROM inventario
+        WHERE CANTIDAD <= MINIMO AND id NOT IN (SELECT inventario_id FROM bajo_stock)
+    """, (ahora,))
+
+def leer_resumen(conn):
+    """Contadores del tablero (lectura por clave primaria)"""
+    return conn.execute("SELECT * FROM resumen_inventario WHERE id = 1").fetchone()
+
+CAMPOS_BUSQUEDA = ['CODIGO', 'DESCRIPCION', 'MARCA', 'UBICACION']
+
+# Índice -> expresión de orden (sin el alias i.); ver COLUMNAS_ORDEN
+INDICES_ORDEN = {
+    'idx_inventario_orden_codigo': "COALESCE(CODIGO_N, '')",
+    'idx_inventario_orden_descripcion': "COALESCE(DESCRIPCION_N, '')",
+    'idx_inventario_orden_marca': "COALESCE(MARCA_N, '')",
+    'idx_inventario_orden_ubicacion': "COALESCE(UBICACION_N, '')",
+    'idx_inventario_orden_cantidad': "COALESCE(CANTIDAD, 0)",
+}
+
+def campos_busqueda(codigo, descripcion, marca, ubicacion):
+    """Helper que calcula los valores de CODIGO_N, DESCRIPCION_N, MARCA_N y UBICACION_N"""
+    return (
+        normalizar_busqueda(codigo),
+        normalizar_busqueda(descripcion),
+        normalizar_busqueda(marca),
+        normalizar_busqueda(ubicacion),
+    )
+
+def asegurar_columnas_busqueda(conn, tamano_lote=5000):
+    """Agrega las columnas normalizadas si faltan y rellena las filas que no las tienen.
+    
+    Retorna la cantidad de filas rellenadas.
+    """
+    columnas = [col[1] for col in conn.execute("PRAGMA table_info(inventario)").fetchall()]
+    for campo in CAMPOS_BUSQUEDA:
+        if f"{campo}_N" not in columnas:
+            conn.execute(f"ALTER TABLE inventario ADD COLUMN {campo}_N TEXT")
+    
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_inventario_codigo_n ON inventario (CODIGO_N)")
+    # Índices de orden de la tabla principal: la misma expresión que COLUMNAS_ORDEN
+    for nombre, expresion in INDICES_ORDEN.items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {nombre} ON inventario ({expresion})")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_inventario_codigo_serial ON inventario (CODIGO, SERIAL)")
+    
+    rellenados = 0
+    ultimo_id = 0
+    while True:
+        filas = conn.execute("""
+            SELECT id, CODIGO, DESCRIPCION, MARCA, UBICACION
+            FROM inventario
+            WHERE id > ? AND CODIGO_N IS NULL
+            ORDER BY id
+            LIMIT ?
+        """, (ultimo_id, tamano_lote)).fetchall()
+        if not filas:
+            break
+        conn.executemany("""
+            UPDATE inventario SET CODIGO_N = ?, DESCRIPCION_N = ?, MARCA_N = ?, UBICACION_N = ?
+            WHERE id = ?
+        """, [
+            (*campos_busqueda(f['CODIGO'], f['DESCRIPCION'], f['MARCA'], f['UBICACION']), f['id'])
+            for f in filas
+        ])
+        rellenados += len(filas)
+        ultimo_id = filas[-1]['id']
+    return rellenados
+
+def filtro_busqueda(busqueda):
+    """Helper que traduce el texto buscado a una condición sin funciones Python por fila.
+    
+    Retorna (condicion, params, usa_match). Con 3 o más caracteres se usa MATCH sobre
+    inventario_fts (subcadena, ordenable por relevancia); con menos, LIKE sobre las
+    columnas normalizadas de inventario (alias i).
+    """
+    termino = normalizar_busqueda(busqueda).strip()
+    if len(termino) >= 3:
+        frase = '"' + termino.replace('"', '""') + '"'
+        return "inventario_fts MATCH ?", [frase], True
+    patron = f"%{termino}%"
+    condicion = (
+        "(i.CODIGO_N LIKE ? OR i.DESCRIPCION_N LIKE ? "
+        "OR i.MARCA_N LIKE ? OR i.UBICACION_N LIKE ?)"
+    )
+    return condicion, [patron, patron, patron, patron], False
+
+def consulta_busqueda(busqueda, columnas="i.*"):
+    """Helper que arma el SELECT de productos filtrado por la búsqueda.
+    
+    Retorna (query, params, orden); el WHERE queda abierto para agregar más filtros.
+    """
+    if not busqueda:
+        return f"SELECT {columnas} FROM inventario i WHERE 1=1", [], ""
+    condicion, params, usa_match = filtro_busqueda(busqueda)
+    if usa_match:
+        query = (
+            f"SELECT {columnas} FROM inventario_fts "
+            "JOIN inventario i ON i.id = inventario_fts.rowid "
+            f"WHERE {condicion}"
+        )
+        return query, params, " ORDER BY inventario_fts.rank"
+    return f"SELECT {columnas} FROM inventario i WHERE {condicion}", params, ""
+
+# Filtro de bajo stock: búsqueda por clave en la lista que mantienen los triggers
+FILTRO_BAJO_STOCK = " AND i.id IN (SELECT inventario_id FROM bajo_stock)"
+
+# Columnas por las que se puede ordenar la tabla principal (todas indexadas). Los NULL se
+# ordenan como '' o 0: una comparación (NULL, id) > (?, ?) no es verdadera ni falsa y el
+# cursor que cae en una fila así dejaría fuera todas las páginas siguientes.
+COLUMNAS_ORDEN = {
+    'id': 'i.id',
+    'MARCA': "COALESCE(i.MARCA_N, '')",
+    'CODIGO': "COALESCE(i.CODIGO_N, '')",
+    'DESCRIPCION': "COALESCE(i.DESCRIPCION_N, '')",
+    'CANTIDAD': 'COALESCE(i.CANTIDAD, 0)',
+    'UBICACION': "COALESCE(i.UBICACION_N, '')",
+}
+
+def codificar_cursor(valor, item_id):
+    """Helper para generar el cursor de paginación (valor de orden + id)"""
+    datos = json.dumps([valor, item_id]).encode()
+    return base64.urlsafe_b64encode(datos).decode()
+
+def decodificar_cursor(cursor):
+    """Helper para leer un cursor de paginación; retorna None si no es válido"""
+    if not cursor:
+        return None
+    try:
+        valor, item_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return [valor, int(item_id)]
+    except (ValueError, TypeError):
+        return None
+
+def parsear_fecha(texto):
+    """Helper que lee una fecha AAAA-MM-DD de un filtro; retorna None si falta o no es válida"""
+    try:
+        return datetime.strptime((texto or "").strip(), "%Y-%m-%d")
+    except ValueError:
+        return None
+
+def parsear_rangos(texto):
+    """Helper que convierte '1-5,8,10-12' en [(1, 5), (8, 8), (10, 12)]"""
+    rangos = []
+    for parte in (texto or "").split(','):
+        inicio, separador, fin = parte.strip().partition('-')
+        inicio = to_int(inicio, None)
+        fin = to_int(fin, None) if separador else inicio
+        if inicio is None or fin is None:
+            continue
+        rangos.append((min(inicio, fin), max(inicio, fin)))
+    return rangos
+
+def rango_prefijo(prefijo):
+    """Límites [desde, hasta) que cubren todos los textos que empiezan con prefijo.
+    
+    A diferencia de LIKE 'prefijo%', la comparación por rango siempre usa el índice.
+    """
+    return prefijo, prefijo[:-1] + chr(ord(prefijo[-1]) + 1)
+
+def buscar_para_asignar(conn, busqueda, limite=20):
+    """Helper de autocompletado: productos con stock, primero los que empiezan con el código.
+    
+    Con 3 o más caracteres completa con el índice FTS (sin acentos, sobre código,
+    descripción, marca y ubicación) en orden del índice, sin ordenar por relevancia
+    para que LIMIT corte la búsqueda apenas junta los resultados.
+    """
+    columnas = "i.id, i.CODIGO, i.DESCRIPCION, i.MARCA, i.UBICACION, i.CANTIDAD"
+    termino = normalizar_busqueda(busqueda).strip()
     
-    if producto and producto['CANTIDAD'] <= producto['MINIMO']:
-        enviar_alerta_stock(producto)
-        return True  # Retorna True si está en stock bajo
-    return False
+    if termino:
+        desde, hasta = rango_prefijo(termino)
+        productos = conn.execute(f"""
+            SELECT {columnas} FROM inventario i
+            WHERE i.CODIGO_N >= ? AND i.CODIGO_N < ? AND i.CANTIDAD > 0
+            ORDER BY i.CODIGO_N, i.id LIMIT ?
+        """, (desde, hasta, limite)).fetchall()
+    else:
+        productos = conn.execute(f"""
+            SELECT {columnas} FROM inventario i
+            WHERE i.CANTIDAD > 0
+            ORDER BY i.CODIGO_N, i.id LIMIT ?
+        """, (limite,)).fetchall()
+    
+    if len(termino) >= 3 and len(productos) < limite:
+        condicion, params, _ = filtro_busqueda(termino)
+        vistos = [p['id'] for p in productos]
+        excluir = f"AND i.id NOT IN ({', '.join('?' * len(vistos))})" if vistos else ""
+        productos += conn.execute(f"""
+            SELECT {columnas} FROM inventario_fts
+            JOIN inventario i ON i.id = inventario_fts.rowid
+            WHERE {condicion} AND i.CANTIDAD > 0 {excluir}
+            LIMIT ?
+        """, params + vistos + [limite - len(productos)]).fetchall()
+    
+    return productos
 
 def get_item_or_404(conn, item_id, redirect_to='index'):
     """Helper para obtener un item o redirigir si no existe"""
     item = conn.execute("SELECT * FROM inventario WHERE id = ?", (item_id,)).fetchone()
     if not item:
-        conn.close()
         flash("Producto no encontrado.", "warning")
         return None, redirect(url_for(redirect_to))
     return item, None
@@ -239,7 +2761,6 @@ def get_proyecto_or_404(conn, proyecto_id):
     """Helper para obtener un proyecto o redirigir si no existe"""
     proyecto = conn.execute("SELECT * FROM ubicaciones WHERE id = ?", (proyecto_id,)).fetchone()
     if not proyecto:
-        conn.close()
         flash("Proyecto no encontrado", "danger")
         return None, redirect(url_for("crear_proyecto"))
     return proyecto, None
@@ -272,9 +2793,112 @@ def verificar_credenciales(username, password):
         SELECT * FROM usuarios 
         WHERE username = ? AND password = ? AND activo = 1
     """, (username, password)).fetchone()
-    conn.close()
     return usuario
 
+def hash_token(token):
+    """Hash con el que se guarda y se busca un token de la API"""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def crear_token_api(conn, usuario_id, nombre=""):
+    """Crea un token de la API para el usuario y lo retorna; solo se muestra esta vez"""
+    token = secrets.token_urlsafe(32)
+    conn.execute("""
+        INSERT INTO api_tokens (token_hash, usuario_id, nombre, creado)
+        VALUES (?, ?, ?, ?)
+    """, (hash_token(token), usuario_id, nombre, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    return token
+
+def token_requerido(f):
+    """Decorador para rutas de la API: exige Authorization: Bearer <token>.
+    
+    El usuario del token queda en g.api_usuario. La fecha de último uso se
+    escribe como mucho una vez por minuto, no en cada petición.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        esquema, _, token = request.headers.get('Authorization', '').partition(' ')
+        if esquema.lower() != 'bearer' or not token.strip():
+            return error_api('Se requiere un token: Authorization: Bearer <token>', 401)
+        
+        conn = get_db_connection()
+        usuario = conn.execute("""
+            SELECT t.id AS token_id, t.ultimo_uso, u.id, u.username, u.rol
+            FROM api_tokens t JOIN usuarios u ON u.id = t.usuario_id
+            WHERE t.token_hash = ? AND t.activo = 1 AND u.activo = 1
+        """, (hash_token(token.strip()),)).fetchone()
+        if not usuario:
+            return error_api('Token inválido o revocado', 401)
+        
+        ahora = datetime.now()
+        if not usuario['ultimo_uso'] or usuario['ultimo_uso'] < (ahora - timedelta(minutes=1)).strftime("%Y-%m-%d %H:%M:%S"):
+            conn.execute("UPDATE api_tokens SET ultimo_uso = ? WHERE id = ?",
+                         (ahora.strftime("%Y-%m-%d %H:%M:%S"), usuario['token_id']))
+            conn.commit()
+        
+        g.api_usuario = usuario
+        return f(*args, **kwargs)
+    return decorated_function
+
+def error_api(mensaje, estado, **extra):
+    """Respuesta de error de la API ({"error": ...} con el código HTTP indicado)"""
+    respuesta = jsonify({'error': mensaje, **extra})
+    respuesta.status_code = estado
+    if estado == 401:
+        respuesta.headers['WWW-Authenticate'] = 'Bearer'
+    return respuesta
+
+
+# ============================================
+# 🏷️ CACHÉ HTTP (ETAG Y 304)
+# ============================================
+
+# Cambia en cada arranque: una página guardada con las plantillas anteriores no se revalida
+INICIO_SERVIDOR = uuid.uuid4().hex[:8]
+
+def sello_datos(conn, claves):
+    """Versión combinada y fecha del último cambio (UTC) de las tablas indicadas, con una sola consulta"""
+    filas = conn.execute(
+        f"SELECT clave, version, actualizado FROM versiones WHERE clave IN ({', '.join('?' * len(claves))}) ORDER BY clave",
+        list(claves)
+    ).fetchall()
+    version = ",".join(f"{fila['clave']}:{fila['version']}" for fila in filas)
+    fechas = [fila['actualizado'] for fila in filas if fila['actualizado']]
+    actualizado = datetime.strptime(max(fechas), "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc) if fechas else None
+    return version, actualizado
+
+def condicional(*claves):
+    """Decorador para páginas de solo lectura: ETag y Last-Modified a partir del sello de los datos.
+    
+    Si el navegador ya tiene la versión vigente responde 304 sin ejecutar la vista
+    (ni sus consultas ni la plantilla). La ETag incluye la URL completa y el usuario.
+    """
+    def decorador(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            # Un mensaje flash pendiente se muestra en la página: esa respuesta no se guarda
+            if session.get('_flashes'):
+                return f(*args, **kwargs)
+            
+            version, actualizado = sello_datos(get_db_connection(), claves)
+            etag = hashlib.sha1(
+                f"{INICIO_SERVIDOR}|{session.get('user_id')}|{request.full_path}|{version}".encode()
+            ).hexdigest()
+            if is_resource_modified(request.environ, etag=etag, last_modified=actualizado):
+                respuesta = make_response(f(*args, **kwargs))
+                if respuesta.status_code != 200:
+                    return respuesta
+            else:
+                respuesta = Response(status=304)
+            
+            respuesta.set_etag(etag)
+            respuesta.last_modified = actualizado
+            # El navegador la guarda pero pregunta siempre (el 304 es lo barato)
+            respuesta.cache_control.private = True
+            respuesta.cache_control.no_cache = True
+            return respuesta
+        return decorated_function
+    return decorador
+
 
 # ============================================
 # 🔐 RUTAS DE AUTENTICACIÓN
@@ -343,25 +2967,21 @@ def cambiar_password():
         """, (session['user_id'], password_actual)).fetchone()
         
         if not usuario:
-            conn.close()
             flash("La contraseña actual es incorrecta", "danger")
             return redirect(url_for("cambiar_password"))
         
         # Verificar que las contraseñas nuevas coincidan
         if password_nueva != password_confirmar:
-            conn.close()
             flash("Las contraseñas nuevas no coinciden", "danger")
             return redirect(url_for("cambiar_password"))
         
         # Verificar longitud mínima
         if len(password_nueva) < 6:
-            conn.close()
             flash("La contraseña debe tener al menos 6 caracteres", "warning")
             return redirect(url_for("cambiar_password"))
         
         # Verificar que no sea igual a la actual
         if password_nueva == password_actual:
-            conn.close()
             flash("La contraseña nueva debe ser diferente a la actual", "warning")
             return redirect(url_for("cambiar_password"))
         
@@ -372,7 +2992,6 @@ def cambiar_password():
             WHERE id = ?
         """, (password_nueva, session['user_id']))
         conn.commit()
-        conn.close()
         
         # Actualizar sesión
         session['debe_cambiar_password'] = 0
@@ -389,61 +3008,199 @@ def cambiar_password():
 
 @app.route("/", methods=["GET"])
 @login_required
+@condicional('inventario', 'ubicaciones')
 def index():
     busqueda = request.args.get("busqueda", "").strip()
     solo_bajo_stock = request.args.get("solo_bajo_stock", "")
+    orden = request.args.get("orden", "")
+    direccion = "desc" if request.args.get("dir") == "desc" else "asc"
+    por_pagina = min(max(to_int(request.args.get("por_pagina"), app.config["ITEMS_POR_PAGINA"]), 1), 500)
     conn = get_db_connection()
     
-    # Obtener totales generales (sin filtros) - SIEMPRE FIJOS
-    total_productos = conn.execute("SELECT COUNT(*) as total FROM inventario").fetchone()["total"]
-    total_bajo_stock = conn.execute(
-        "SELECT COUNT(*) as total FROM inventario WHERE CANTIDAD <= MINIMO"
-    ).fetchone()["total"]
+    # Obtener totales generales (sin filtros) - SIEMPRE FIJOS, mantenidos por triggers
+    resumen = leer_resumen(conn)
+    total_productos = resumen["total_productos"]
+    total_bajo_stock = resumen["bajo_stock"]
     
     # Aplicar filtros para la tabla
-    query = "SELECT * FROM inventario WHERE 1=1"
-    params = []
+    if orden not in COLUMNAS_ORDEN:
+        orden = ""
+    expresion = COLUMNAS_ORDEN.get(orden, "i.id")
+    query, params, orden_relevancia = consulta_busqueda(busqueda, f"i.*, {expresion} AS valor_orden")
+    
+    if solo_bajo_stock:
+        query += FILTRO_BAJO_STOCK
     
+    # Total filtrado: sin filtros coincide con los totales ya calculados
     if busqueda:
-        busqueda_clean = quitar_acentos(busqueda)
-        query += (
-            " AND (quitar_acentos(CODIGO) LIKE ? COLLATE NOCASE "
-            "OR quitar_acentos(DESCRIPCION) LIKE ? COLLATE NOCASE "
-            "OR quitar_acentos(MARCA) LIKE ? COLLATE NOCASE "
-            "OR quitar_acentos(UBICACION) LIKE ? COLLATE NOCASE)"
-        )
-        params.extend([f"%{busqueda_clean}%", f"%{busqueda_clean}%", f"%{busqueda_clean}%", f"%{busqueda_clean}%"])
+        query_total, params_total, _ = consulta_busqueda(busqueda, "COUNT(*)")
+        if solo_bajo_stock:
+            query_total += FILTRO_BAJO_STOCK
+        total_filtrado = conn.execute(query_total, params_total).fetchone()[0]
+    elif solo_bajo_stock:
+        total_filtrado = total_bajo_stock
+    else:
+        total_filtrado = total_productos
     
-    if solo_bajo_stock:
-        query += " AND CANTIDAD <= MINIMO"
+    paginacion = {'pagina': None, 'anterior': None, 'siguiente': None}
+    
+    if orden_relevancia and not orden:
+        # Orden por relevancia: el rank no es estable como cursor, se pagina por número
+        pagina = max(to_int(request.args.get("pagina"), 1), 1)
+        items = conn.execute(
+            query + orden_relevancia + " LIMIT ? OFFSET ?",
+            params + [por_pagina + 1, (pagina - 1) * por_pagina]
+        ).fetchall()
+        hay_mas = len(items) > por_pagina
+        items = items[:por_pagina]
+        paginacion['pagina'] = pagina
+        paginacion['anterior'] = {'pagina': pagina - 1} if pagina > 1 else None
+        paginacion['siguiente'] = {'pagina': pagina + 1} if hay_mas else None
+    else:
+        # Paginación por cursor sobre (columna de orden, id)
+        retroceder = bool(request.args.get("antes"))
+        cursor = decodificar_cursor(request.args.get("antes") if retroceder else request.args.get("despues"))
+        ascendente = (direccion == "asc") != retroceder
+        if cursor:
+            # La primera condición permite buscar en el índice de la expresión; la de fila desempata por id
+            query += (f" AND {expresion} {'>=' if ascendente else '<='} ?"
+                      f" AND ({expresion}, i.id) {'>' if ascendente else '<'} (?, ?)")
+            params = params + cursor[:1] + cursor
+        sentido = "ASC" if ascendente else "DESC"
+        query += f" ORDER BY {expresion} {sentido}, i.id {sentido} LIMIT ?"
+        items = conn.execute(query, params + [por_pagina + 1]).fetchall()
+        hay_mas = len(items) > por_pagina
+        items = items[:por_pagina]
+        if retroceder:
+            items.reverse()
+        
+        if items:
+            primero, ultimo = items[0], items[-1]
+            if (retroceder and hay_mas) or (not retroceder and cursor):
+                paginacion['anterior'] = {'antes': codificar_cursor(primero['valor_orden'], primero['id'])}
+            if retroceder or hay_mas:
+                paginacion['siguiente'] = {'despues': codificar_cursor(ultimo['valor_orden'], ultimo['id'])}
     
-    items = conn.execute(query, params).fetchall()
-    conn.close()
     
     ubicaciones_fijas, proyectos = obtener_ubicaciones()
     
+    filtros = {
+        'busqueda': busqueda or None,
+        'solo_bajo_stock': solo_bajo_stock or None,
+        'orden': orden or None,
+        'dir': direccion if orden else None,
+        'por_pagina': por_pagina if por_pagina != app.config["ITEMS_POR_PAGINA"] else None,
+    }
+    
+    def url_pagina(**cambios):
+        return url_for('index', **{k: v for k, v in {**filtros, **cambios}.items() if v is not None})
+    
+    def url_orden(columna):
+        nueva_direccion = 'desc' if orden == columna and direccion == 'asc' else 'asc'
+        return url_pagina(orden=columna, dir=nueva_direccion)
+    
     return render_template("index.html",
         items=items,
         busqueda=busqueda,
         total_productos=total_productos,
         total_bajo_stock=total_bajo_stock,
+        resumen=resumen,
+        total_filtrado=total_filtrado,
+        orden=orden,
+        direccion=direccion,
+        por_pagina=por_pagina,
+        paginacion=paginacion,
+        url_pagina=url_pagina,
+        url_orden=url_orden,
         ubicaciones_fijas=ubicaciones_fijas,
         proyectos=proyectos
     )
 
+@app.route("/reporte_reposicion")
+@login_required
+def reporte_reposicion():
+    """Productos en bajo stock ordenados por faltante, leídos desde la lista bajo_stock"""
+    conn = get_db_connection()
+    consulta = """
+        SELECT
+            i.id,
+            i.CODIGO,
+            i.DESCRIPCION,
+            i.MARCA,
+            i.UBICACION,
+            i.CANTIDAD,
+            i.MINIMO,
+            i.MINIMO - i.CANTIDAD AS FALTANTE,
+            (i.MINIMO - i.CANTIDAD) * COALESCE(i.PRECIO_COSTO, 0) AS COSTO_REPOSICION,
+            b.desde AS EN_BAJO_STOCK_DESDE
+        FROM bajo_stock b
+        JOIN inventario i ON i.id = b.inventario_id
+        ORDER BY FALTANTE DESC, b.desde
+    """
+    if request.args.get("formato") == "csv":
+        return respuesta_csv(conn.execute(consulta), 'reporte_reposicion.csv')
+    
+    items = conn.execute(consulta).fetchall()
+    costo_total = sum(item['COSTO_REPOSICION'] for item in items)
+    return render_template("reporte_reposicion.html", items=items, costo_total=costo_total)
+
+PERIODOS_REPORTES = [7, 30, 90, 365]
+MESES_REPORTES = [1, 3, 6, 12]
+
+@app.route("/reportes")
+@login_required
+def reportes():
+    """Tablero de movimientos: lee solo los acumulados, su costo no crece con el historial"""
+    dias = to_int(request.args.get("dias"), 30)
+    if dias not in PERIODOS_REPORTES:
+        dias = 30
+    meses = to_int(request.args.get("meses"), 12)
+    if meses not in MESES_REPORTES:
+        meses = 12
+    
+    conn = get_db_connection()
+    return render_template("reportes.html",
+        dias=dias,
+        meses=meses,
+        periodos=PERIODOS_REPORTES,
+        opciones_meses=MESES_REPORTES,
+        top=top_movidos(conn, dias),
+        proyectos=consumo_por_proyecto(conn, meses),
+        velocidad=velocidad_stock(conn, dias),
+        recientes=movimientos_recientes(conn)
+    )
+
 @app.route("/exportar_seleccionados", methods=["POST"])
 @login_required
 def exportar_seleccionados():
-    seleccionados = request.form.getlist('seleccionados')
-    if not seleccionados:
+    # La selección llega como rangos de ids ("1-50,73,80-95") o como "todos los resultados"
+    todos = request.form.get("todos") == "1"
+    rangos = parsear_rangos(request.form.get("rangos", ""))
+    rangos += [(i, i) for i in (to_int(x, None) for x in request.form.getlist('seleccionados')) if i is not None]
+    
+    if not todos and not rangos:
         flash("No seleccionaste ningún producto.", "warning")
         return redirect(url_for("index"))
-    placeholders = ','.join(['?'] * len(seleccionados))
+    
     conn = get_db_connection()
-    query = f"SELECT CODIGO, DESCRIPCION, CANTIDAD FROM inventario WHERE id IN ({placeholders})"
-    items = conn.execute(query, seleccionados).fetchall()
-    conn.close()
-    df = pd.DataFrame([dict(item) for item in items])
+    if todos:
+        query, params, orden = consulta_busqueda(
+            request.form.get("busqueda", "").strip(), "i.CODIGO, i.DESCRIPCION, i.CANTIDAD"
+        )
+        if request.form.get("solo_bajo_stock"):
+            query += FILTRO_BAJO_STOCK
+        items = conn.execute(query + orden, params).fetchall()
+    else:
+        items = []
+        for inicio in range(0, len(rangos), 400):
+            bloque = rangos[inicio:inicio + 400]
+            condicion = " OR ".join(["id BETWEEN ? AND ?"] * len(bloque))
+            params = [valor for rango in bloque for valor in rango]
+            items += conn.execute(
+                f"SELECT CODIGO, DESCRIPCION, CANTIDAD FROM inventario WHERE {condicion} ORDER BY id",
+                params
+            ).fetchall()
+    df = pd.DataFrame([dict(item) for item in items], columns=['CODIGO', 'DESCRIPCION', 'CANTIDAD'])
     
     output = io.BytesIO()
     with pd.ExcelWriter(output, engine='openpyxl') as writer:
@@ -484,28 +3241,24 @@ def agregar():
         if "imagen" in request.files:
             file = request.files["imagen"]
             if file and file.filename != "":
-                os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
-                ext = os.path.splitext(file.filename)[1]
-                unique_name = f"{uuid.uuid4().hex}{ext}"
-                filepath = os.path.join(app.config["UPLOAD_FOLDER"], unique_name)
-                file.save(filepath)
-                imagen = unique_name
+                imagen = guardar_imagen(file)
 
         conn = get_db_connection()
         conn.execute("""INSERT INTO inventario 
             (MARCA, CODIGO, DESCRIPCION, CANTIDAD, MINIMO, UBICACION, SERIAL,
-            PRECIO_COSTO, PRECIO_DIST, PRECIO_INT, PRECIO_GENERAL, IMAGEN)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            PRECIO_COSTO, PRECIO_DIST, PRECIO_INT, PRECIO_GENERAL, IMAGEN,
+            CODIGO_N, DESCRIPCION_N, MARCA_N, UBICACION_N)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
             (marca, codigo, descripcion, cantidad, minimo, ubicacion, serial,
-             precio_costo, precio_dist, precio_int, precio_general, imagen)
+             precio_costo, precio_dist, precio_int, precio_general, imagen,
+             *campos_busqueda(codigo, descripcion, marca, ubicacion))
         )
-        conn.commit()
         
         nuevo = conn.execute("SELECT * FROM inventario WHERE id = last_insert_rowid()").fetchone()
         if nuevo and nuevo["CANTIDAD"] <= nuevo["MINIMO"]:
-            enviar_alerta_stock(nuevo)
+            encolar_alerta_stock(conn, nuevo)
+        conn.commit()
         
-        conn.close()
         flash("Producto agregado correctamente.", "success")
         return redirect(url_for("index"))
     
@@ -532,7 +3285,6 @@ def crear_proyecto():
                 flash("Proyecto creado correctamente", "success")
             except sqlite3.IntegrityError:
                 flash("Ese proyecto ya existe", "danger")
-            conn.close()
 
         return redirect(url_for("crear_proyecto"))
 
@@ -542,7 +3294,6 @@ def crear_proyecto():
         WHERE tipo = 'PROYECTO' 
         ORDER BY fecha_inicio DESC, nombre DESC
     """).fetchall()
-    conn.close()
     
     # Pasar fecha actual para el formulario
     from datetime import date
@@ -555,7 +3306,6 @@ def crear_proyecto():
 def editar(id):
     conn = get_db_connection()
     item, error = get_item_or_404(conn, id)
-    conn.close()
     
     if error:
         return error
@@ -578,90 +3328,290 @@ def editar(id):
         if "imagen" in request.files:
             file = request.files["imagen"]
             if file and file.filename != "":
-                os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
-                ext = os.path.splitext(file.filename)[1]
-                unique_name = f"{uuid.uuid4().hex}{ext}"
-                filepath = os.path.join(app.config["UPLOAD_FOLDER"], unique_name)
-                file.save(filepath)
-
-                if item["IMAGEN"]:
-                    old_path = os.path.join(app.config["UPLOAD_FOLDER"], item["IMAGEN"])
-                    if os.path.exists(old_path):
-                        try:
-                            os.remove(old_path)
-                        except Exception:
-                            pass
-
-                imagen = unique_name
+                imagen = guardar_imagen(file)
 
         conn = get_db_connection()
-        conn.execute("""
+        actualizado = conn.execute("""
             UPDATE inventario SET 
                 MARCA=?, CODIGO=?, DESCRIPCION=?, CANTIDAD=?, MINIMO=?, UBICACION=?, SERIAL=?,
-                PRECIO_COSTO=?, PRECIO_DIST=?, PRECIO_INT=?, PRECIO_GENERAL=?, IMAGEN=?
+                PRECIO_COSTO=?, PRECIO_DIST=?, PRECIO_INT=?, PRECIO_GENERAL=?, IMAGEN=?,
+                CODIGO_N=?, DESCRIPCION_N=?, MARCA_N=?, UBICACION_N=?
             WHERE id=?
+            RETURNING *
         """, (
             marca, codigo, descripcion, cantidad, minimo, ubicacion, serial,
-            precio_costo, precio_dist, precio_int, precio_general, imagen, id
-        ))
+            precio_costo, precio_dist, precio_int, precio_general, imagen,
+            *campos_busqueda(codigo, descripcion, marca, ubicacion), id
+        )).fetchone()
+        if actualizado:
+            alertar_si_entra_en_bajo_stock(conn, item, actualizado)
+        # La imagen anterior se borra solo si ya no la usa ningún otro producto
+        liberada = liberar_imagen(conn, item["IMAGEN"]) if item["IMAGEN"] != imagen else None
         conn.commit()
-        conn.close()
+        borrar_imagenes_liberadas(conn, [liberada])
         flash("Producto actualizado correctamente.", "success")
         return redirect(url_for("index"))
 
     return render_with_ubicaciones("editar.html", item=item)
 
-@app.route("/eliminar/<int:id>")
+def respaldar_asignaciones_cerradas(conn, ids):
+    """Copia a proyecto_items_huerfanos las asignaciones de proyectos cerrados de los productos
+    de ids que no están en ningún proyecto abierto, y las quita.
+    
+    Un proyecto cerrado ya devolvió su stock: esas filas son historial y no deben
+    impedir eliminar el producto. No hace commit. Retorna cuántas se movieron.
+    """
+    cerradas = """
+        FROM proyecto_items
+        WHERE inventario_id IN (SELECT value FROM json_each(?))
+          AND proyecto_id IN (SELECT id FROM ubicaciones WHERE estado = 'CERRADO')
+          AND inventario_id NOT IN (
+              SELECT pi.inventario_id FROM proyecto_items pi
+              JOIN ubicaciones u ON u.id = pi.proyecto_id
+              WHERE u.estado IS NOT 'CERRADO'
+          )
+    """
+    conn.execute(f"""
+        INSERT OR REPLACE INTO proyecto_items_huerfanos
+            (id, proyecto_id, inventario_id, cantidad_asignada, fecha_asignacion, observacion, respaldado)
+        SELECT id, proyecto_id, inventario_id, cantidad_asignada, fecha_asignacion, observacion, datetime('now', 'localtime')
+        {cerradas}
+    """, (json.dumps(ids),))
+    return conn.execute(f"DELETE {cerradas}", (json.dumps(ids),)).rowcount
+
+@app.route("/eliminar/<int:id>")
+@login_required
+def eliminar(id):
+    conn = get_db_connection()
+    
+    # El stock asignado a una obra no puede desaparecer sin un movimiento (la clave es RESTRICT);
+    # los proyectos cerrados ya devolvieron su stock y no cuentan
+    proyectos = [fila['nombre'] for fila in conn.execute("""
+        SELECT DISTINCT u.nombre FROM proyecto_items pi
+        JOIN ubicaciones u ON u.id = pi.proyecto_id
+        WHERE pi.inventario_id = ? AND u.estado IS NOT 'CERRADO'
+        ORDER BY u.nombre
+    """, (id,))]
+    if proyectos:
+        flash(f"No se puede eliminar: el producto está asignado a proyectos ({', '.join(proyectos)}). "
+              "Devuélvelo al stock primero.", "warning")
+        return redirect(url_for("index"))
+    
+    try:
+        respaldar_asignaciones_cerradas(conn, [id])
+        eliminado = conn.execute("DELETE FROM inventario WHERE id = ? RETURNING IMAGEN", (id,)).fetchone()
+        liberada = liberar_imagen(conn, eliminado["IMAGEN"]) if eliminado else None
+        conn.commit()
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        flash("No se puede eliminar: el producto está asignado a proyectos.", "warning")
+        return redirect(url_for("index"))
+    borrar_imagenes_liberadas(conn, [liberada])
+    flash("Producto eliminado correctamente.", "success")
+    return redirect(url_for("index"))
+
+@app.route("/detalle/<int:id>")
+@login_required
+@condicional('inventario')
+def detalle(id):
+    conn = get_db_connection()
+    item = conn.execute("SELECT * FROM inventario WHERE id = ?", (id,)).fetchone()
+    return render_template("detalle.html", item=item)
+
+@app.route("/imagenes/<tamano>/<nombre>")
+@login_required
+def imagen_producto(tamano, nombre):
+    """Imagen de un producto en el tamaño pedido, con caché larga y ETag"""
+    if tamano != 'original' and tamano not in app.config["IMAGEN_TAMANOS"]:
+        abort(404)
+    
+    # Imágenes anteriores al backfill: la versión se genera la primera vez que se pide
+    servido = tamano
+    if tamano != 'original' and not os.path.exists(ruta_imagen(nombre, tamano)):
+        if os.path.isfile(ruta_imagen(nombre)):
+            generar_versiones(nombre)
+        if not os.path.exists(ruta_imagen(nombre, tamano)):
+            servido = 'original'
+    
+    ruta = ruta_imagen(nombre, servido)
+    if servido != tamano:
+        # El original va en lugar de la versión que falta: el navegador pregunta cada vez
+        # (ETag del archivo) para tomar la versión reducida cuando exista
+        respuesta = send_from_directory(os.path.dirname(ruta), os.path.basename(ruta))
+        respuesta.cache_control.private = True
+        respuesta.cache_control.no_cache = True
+        return respuesta
+    
+    respuesta = send_from_directory(
+        os.path.dirname(ruta), os.path.basename(ruta),
+        max_age=app.config["IMAGEN_CACHE_DIAS"] * 24 * 3600
+    )
+    # Solo usuarios con sesión: que la guarde el navegador, no un proxy compartido
+    respuesta.cache_control.public = False
+    respuesta.cache_control.private = True
+    respuesta.cache_control.immutable = True
+    return respuesta
+
+MOVIMIENTOS_CONTEO_MAXIMO = 10000
+
+@app.route("/entrada/<int:id>", methods=["GET", "POST"])
+@login_required
+def entrada(id):
+    conn = get_db_connection()
+    item, error = get_item_or_404(conn, id)
+    if error:
+        return error
+    
+    if request.method == "POST":
+        cantidad = to_int(request.form.get("cantidad"), 0)
+        proyecto = request.form.get("proyecto", "").strip().upper()
+        observacion = request.form.get("observacion", "").strip().upper()
+        
+        if cantidad <= 0:
+            flash("La cantidad debe ser mayor a cero", "warning")
+            return redirect(url_for("entrada", id=id))
+        
+        def ingresar(conn):
+            restante = reponer_stock(conn, id, cantidad)
+            if restante is not None:
+                registrar_movimiento(conn, id, 'entrada', cantidad, observacion, proyecto)
+            return restante
+        
+        restante = en_transaccion_inmediata(conn, ingresar)
+        if restante is None:
+            flash("Producto no encontrado.", "warning")
+            return redirect(url_for("index"))
+        
+        flash(f"✅ Entrada registrada: {cantidad} unidades. Stock actual: {restante}", "success")
+        return redirect(url_for("movimientos", id=id))
+    
+    return render_template("entrada.html", item=item)
+
+@app.route("/salida/<int:id>", methods=["GET", "POST"])
 @login_required
-def eliminar(id):
+def salida(id):
     conn = get_db_connection()
-    conn.execute("DELETE FROM inventario WHERE id = ?", (id,))
-    conn.commit()
-    conn.close()
-    flash("Producto eliminado correctamente.", "success")
-    return redirect(url_for("index"))
+    item, error = get_item_or_404(conn, id)
+    if error:
+        return error
+    
+    if request.method == "POST":
+        cantidad = to_int(request.form.get("cantidad"), 0)
+        proyecto = request.form.get("proyecto", "").strip().upper()
+        observacion = request.form.get("observacion", "").strip().upper()
+        
+        if cantidad <= 0:
+            flash("La cantidad debe ser mayor a cero", "warning")
+            return redirect(url_for("salida", id=id))
+        
+        def retirar(conn):
+            restante, stock_bajo = descontar_stock_y_verificar(conn, id, cantidad)
+            if restante is not None:
+                registrar_movimiento(conn, id, 'salida', cantidad, observacion, proyecto)
+            return restante, stock_bajo
+        
+        restante, stock_bajo = en_transaccion_inmediata(conn, retirar)
+        if restante is None:
+            disponible = conn.execute("SELECT CANTIDAD FROM inventario WHERE id = ?", (id,)).fetchone()
+            flash(f"Stock insuficiente. Disponible: {disponible['CANTIDAD'] if disponible else 0}", "danger")
+            return redirect(url_for("salida", id=id))
+        
+        if stock_bajo:
+            flash(f"⚠️ {item['DESCRIPCION']} está en stock bajo", "warning")
+        flash(f"✅ Salida registrada: {cantidad} unidades. Stock actual: {restante}", "success")
+        return redirect(url_for("movimientos", id=id))
+    
+    return render_template("salida.html", item=item)
 
-@app.route("/detalle/<int:id>")
+@app.route("/movimientos/<int:id>")
 @login_required
-def detalle(id):
+def movimientos(id):
     conn = get_db_connection()
-    item = conn.execute("SELECT * FROM inventario WHERE id = ?", (id,)).fetchone()
-    conn.close()
-    return render_template("detalle.html", item=item)
+    item, error = get_item_or_404(conn, id)
+    if error:
+        return error
+    
+    proyecto = request.args.get("proyecto", "").strip().upper()
+    desde = parsear_fecha(request.args.get("desde"))
+    hasta = parsear_fecha(request.args.get("hasta"))
+    por_pagina = app.config["ITEMS_POR_PAGINA"]
+    
+    # Todos los filtros son prefijos o rangos de idx_movimientos_inventario(_proyecto)
+    condiciones = ["inventario_id = ?"]
+    params = [id]
+    if proyecto:
+        condiciones.append("proyecto = ?")
+        params.append(proyecto)
+    if desde:
+        condiciones.append("fecha >= ?")
+        params.append(desde.strftime("%Y-%m-%d"))
+    if hasta:
+        condiciones.append("fecha < ?")
+        params.append((hasta + timedelta(days=1)).strftime("%Y-%m-%d"))
+    where = " AND ".join(condiciones)
+    
+    # Conteo acotado: con cientos de miles de movimientos el número exacto no aporta y cuesta un recorrido
+    total = conn.execute(
+        f"SELECT COUNT(*) FROM (SELECT 1 FROM movimientos WHERE {where} LIMIT ?)",
+        params + [MOVIMIENTOS_CONTEO_MAXIMO + 1]
+    ).fetchone()[0]
+    
+    # Paginación por cursor sobre (fecha, id), del más reciente al más antiguo
+    paginacion = {'anterior': None, 'siguiente': None}
+    retroceder = bool(request.args.get("antes"))
+    cursor = decodificar_cursor(request.args.get("antes") if retroceder else request.args.get("despues"))
+    if cursor:
+        where += f" AND (fecha, id) {'>' if retroceder else '<'} (?, ?)"
+        params = params + cursor
+    sentido = "ASC" if retroceder else "DESC"
+    filas = conn.execute(f"""
+        SELECT id, tipo, cantidad, fecha, observacion, proyecto FROM movimientos
+        WHERE {where}
+        ORDER BY fecha {sentido}, id {sentido} LIMIT ?
+    """, params + [por_pagina + 1]).fetchall()
+    hay_mas = len(filas) > por_pagina
+    filas = filas[:por_pagina]
+    if retroceder:
+        filas.reverse()
+    
+    if filas:
+        primero, ultimo = filas[0], filas[-1]
+        if (retroceder and hay_mas) or (not retroceder and cursor):
+            paginacion['anterior'] = {'antes': codificar_cursor(primero['fecha'], primero['id'])}
+        if retroceder or hay_mas:
+            paginacion['siguiente'] = {'despues': codificar_cursor(ultimo['fecha'], ultimo['id'])}
+    
+    filtros = {
+        'proyecto': proyecto or None,
+        'desde': desde.strftime("%Y-%m-%d") if desde else None,
+        'hasta': hasta.strftime("%Y-%m-%d") if hasta else None,
+    }
+    
+    def url_pagina(**cambios):
+        return url_for('movimientos', id=id, **{k: v for k, v in {**filtros, **cambios}.items() if v is not None})
+    
+    _, proyectos = obtener_ubicaciones()
+    
+    return render_template("movimientos.html",
+        item=item,
+        movimientos=filas,
+        total=total,
+        conteo_maximo=MOVIMIENTOS_CONTEO_MAXIMO,
+        filtros=filtros,
+        proyectos=proyectos,
+        paginacion=paginacion,
+        url_pagina=url_pagina
+    )
 
 @app.route("/exportar")
 @login_required
 def exportar():
     busqueda = request.args.get("busqueda", "")
-    conn = get_db_connection()
-    query = "SELECT * FROM inventario WHERE 1=1"
-    params = []
-    
-    if busqueda:
-        busqueda_clean = quitar_acentos(busqueda)
-        query += (
-            " AND (quitar_acentos(CODIGO) LIKE ? COLLATE NOCASE "
-            "OR quitar_acentos(DESCRIPCION) LIKE ? COLLATE NOCASE "
-            "OR quitar_acentos(MARCA) LIKE ? COLLATE NOCASE "
-            "OR quitar_acentos(UBICACION) LIKE ? COLLATE NOCASE)"
-        )
-        params.extend([f"%{busqueda_clean}%", f"%{busqueda_clean}%", f"%{busqueda_clean}%", f"%{busqueda_clean}%"])
+    if request.args.get("formato") == "csv":
+        return respuesta_csv(consulta_exportacion(busqueda), 'export_inventario.csv')
     
-    items = conn.execute(query, params).fetchall()
-    conn.close()
-    df = pd.DataFrame([dict(item) for item in items])
-    
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Inventario')
-    output.seek(0)
-    
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name='export_inventario.xlsx'
-    )
+    trabajo_id = encolar_trabajo('exportar', claves_datos=('inventario',), busqueda=busqueda)
+    return redirect(url_for('ver_trabajo', trabajo_id=trabajo_id))
 
 @app.route("/importar", methods=["GET", "POST"])
 @login_required
@@ -676,101 +3626,23 @@ def importar():
             flash("No se seleccionó ningún archivo", "warning")
             return redirect(url_for("importar"))
         
-        if not file.filename.endswith(('.xlsx', '.xls')):
-            flash("Solo se permiten archivos Excel (.xlsx, .xls)", "danger")
+        if not file.filename.lower().endswith(EXTENSIONES_IMPORTACION):
+            flash("Solo se permiten archivos Excel (.xlsx, .xls) o CSV (.csv)", "danger")
             return redirect(url_for("importar"))
         
-        try:
-            df = pd.read_excel(file)
-            total_filas = len(df)
-            
-            columnas_requeridas = ['MARCA', 'CODIGO', 'DESCRIPCION']
-            columnas_faltantes = [col for col in columnas_requeridas if col not in df.columns]
-            
-            if columnas_faltantes:
-                flash(f"Faltan columnas requeridas: {', '.join(columnas_faltantes)}", "danger")
-                return redirect(url_for("importar"))
-            
-            conn = get_db_connection()
-            insertados = 0
-            omitidos = 0
-            errores_detallados = []
-            
-            for index, row in df.iterrows():
-                try:
-                    codigo = str(row.get('CODIGO', '')).strip()
-                    descripcion = str(row.get('DESCRIPCION', '')).strip()
-                    marca = str(row.get('MARCA', '')).strip()
-                    
-                    # Limpiar 'nan'
-                    if codigo == 'nan':
-                        codigo = ''
-                    if descripcion == 'nan':
-                        descripcion = ''
-                    if marca == 'nan':
-                        marca = ''
-                    
-                    datos = {
-                        'marca': marca,
-                        'codigo': codigo,
-                        'descripcion': descripcion,
-                        'cantidad': to_int(row.get('CANTIDAD', 0)),
-                        'minimo': to_int(row.get('MINIMO', 0)),
-                        'ubicacion': str(row.get('UBICACION', 'BODEGA')),
-                        'serial': str(row.get('SERIAL', '')),
-                        'precio_costo': to_float(row.get('PRECIO_COSTO', 0)),
-                        'precio_dist': to_float(row.get('PRECIO_DIST', 0)),
-                        'precio_int': to_float(row.get('PRECIO_INT', 0)),
-                        'precio_general': to_float(row.get('PRECIO_GENERAL', 0)),
-                    }
-                    
-                    if datos['ubicacion'] == 'nan':
-                        datos['ubicacion'] = 'BODEGA'
-                    if datos['serial'] == 'nan':
-                        datos['serial'] = ''
-                    
-                    conn.execute("""
-                        INSERT INTO inventario 
-                        (MARCA, CODIGO, DESCRIPCION, CANTIDAD, MINIMO, UBICACION, SERIAL,
-                         PRECIO_COSTO, PRECIO_DIST, PRECIO_INT, PRECIO_GENERAL)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """, (
-                        datos['marca'], datos['codigo'], datos['descripcion'],
-                        datos['cantidad'], datos['minimo'], datos['ubicacion'],
-                        datos['serial'], datos['precio_costo'], datos['precio_dist'],
-                        datos['precio_int'], datos['precio_general']
-                    ))
-                    insertados += 1
-                
-                except Exception as e:
-                    omitidos += 1
-                    errores_detallados.append({
-                        'fila': index + 2,
-                        'marca': str(row.get('MARCA', '')),
-                        'codigo': str(row.get('CODIGO', '')),
-                        'descripcion': str(row.get('DESCRIPCION', ''))[:50],
-                        'motivo': f'Error: {str(e)}'
-                    })
-            
-            conn.commit()
-            conn.close()
-            
-            flash(f"✅ Importación completa: {insertados} productos insertados de {total_filas} filas", "success")
-            
-            if omitidos > 0:
-                flash(f"⚠️ Se omitieron {omitidos} filas con errores", "warning")
-                
-                for error in errores_detallados[:10]:
-                    flash(f"Fila {error['fila']}: {error['motivo']}", "warning")
-                
-                if len(errores_detallados) > 10:
-                    flash(f"... y {len(errores_detallados) - 10} errores más", "info")
-            
-            return redirect(url_for("index"))
+        # El archivo se guarda en disco y se procesa en segundo plano
+        extension = os.path.splitext(file.filename)[1].lower()
+        ruta = ruta_resultado(f"entrada_{uuid.uuid4().hex}{extension}")
+        file.save(ruta)
         
-        except Exception as e:
-            flash(f"Error al procesar el archivo: {str(e)}", "danger")
-            return redirect(url_for("importar"))
+        trabajo_id = encolar_trabajo(
+            'importacion',
+            ruta=ruta,
+            nombre=file.filename,
+            modo=request.form.get("modo", "insertar"),
+            registrar_cambios_stock=bool(request.form.get("registrar_movimientos"))
+        )
+        return redirect(url_for('ver_trabajo', trabajo_id=trabajo_id))
     
     return render_template("importar.html")
 
@@ -778,34 +3650,82 @@ def importar():
 @login_required
 def descargar_plantilla():
     conn = get_db_connection()
-    items = conn.execute("SELECT * FROM inventario ORDER BY id").fetchall()
-    conn.close()
-    
-    if not items:
+    if not conn.execute("SELECT 1 FROM inventario LIMIT 1").fetchone():
         flash("No hay productos en el inventario para exportar.", "warning")
         return redirect(url_for("importar"))
     
-    df = pd.DataFrame([dict(item) for item in items])
+    if request.args.get("formato") == "csv":
+        return respuesta_csv(consulta_plantilla(), 'inventario_LSI.csv')
     
-    columnas_exportar = [
-        'MARCA', 'CODIGO', 'DESCRIPCION', 'CANTIDAD', 'MINIMO', 
-        'UBICACION', 'SERIAL', 'PRECIO_COSTO', 'PRECIO_DIST', 
-        'PRECIO_INT', 'PRECIO_GENERAL'
-    ]
-    df = df[columnas_exportar]
+    trabajo_id = encolar_trabajo('plantilla', claves_datos=('inventario',))
+    return redirect(url_for('ver_trabajo', trabajo_id=trabajo_id))
+
+
+@app.route("/trabajos/<trabajo_id>")
+@login_required
+def ver_trabajo(trabajo_id):
+    conn = get_db_connection()
+    item = conn.execute("SELECT * FROM trabajos WHERE id = ?", (trabajo_id,)).fetchone()
+    if not item:
+        flash("El trabajo no existe o ya expiró.", "warning")
+        return redirect(url_for('index'))
+    return render_template("trabajo.html", trabajo=item)
+
+@app.route("/trabajos/<trabajo_id>/estado")
+@login_required
+def estado_trabajo(trabajo_id):
+    conn = get_db_connection()
+    item = conn.execute("SELECT * FROM trabajos WHERE id = ?", (trabajo_id,)).fetchone()
+    if not item:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
     
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Inventario')
-    output.seek(0)
+    resultado = json.loads(item['resultado']) if item['resultado'] else None
+    return jsonify({
+        'id': item['id'],
+        'tipo': item['tipo'],
+        'estado': item['estado'],
+        'procesados': item['procesados'],
+        'mensaje': item['mensaje'],
+        'resultado': resultado,
+        'descarga': url_for('descargar_trabajo', trabajo_id=trabajo_id) if item['archivo'] else None,
+        'creado': item['creado'],
+        'actualizado': item['actualizado'],
+    })
+
+@app.route("/trabajos/<trabajo_id>/descargar")
+@login_required
+def descargar_trabajo(trabajo_id):
+    conn = get_db_connection()
+    item = conn.execute("SELECT * FROM trabajos WHERE id = ?", (trabajo_id,)).fetchone()
+    if not item or not item['archivo'] or not renovar_resultado(conn, trabajo_id, item['archivo']):
+        flash("El archivo ya no está disponible, vuelve a generar la exportación.", "warning")
+        return redirect(url_for('index'))
     
     return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        ruta_resultado(item['archivo']),
+        mimetype=MIMETYPE_XLSX,
         as_attachment=True,
-        download_name='inventario_LSI.xlsx'
+        download_name=item['nombre_descarga']
     )
 
+@app.route("/metricas")
+@login_required
+def metricas():
+    return jsonify({
+        'pool_conexiones': obtener_pool().metricas(),
+        'cache_ubicaciones': cache_ubicaciones.metricas(),
+        'esquema': {'version': version_esquema(get_db_connection()), 'ultima': max(MIGRACIONES)},
+        'imagenes': dict(get_db_connection().execute("""
+            SELECT COUNT(*) AS archivos, COALESCE(SUM(referencias <= 0), 0) AS sin_uso FROM imagenes
+        """).fetchone()),
+        'alertas_stock': {
+            **obtener_enviador().metricas(),
+            **{fila['estado']: fila['total'] for fila in get_db_connection().execute(
+                "SELECT estado, COUNT(*) AS total FROM bandeja_alertas GROUP BY estado"
+            )},
+        },
+    })
+
 
 # ============================================
 # ⬇️ RUTAS DE GESTIÓN DE PROYECTOS ⬇️
@@ -813,6 +3733,7 @@ def descargar_plantilla():
 
 @app.route("/detalle_proyecto/<int:id>")
 @login_required
+@condicional('inventario', 'proyectos', 'ubicaciones')
 def detalle_proyecto(id):
     conn = get_db_connection()
     proyecto, error = get_proyecto_or_404(conn, id)
@@ -837,7 +3758,6 @@ def detalle_proyecto(id):
         ORDER BY pi.fecha_asignacion DESC
     """, (id,)).fetchall()
     
-    conn.close()
     
     return render_template("detalle_proyecto.html", proyecto=proyecto, items=items)
 
@@ -851,60 +3771,18 @@ def exportar_proyecto(id):
     
     if not proyecto:
         flash("Proyecto no encontrado.", "danger")
-        conn.close()
         return redirect(url_for('crear_proyecto'))
     
-    # Obtener items asignados al proyecto
-    items = conn.execute("""
-        SELECT 
-            i.CODIGO,
-            i.MARCA,
-            i.DESCRIPCION,
-            pi.cantidad_asignada as CANTIDAD_ASIGNADA,
-            i.CANTIDAD as STOCK_ACTUAL,
-            i.UBICACION,
-            pi.fecha_asignacion as FECHA_ASIGNACION,
-            pi.observacion as OBSERVACION
-        FROM proyecto_items pi
-        JOIN inventario i ON pi.inventario_id = i.id
-        WHERE pi.proyecto_id = ?
-        ORDER BY i.CODIGO
-    """, (id,)).fetchall()
-    
-    conn.close()
+    tiene_items = conn.execute(
+        "SELECT 1 FROM proyecto_items WHERE proyecto_id = ? LIMIT 1", (id,)
+    ).fetchone()
     
-    if not items:
+    if not tiene_items:
         flash("No hay productos asignados a este proyecto.", "warning")
         return redirect(url_for('detalle_proyecto', id=id))
     
-    # Convertir a DataFrame
-    df = pd.DataFrame([dict(item) for item in items])
-    
-    # Crear archivo Excel en memoria
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Productos Asignados')
-        
-        # Ajustar anchos de columna
-        worksheet = writer.sheets['Productos Asignados']
-        for idx, col in enumerate(df.columns):
-            max_length = max(
-                df[col].astype(str).map(len).max(),
-                len(col)
-            ) + 2
-            worksheet.column_dimensions[chr(65 + idx)].width = max_length
-    
-    output.seek(0)
-    
-    # Nombre del archivo
-    nombre_archivo = f"Proyecto_{proyecto['nombre'].replace(' ', '_')}.xlsx"
-    
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name=nombre_archivo
-    )
+    trabajo_id = encolar_trabajo('proyecto', claves_datos=('inventario', 'proyectos', 'ubicaciones'), proyecto_id=id)
+    return redirect(url_for('ver_trabajo', trabajo_id=trabajo_id))
 
 @app.route("/asignar_items/<int:proyecto_id>", methods=["GET", "POST"])
 @login_required
@@ -914,67 +3792,123 @@ def asignar_items(proyecto_id):
     if error:
         return error
     
+    if proyecto['estado'] == 'CERRADO':
+        flash("El proyecto está cerrado: no se le pueden asignar productos", "warning")
+        return redirect(url_for("detalle_proyecto", id=proyecto_id))
+    
     if request.method == "POST":
-        inventario_id = request.form.get("inventario_id")
-        cantidad = int(request.form.get("cantidad", 0))
+        inventario_id = to_int(request.form.get("inventario_id"), None)
+        cantidad = to_int(request.form.get("cantidad"), None)
         observacion = request.form.get("observacion", "").strip().upper()
         
-        if not inventario_id or cantidad <= 0:
+        if inventario_id is None or cantidad is None or cantidad <= 0:
             flash("Debe seleccionar un producto y cantidad válida", "warning")
             return redirect(url_for("asignar_items", proyecto_id=proyecto_id))
         
-        item = conn.execute("SELECT * FROM inventario WHERE id = ?", (inventario_id,)).fetchone()
+        item = conn.execute("SELECT id FROM inventario WHERE id = ?", (inventario_id,)).fetchone()
         
         if not item:
             flash("Producto no encontrado", "danger")
             return redirect(url_for("asignar_items", proyecto_id=proyecto_id))
         
-        if item['CANTIDAD'] < cantidad:
-            flash(f"Stock insuficiente. Disponible: {item['CANTIDAD']}", "danger")
-            return redirect(url_for("asignar_items", proyecto_id=proyecto_id))
-        
-        # Asignar item al proyecto
-        fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        conn.execute("""
-            INSERT INTO proyecto_items (proyecto_id, inventario_id, cantidad_asignada, fecha_asignacion, observacion)
-            VALUES (?, ?, ?, ?, ?)
-        """, (proyecto_id, inventario_id, cantidad, fecha, observacion))
-        
-        # Descontar del stock y verificar
-        nueva_cantidad = item['CANTIDAD'] - cantidad
-        stock_bajo = actualizar_stock_y_verificar(conn, inventario_id, nueva_cantidad)
+        def asignar(conn):
+            # Descontar del stock (solo si alcanza) y verificar
+            restante, stock_bajo = descontar_stock_y_verificar(conn, inventario_id, cantidad)
+            if restante is None:
+                disponible = conn.execute("SELECT CANTIDAD FROM inventario WHERE id = ?", (inventario_id,)).fetchone()
+                return False, disponible['CANTIDAD'], False
+            
+            # Asignar item al proyecto
+            fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            conn.execute("""
+                INSERT INTO proyecto_items (proyecto_id, inventario_id, cantidad_asignada, fecha_asignacion, observacion)
+                VALUES (?, ?, ?, ?, ?)
+            """, (proyecto_id, inventario_id, cantidad, fecha, observacion))
+            
+            # Registrar movimiento
+            registrar_movimiento(conn, inventario_id, 'salida', cantidad, 
+                               f"Asignado a proyecto: {observacion}", proyecto['nombre'])
+            return True, restante, stock_bajo
         
-        # Registrar movimiento
-        registrar_movimiento(conn, inventario_id, 'salida', cantidad, 
-                           f"Asignado a proyecto: {observacion}", proyecto['nombre'])
+        asignado, disponible, stock_bajo = en_transaccion_inmediata(conn, asignar)
         
-        conn.commit()
+        if not asignado:
+            flash(f"Stock insuficiente. Disponible: {disponible}", "danger")
+            return redirect(url_for("asignar_items", proyecto_id=proyecto_id))
         
         if stock_bajo:
             producto = conn.execute("SELECT * FROM inventario WHERE id = ?", (inventario_id,)).fetchone()
             flash(f"⚠️ {producto['DESCRIPCION']} está en stock bajo", "warning")
         
-        conn.close()
         flash(f"✅ {cantidad} unidades asignadas al proyecto correctamente", "success")
         return redirect(url_for("detalle_proyecto", id=proyecto_id))
     
-    productos = conn.execute("SELECT * FROM inventario WHERE CANTIDAD > 0 ORDER BY DESCRIPCION").fetchall()
-    conn.close()
+    return render_template("asignar_items.html", proyecto=proyecto)
+
+@app.route("/productos/buscar")
+@login_required
+def buscar_productos():
+    """Autocompletado de la página de asignación: devuelve los primeros N productos con stock"""
+    busqueda = request.args.get('q', '').strip()
+    limite = min(max(to_int(request.args.get('limite'), 20), 1), 50)
+    
+    conn = get_db_connection()
+    productos = buscar_para_asignar(conn, busqueda, limite)
+    
+    return jsonify([dict(p) for p in productos])
+
+@app.route("/asignar_items/<int:proyecto_id>/lote", methods=["POST"])
+@login_required
+def asignar_items_lote(proyecto_id):
+    """Asigna varias líneas en una sola petición JSON:
+    {"lineas": [{"inventario_id": 1, "cantidad": 2, "observacion": ""}], "parcial": false}
+    """
+    conn = get_db_connection()
+    proyecto = conn.execute(
+        "SELECT * FROM ubicaciones WHERE id = ? AND tipo = 'PROYECTO'", (proyecto_id,)
+    ).fetchone()
+    if not proyecto:
+        return jsonify({'error': 'Proyecto no encontrado'}), 404
+    if proyecto['estado'] == 'CERRADO':
+        return jsonify({'error': 'El proyecto está cerrado'}), 409
+    
+    datos = request.get_json(silent=True) or {}
+    lineas = datos.get('lineas')
+    if not isinstance(lineas, list) or not lineas or not all(isinstance(l, dict) for l in lineas):
+        return jsonify({'error': 'Se esperaba una lista de líneas con inventario_id y cantidad'}), 400
+    parcial = bool(datos.get('parcial'))
     
-    return render_template("asignar_items.html", proyecto=proyecto, productos=productos)
+    asignadas, rechazadas, stock_bajo = en_transaccion_inmediata(
+        conn, lambda conn: asignar_lote(conn, proyecto, lineas, parcial)
+    )
+    
+    return jsonify({
+        'aplicado': bool(asignadas),
+        'asignadas': [
+            {'linea': l['linea'], 'inventario_id': l['inventario_id'], 'cantidad': l['cantidad']}
+            for l in asignadas
+        ],
+        'rechazadas': rechazadas,
+        'stock_bajo': [
+            {'inventario_id': p['id'], 'CODIGO': p['CODIGO'], 'DESCRIPCION': p['DESCRIPCION'],
+             'CANTIDAD': p['CANTIDAD'], 'MINIMO': p['MINIMO']}
+            for p in stock_bajo
+        ],
+        'detalle_proyecto': url_for('detalle_proyecto', id=proyecto_id),
+    }), 200 if asignadas or not rechazadas else 409
 
 @app.route("/devolver_item/<int:asignacion_id>", methods=["POST"])
 @login_required
 def devolver_item(asignacion_id):
-    cantidad_devolver = int(request.form.get("cantidad", 0))
+    cantidad_devolver = to_int(request.form.get("cantidad"), None)
     
-    if cantidad_devolver <= 0:
+    if cantidad_devolver is None or cantidad_devolver <= 0:
         flash("Cantidad inválida", "danger")
         return redirect(request.referrer)
     
     conn = get_db_connection()
     asignacion = conn.execute("""
-        SELECT pi.*, u.nombre as proyecto_nombre, i.CODIGO, i.DESCRIPCION
+        SELECT pi.*, u.nombre as proyecto_nombre, u.estado as proyecto_estado, i.CODIGO, i.DESCRIPCION
         FROM proyecto_items pi
         JOIN ubicaciones u ON pi.proyecto_id = u.id
         JOIN inventario i ON pi.inventario_id = i.id
@@ -982,34 +3916,45 @@ def devolver_item(asignacion_id):
     """, (asignacion_id,)).fetchone()
     
     if not asignacion:
-        conn.close()
         flash("Asignación no encontrada", "danger")
         return redirect(request.referrer)
     
+    if asignacion['proyecto_estado'] == 'CERRADO':
+        flash("El proyecto está cerrado: sus productos ya fueron devueltos al stock", "warning")
+        return redirect(request.referrer)
+    
     if cantidad_devolver > asignacion['cantidad_asignada']:
         flash(f"No puedes devolver más de {asignacion['cantidad_asignada']} unidades", "danger")
-        conn.close()
         return redirect(request.referrer)
     
-    # Actualizar cantidad asignada
-    nueva_cantidad_asignada = asignacion['cantidad_asignada'] - cantidad_devolver
-    
-    if nueva_cantidad_asignada == 0:
-        conn.execute("DELETE FROM proyecto_items WHERE id = ?", (asignacion_id,))
-    else:
-        conn.execute("UPDATE proyecto_items SET cantidad_asignada = ? WHERE id = ?", 
-                    (nueva_cantidad_asignada, asignacion_id))
-    
-    # Devolver al stock
-    conn.execute("UPDATE inventario SET CANTIDAD = CANTIDAD + ? WHERE id = ?", 
-                (cantidad_devolver, asignacion['inventario_id']))
-    
-    # Registrar movimiento
-    registrar_movimiento(conn, asignacion['inventario_id'], 'entrada', cantidad_devolver,
-                        "Devuelto desde proyecto", asignacion['proyecto_nombre'])
+    def devolver(conn):
+        # Actualizar cantidad asignada (solo si todavía alcanza: otra devolución pudo adelantarse)
+        fila = conn.execute("""
+            UPDATE proyecto_items SET cantidad_asignada = cantidad_asignada - ?
+            WHERE id = ? AND cantidad_asignada >= ?
+            RETURNING cantidad_asignada
+        """, (cantidad_devolver, asignacion_id, cantidad_devolver)).fetchall()
+        if not fila:
+            return False
+        
+        if fila[0]['cantidad_asignada'] == 0:
+            conn.execute("DELETE FROM proyecto_items WHERE id = ?", (asignacion_id,))
+        
+        # Devolver al stock
+        reponer_stock(conn, asignacion['inventario_id'], cantidad_devolver)
+        
+        # Registrar movimiento
+        registrar_movimiento(conn, asignacion['inventario_id'], 'entrada', cantidad_devolver,
+                            "Devuelto desde proyecto", asignacion['proyecto_nombre'])
+        return True
     
-    conn.commit()
-    conn.close()
+    if not en_transaccion_inmediata(conn, devolver):
+        actual = conn.execute("SELECT cantidad_asignada FROM proyecto_items WHERE id = ?", (asignacion_id,)).fetchone()
+        if actual:
+            flash(f"No puedes devolver más de {actual['cantidad_asignada']} unidades", "danger")
+        else:
+            flash("Asignación no encontrada", "danger")
+        return redirect(request.referrer)
     
     flash(f"✅ {cantidad_devolver} unidades devueltas al stock correctamente", "success")
     return redirect(request.referrer)
@@ -1022,35 +3967,42 @@ def eliminar_proyecto(id):
     if error:
         return error
     
-    # Obtener todos los items asignados al proyecto
-    items_asignados = conn.execute("""
-        SELECT pi.*, i.CODIGO, i.DESCRIPCION
-        FROM proyecto_items pi
-        JOIN inventario i ON pi.inventario_id = i.id
-        WHERE pi.proyecto_id = ?
-    """, (id,)).fetchall()
+    # Con modo=archivar el proyecto queda CERRADO y conserva sus asignaciones como historial
+    archivar = request.form.get("modo") == "archivar"
     
-    # Devolver todos los productos al stock
-    fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    for item in items_asignados:
-        # Devolver al stock
-        conn.execute("UPDATE inventario SET CANTIDAD = CANTIDAD + ? WHERE id = ?", 
-                    (item['cantidad_asignada'], item['inventario_id']))
+    def cerrar(conn):
+        # Releer el estado dentro de la transacción: un proyecto cerrado ya devolvió su stock
+        estado = conn.execute("SELECT estado FROM ubicaciones WHERE id = ?", (id,)).fetchone()
+        if not estado:
+            return 0
+        ya_cerrado = estado['estado'] == 'CERRADO'
+        if archivar and ya_cerrado:
+            return None
         
-        # Registrar movimiento
-        registrar_movimiento(conn, item['inventario_id'], 'entrada', item['cantidad_asignada'],
-                           "Devuelto por eliminación de proyecto", proyecto['nombre'])
-    
-    # Eliminar todas las asignaciones del proyecto
-    conn.execute("DELETE FROM proyecto_items WHERE proyecto_id = ?", (id,))
-    
-    # Eliminar el proyecto
-    conn.execute("DELETE FROM ubicaciones WHERE id = ?", (id,))
+        devueltas = 0
+        if not ya_cerrado:
+            motivo = "cierre" if archivar else "eliminación"
+            devueltas = devolver_stock_proyecto(conn, proyecto, f"Devuelto por {motivo} de proyecto")
+        
+        if archivar:
+            fecha_fin = datetime.now().strftime("%Y-%m-%d")
+            conn.execute("""
+                UPDATE ubicaciones SET estado = 'CERRADO', activa = 0, fecha_fin = ?
+                WHERE id = ?
+            """, (fecha_fin, id))
+        else:
+            conn.execute("DELETE FROM proyecto_items WHERE proyecto_id = ?", (id,))
+            conn.execute("DELETE FROM ubicaciones WHERE id = ?", (id,))
+        return devueltas
     
-    conn.commit()
-    conn.close()
+    devueltas = en_transaccion_inmediata(conn, cerrar)
     
-    flash(f"✅ Proyecto '{proyecto['nombre']}' eliminado. Productos devueltos al stock.", "success")
+    if devueltas is None:
+        flash(f"El proyecto '{proyecto['nombre']}' ya estaba cerrado.", "warning")
+    elif archivar:
+        flash(f"✅ Proyecto '{proyecto['nombre']}' cerrado. {devueltas} unidades devueltas al stock.", "success")
+    else:
+        flash(f"✅ Proyecto '{proyecto['nombre']}' eliminado. Productos devueltos al stock.", "success")
     return redirect(url_for("crear_proyecto"))
 
 
@@ -1058,7 +4010,451 @@ def eliminar_proyecto(id):
 # ⬆️ FIN DE RUTAS DE PROYECTOS ⬆️
 # ============================================
 
+# ============================================
+# 🔌 API JSON v1 (INTEGRACIONES)
+# ============================================
+
+# Las rutas /api/v1 reciben y responden JSON y se autentican con token (ver
+# crear_token.py). Las operaciones en lote corren en una sola transacción: sin
+# "parcial" se aplican todas las líneas o ninguna, como asignar_items_lote.
+
+COLUMNAS_API = COLUMNAS_EXPORTACION
+# CANTIDAD no se edita directo: cada cambio de stock pasa por /stock/ajustes y deja su movimiento
+COLUMNAS_API_EDITABLES = [c for c in COLUMNAS_IMPORTACION if c != 'CANTIDAD']
+COLUMNAS_API_ENTEROS = ('CANTIDAD', 'MINIMO')
+
+class LoteRechazado(Exception):
+    """Corta la transacción de un lote de la API cuando una línea no se puede aplicar"""
+    def __init__(self, rechazadas):
+        super().__init__("Lote rechazado")
+        self.rechazadas = rechazadas
+
+def columnas_api(texto):
+    """Helper que lee ?campos=CODIGO,CANTIDAD; retorna las columnas (siempre con id) o None si alguna no existe"""
+    if not texto:
+        return COLUMNAS_API
+    pedidas = ['id' if c.strip().lower() == 'id' else c.strip().upper() for c in texto.split(',') if c.strip()]
+    if any(c not in COLUMNAS_API for c in pedidas):
+        return None
+    return ['id'] + [c for c in COLUMNAS_API if c in pedidas and c != 'id']
+
+def valores_producto(datos, columnas):
+    """Helper que valida los campos de un producto recibido por la API; retorna (valores, error)"""
+    desconocidos = sorted(set(datos) - set(columnas) - {'id'})
+    if desconocidos:
+        return None, f"Campos no permitidos: {', '.join(desconocidos)}"
+    valores = {}
+    for columna in columnas:
+        if columna not in datos:
+            continue
+        valor = datos[columna]
+        if columna in COLUMNAS_API_ENTEROS:
+            valor = to_int(valor, None)
+            if valor is None or valor < 0:
+                return None, f"{columna} debe ser un entero no negativo"
+        elif columna.startswith('PRECIO_'):
+            valor = to_float(valor, None)
+            if valor is None:
+                return None, f"{columna} debe ser un número"
+        else:
+            valor = '' if valor is None else str(valor).strip()
+        valores[columna] = valor
+    return valores, None
+
+def lote_api(clave):
+    """Helper que lee la lista "clave" del cuerpo JSON; retorna (lista, datos, error)"""
+    datos = request.get_json(silent=True)
+    lista = datos.get(clave) if isinstance(datos, dict) else None
+    if not isinstance(lista, list) or not lista:
+        return None, None, error_api(f'Se esperaba {{"{clave}": [...]}} con al menos un elemento', 400)
+    if len(lista) > app.config["API_MAX_LOTE"]:
+        return None, None, error_api(f'Máximo {app.config["API_MAX_LOTE"]} elementos por petición', 413)
+    return lista, datos, None
+
+def ids_api(lista):
+    """Helper que convierte una lista de ids; retorna None si alguno no es entero"""
+    ids = [to_int(i, None) for i in lista]
+    return None if None in ids else ids
+
+def productos_por_id(conn, ids, columnas="i.*"):
+    """Productos de la lista de ids con una sola consulta (json_each), en el orden pedido"""
+    filas = conn.execute(f"""
+        SELECT {columnas} FROM json_each(?) p
+        JOIN inventario i ON i.id = p.value
+        ORDER BY p.key
+    """, (json.dumps(ids),)).fetchall()
+    return filas
+
+@app.after_request
+def comprimir_api(respuesta):
+    """Comprime con gzip las respuestas de la API si el cliente lo acepta y vale la pena"""
+    if (not request.path.startswith('/api/') or respuesta.direct_passthrough
+            or respuesta.status_code != 200 or 'Content-Encoding' in respuesta.headers):
+        return respuesta
+    respuesta.vary.add('Accept-Encoding')
+    if not request.accept_encodings['gzip']:
+        return respuesta
+    datos = respuesta.get_data()
+    if len(datos) < app.config["API_GZIP_MINIMO"]:
+        return respuesta
+    respuesta.set_data(gzip.compress(datos, compresslevel=6))
+    respuesta.headers['Content-Encoding'] = 'gzip'
+    # Misma ETag pero débil: los bytes cambian, los datos no, y el 304 sigue valiendo
+    etag, _ = respuesta.get_etag()
+    if etag:
+        respuesta.set_etag(etag, weak=True)
+    return respuesta
+
+@app.route("/api/v1/productos", methods=["GET"])
+@token_requerido
+@condicional('inventario')
+def api_productos():
+    """Lista de productos paginada por cursor (orden por id):
+    ?q=texto&bajo_stock=1&campos=CODIGO,CANTIDAD&limite=100&cursor=...
+    """
+    columnas = columnas_api(request.args.get('campos'))
+    if columnas is None:
+        return error_api('Campo desconocido', 400, disponibles=COLUMNAS_API)
+    limite = min(max(to_int(request.args.get('limite'), app.config["API_LIMITE_PAGINA"]), 1),
+                 app.config["API_LIMITE_MAXIMO"])
+    cursor = decodificar_cursor(request.args.get('cursor'))
+    if request.args.get('cursor') and cursor is None:
+        return error_api('Cursor inválido', 400)
+    
+    # Búsqueda con el mismo filtro que la tabla principal, pero siempre por id para que el cursor sea estable
+    query, params, _ = consulta_busqueda(request.args.get('q', '').strip(), ", ".join(f"i.{c}" for c in columnas))
+    if request.args.get('bajo_stock') == '1':
+        query += FILTRO_BAJO_STOCK
+    if cursor:
+        query += " AND i.id > ?"
+        params.append(cursor[1])
+    query += " ORDER BY i.id LIMIT ?"
+    params.append(limite + 1)
+    
+    filas = get_db_connection().execute(query, params).fetchall()
+    siguiente = codificar_cursor(None, filas[limite - 1]['id']) if len(filas) > limite else None
+    return jsonify({'productos': [dict(f) for f in filas[:limite]], 'siguiente': siguiente})
+
+@app.route("/api/v1/productos/lote", methods=["GET", "POST"])
+@token_requerido
+def api_productos_lote():
+    """Varios productos por id: GET ?ids=1,2,3 o POST {"ids": [1, 2, 3]} (admite ?campos=)"""
+    columnas = columnas_api(request.args.get('campos'))
+    if columnas is None:
+        return error_api('Campo desconocido', 400, disponibles=COLUMNAS_API)
+    if request.method == "POST":
+        lista, _, error = lote_api('ids')
+        if error:
+            return error
+    else:
+        lista = [i for i in request.args.get('ids', '').split(',') if i.strip()]
+        if not lista or len(lista) > app.config["API_MAX_LOTE"]:
+            return error_api(f'Se esperaba ?ids=1,2,3 (máximo {app.config["API_MAX_LOTE"]})', 400)
+    ids = ids_api(lista)
+    if ids is None:
+        return error_api('Los ids deben ser enteros', 400)
+    
+    filas = productos_por_id(get_db_connection(), ids, ", ".join(f"i.{c}" for c in columnas))
+    encontrados = {f['id'] for f in filas}
+    return jsonify({
+        'productos': [dict(f) for f in filas],
+        'no_encontrados': [i for i in dict.fromkeys(ids) if i not in encontrados],
+    })
+
+@app.route("/api/v1/productos", methods=["POST"])
+@token_requerido
+def api_crear_productos():
+    """Crea productos: {"productos": [{"MARCA": ..., "CODIGO": ..., "DESCRIPCION": ..., ...}], "parcial": false}"""
+    lista, datos, error = lote_api('productos')
+    if error:
+        return error
+    parcial = bool(datos.get('parcial'))
+    
+    validos = []
+    rechazadas = []
+    for numero, producto in enumerate(lista, start=1):
+        if not isinstance(producto, dict):
+            rechazadas.append({'linea': numero, 'motivo': 'Se esperaba un objeto'})
+            continue
+        valores, motivo = valores_producto(producto, COLUMNAS_IMPORTACION)
+        if not motivo and not all(valores.get(c) for c in ('MARCA', 'CODIGO', 'DESCRIPCION')):
+            motivo = 'Marca, código y descripción son obligatorios'
+        if motivo:
+            rechazadas.append({'linea': numero, 'motivo': motivo})
+            continue
+        validos.append((numero, valores))
+    if rechazadas and not parcial:
+        return error_api('Ningún producto fue creado', 400, rechazadas=rechazadas)
+    
+    columnas = COLUMNAS_IMPORTACION + [f"{c}_N" for c in CAMPOS_BUSQUEDA]
+    sql = f"""
+        INSERT INTO inventario ({', '.join(columnas)})
+        VALUES ({', '.join(['?'] * len(columnas))})
+        RETURNING *
+    """
+    
+    def crear(conn):
+        creados = []
+        for numero, valores in validos:
+            fila = {c: valores.get(c, 0 if c in COLUMNAS_API_ENTEROS or c.startswith('PRECIO_') else '')
+                    for c in COLUMNAS_IMPORTACION}
+            # Sin ubicación queda en BODEGA, igual que en la importación
+            fila['UBICACION'] = fila['UBICACION'] or 'BODEGA'
+            nuevo = conn.execute(sql, (
+                *(fila[c] for c in COLUMNAS_IMPORTACION),
+                *campos_busqueda(fila['CODIGO'], fila['DESCRIPCION'], fila['MARCA'], fila['UBICACION'])
+            )).fetchone()
+            if nuevo['CANTIDAD'] <= nuevo['MINIMO']:
+                encolar_alerta_stock(conn, nuevo)
+            creados.append({'linea': numero, 'id': nuevo['id']})
+        return creados
+    
+    creados = en_transaccion_inmediata(get_db_connection(), crear) if validos else []
+    return jsonify({'creados': creados, 'rechazadas': rechazadas}), 201 if creados else 400
+
+@app.route("/api/v1/productos", methods=["PATCH"])
+@token_requerido
+def api_actualizar_productos():
+    """Actualiza solo los campos enviados: {"productos": [{"id": 1, "PRECIO_COSTO": 10.5}], "parcial": false}
+    
+    CANTIDAD no se acepta aquí: el stock se cambia con /api/v1/stock/ajustes.
+    """
+    lista, datos, error = lote_api('productos')
+    if error:
+        return error
+    parcial = bool(datos.get('parcial'))
+    
+    cambios = []
+    rechazadas = []
+    for numero, producto in enumerate(lista, start=1):
+        producto_id = to_int(producto.get('id'), None) if isinstance(producto, dict) else None
+        if producto_id is None:
+            rechazadas.append({'linea': numero, 'motivo': 'Falta el id del producto'})
+            continue
+        valores, motivo = valores_producto(producto, COLUMNAS_API_EDITABLES)
+        if not motivo and not valores:
+            motivo = 'No hay campos para actualizar'
+        if not motivo and any(c in valores and not valores[c] for c in ('MARCA', 'CODIGO', 'DESCRIPCION')):
+            motivo = 'Marca, código y descripción no pueden quedar vacíos'
+        if motivo:
+            rechazadas.append({'linea': numero, 'id': producto_id, 'motivo': motivo})
+            continue
+        cambios.append((numero, producto_id, valores))
+    if rechazadas and not parcial:
+        return error_api('Ningún producto fue actualizado', 400, rechazadas=rechazadas)
+    
+    def actualizar(conn):
+        actualizados = []
+        no_encontrados = []
+        for numero, producto_id, valores in cambios:
+            antes = conn.execute("SELECT CANTIDAD, MINIMO FROM inventario WHERE id = ?", (producto_id,)).fetchone()
+            asignaciones = ", ".join(f"{c} = ?" for c in valores)
+            fila = conn.execute(
+                f"UPDATE inventario SET {asignaciones} WHERE id = ? RETURNING *",
+                (*valores.values(), producto_id)
+            ).fetchone()
+            if not fila:
+                no_encontrados.append({'linea': numero, 'id': producto_id, 'motivo': 'Producto no encontrado'})
+                continue
+            # Subir el mínimo por encima del stock avisa igual que el formulario de edición
+            alertar_si_entra_en_bajo_stock(conn, antes, fila)
+            if any(c in valores for c in CAMPOS_BUSQUEDA):
+                conn.execute("""
+                    UPDATE inventario SET CODIGO_N = ?, DESCRIPCION_N = ?, MARCA_N = ?, UBICACION_N = ?
+                    WHERE id = ?
+                """, (*campos_busqueda(fila['CODIGO'], fila['DESCRIPCION'], fila['MARCA'], fila['UBICACION']), producto_id))
+            actualizados.append({'linea': numero, 'id': producto_id})
+        if no_encontrados and not parcial:
+            raise LoteRechazado(no_encontrados)
+        return actualizados, no_encontrados
+    
+    try:
+        actualizados, no_encontrados = en_transaccion_inmediata(get_db_connection(), actualizar)
+    except LoteRechazado as e:
+        return error_api('Ningún producto fue actualizado', 404, rechazadas=e.rechazadas)
+    rechazadas = sorted(rechazadas + no_encontrados, key=lambda r: r['linea'])
+    return jsonify({'actualizados': actualizados, 'rechazadas': rechazadas}), 200 if actualizados else 404
+
+@app.route("/api/v1/productos", methods=["DELETE"])
+@token_requerido
+def api_eliminar_productos():
+    """Elimina productos: {"ids": [1, 2, 3]}.
+    
+    Los ids que no existen y los productos asignados a proyectos se informan
+    aparte y no cortan el lote.
+    """
+    lista, _, error = lote_api('ids')
+    if error:
+        return error
+    ids = ids_api(lista)
+    if ids is None:
+        return error_api('Los ids deben ser enteros', 400)
+    
+    def eliminar_lote(conn):
+        # Solo bloquean los proyectos abiertos: las asignaciones de proyectos cerrados se respaldan
+        asignados = [fila['inventario_id'] for fila in conn.execute("""
+            SELECT DISTINCT pi.inventario_id FROM proyecto_items pi
+            JOIN ubicaciones u ON u.id = pi.proyecto_id
+            WHERE pi.inventario_id IN (SELECT value FROM json_each(?)) AND u.estado IS NOT 'CERRADO'
+        """, (json.dumps(ids),))]
+        respaldar_asignaciones_cerradas(conn, ids)
+        eliminados = conn.execute("""
+            DELETE FROM inventario
+            WHERE id IN (SELECT value FROM json_each(?))
+              AND id NOT IN (SELECT inventario_id FROM proyecto_items)
+            RETURNING id, IMAGEN
+        """, (json.dumps(ids),)).fetchall()
+        liberadas = [liberar_imagen(conn, nombre) for nombre in {fila['IMAGEN'] for fila in eliminados}]
+        return eliminados, asignados, liberadas
+    
+    conn = get_db_connection()
+    eliminados, asignados, liberadas = en_transaccion_inmediata(conn, eliminar_lote)
+    
+    # Las imágenes se borran después del commit y solo si ningún otro producto las usa
+    borrar_imagenes_liberadas(conn, liberadas)
+    borrados = {fila['id'] for fila in eliminados}
+    return jsonify({
+        'eliminados': sorted(borrados),
+        'asignados_a_proyectos': sorted(asignados),
+        'no_encontrados': [i for i in dict.fromkeys(ids) if i not in borrados and i not in asignados],
+    })
+
+@app.route("/api/v1/stock/ajustes", methods=["POST"])
+@token_requerido
+def api_ajustes_stock():
+    """Entradas y salidas en lote, cada una con su movimiento:
+    {"ajustes": [{"inventario_id": 1, "tipo": "salida", "cantidad": 2, "observacion": "", "proyecto": ""}], "parcial": false}
+    """
+    lista, datos, error = lote_api('ajustes')
+    if error:
+        return error
+    parcial = bool(datos.get('parcial'))
+    
+    validos = []
+    rechazadas = []
+    for numero, ajuste in enumerate(lista, start=1):
+        if not isinstance(ajuste, dict):
+            rechazadas.append({'linea': numero, 'motivo': 'Se esperaba un objeto'})
+            continue
+        inventario_id = to_int(ajuste.get('inventario_id'), None)
+        cantidad = to_int(ajuste.get('cantidad'), 0)
+        tipo = str(ajuste.get('tipo') or '').strip().lower()
+        if inventario_id is None or cantidad <= 0 or tipo not in ('entrada', 'salida'):
+            rechazadas.append({'linea': numero, 'inventario_id': inventario_id,
+                               'motivo': 'Se esperaba inventario_id, tipo (entrada o salida) y cantidad mayor a cero'})
+            continue
+        validos.append({
+            'linea': numero,
+            'inventario_id': inventario_id,
+            'tipo': tipo,
+            'cantidad': cantidad,
+            'observacion': str(ajuste.get('observacion') or '').strip().upper(),
+            'proyecto': str(ajuste.get('proyecto') or '').strip().upper(),
+        })
+    if rechazadas and not parcial:
+        return error_api('Ningún ajuste fue aplicado', 400, rechazadas=rechazadas)
+    
+    def ajustar(conn):
+        aplicados = []
+        sin_stock = []
+        stock_bajo = []
+        for linea in validos:
+            # Cada línea ve el stock que dejaron las anteriores (mismo producto varias veces)
+            if linea['tipo'] == 'entrada':
+                restante, bajo = reponer_stock(conn, linea['inventario_id'], linea['cantidad']), False
+            else:
+                restante, bajo = descontar_stock_y_verificar(conn, linea['inventario_id'], linea['cantidad'])
+            if restante is None:
+                disponible = conn.execute(
+                    "SELECT CANTIDAD FROM inventario WHERE id = ?", (linea['inventario_id'],)
+                ).fetchone()
+                motivo = f"Stock insuficiente. Disponible: {disponible['CANTIDAD']}" if disponible else 'Producto no encontrado'
+                sin_stock.append({'linea': linea['linea'], 'inventario_id': linea['inventario_id'], 'motivo': motivo})
+                continue
+            aplicados.append({**linea, 'stock': restante})
+            if bajo:
+                stock_bajo.append(linea['inventario_id'])
+        if sin_stock and not parcial:
+            raise LoteRechazado(sin_stock)
+        registrar_movimientos(conn, [
+            (a['inventario_id'], a['tipo'], a['cantidad'], a['observacion'], a['proyecto']) for a in aplicados
+        ])
+        return aplicados, sin_stock, stock_bajo
+    
+    try:
+        aplicados, sin_stock, stock_bajo = (
+            en_transaccion_inmediata(get_db_connection(), ajustar) if validos else ([], [], [])
+        )
+    except LoteRechazado as e:
+        return error_api('Ningún ajuste fue aplicado', 409, rechazadas=e.rechazadas)
+    
+    return jsonify({
+        'aplicado': bool(aplicados),
+        'ajustes': [
+            {'linea': a['linea'], 'inventario_id': a['inventario_id'], 'tipo': a['tipo'],
+             'cantidad': a['cantidad'], 'stock': a['stock']}
+            for a in aplicados
+        ],
+        'rechazadas': sorted(rechazadas + sin_stock, key=lambda r: r['linea']),
+        'stock_bajo': list(dict.fromkeys(stock_bajo)),
+    }), 200 if aplicados or not (rechazadas or sin_stock) else 409
+
+@app.errorhandler(404)
+@app.errorhandler(405)
+def error_http(error):
+    """En la API los 404/405 de rutas también responden JSON; en el resto, la página de siempre"""
+    if request.path.startswith('/api/'):
+        return error_api('Ruta no encontrada' if error.code == 404 else 'Método no permitido', error.code)
+    return error
+
+
+# ============================================
+# 🚀 ARRANQUE DEL SERVIDOR
+# ============================================
+
+_inicializada = False
+_inicializada_lock = threading.Lock()
+
+def create_app(config=None):
+    """Retorna la aplicación lista para servir (la usan wsgi.py y python app.py).
+    
+    La base se migra e inicializa una sola vez por proceso; con gunicorn y
+    preload_app eso ocurre en el proceso maestro antes de crear los workers, que
+    abren su propio pool y sus hilos la primera vez que los necesitan.
+    """
+    global _inicializada
+    if config:
+        app.config.update(config)
+    with _inicializada_lock:
+        if not _inicializada:
+            os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+            if app.config["INICIALIZAR_DB"]:
+                init_db()
+            _inicializada = True
+    return app
+
+def servir():
+    """Sirve con waitress (multihilo, también en Windows); sin waitress usa el servidor de Flask.
+    
+    Ambos corren en un solo proceso: SERVIDOR_PROCESOS solo lo usa gunicorn (gunicorn.conf.py).
+    """
+    host = app.config["SERVIDOR_HOST"]
+    puerto = app.config["SERVIDOR_PUERTO"]
+    if "SERVIDOR_PROCESOS" in os.environ and app.config["SERVIDOR_PROCESOS"] > 1:
+        print(f"⚠️  SERVIDOR_PROCESOS={app.config['SERVIDOR_PROCESOS']} se ignora: python app.py usa un solo "
+              "proceso con SERVIDOR_HILOS hilos; para varios procesos usar gunicorn -c gunicorn.conf.py")
+    try:
+        from waitress import serve
+    except ImportError:
+        print("⚠️  waitress no está instalado (pip install waitress): usando el servidor de desarrollo")
+        app.run(host=host, port=puerto, debug=False, threaded=True)
+        return
+    print(f"✅ Servidor en http://{host}:{puerto} ({app.config['SERVIDOR_HILOS']} hilos)")
+    serve(app, host=host, port=puerto, threads=app.config["SERVIDOR_HILOS"])
+
 if __name__ == "__main__":
-    os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
-    init_db()
-    app.run(host="10.1.3.105", port=5000, debug=True, threaded=True)
\ No newline at end of file
+    create_app()
+    if "--debug" in sys.argv:
+        app.run(host=app.config["SERVIDOR_HOST"], port=app.config["SERVIDOR_PUERTO"], debug=True, threaded=True)
+    else:
+        servir()
\ No newline at end of file
@@ -0,0 +1,948 @@
+import io
+import gzip
+import json
+import os
+import sys
+import time
+import random
+import tempfile
+import tracemalloc
+import threading
+import socket
+import subprocess
+import http.client
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+# Ejecutar siempre contra una base temporal, nunca contra inventario.db real
+DIRECTORIO_APP = os.path.dirname(os.path.abspath(__file__))
+DIRECTORIO_TMP = tempfile.mkdtemp(prefix="bench_inventario_")
+sys.path.insert(0, DIRECTORIO_APP)
+os.chdir(DIRECTORIO_TMP)
+
+import app as inventario
+
+PALABRAS = [
+    'cámara', 'cable', 'conector', 'switch', 'router', 'módulo', 'fuente', 'batería',
+    'sensor', 'panel', 'antena', 'tubería', 'válvula', 'motor', 'relé', 'tornillo',
+    'acción', 'pequeño', 'canalización', 'metálico', 'eléctrico', 'niño', 'fibra', 'óptica'
+]
+MARCAS = ['Hikvision', 'Cisco', 'Ubiquiti', 'Schneider', 'Siemens', 'Müller', 'Peñaflor']
+UBICACIONES = ['BODEGA', 'OFICINA', 'ALMACEN', 'TALLER', 'PROYECTO ÑUÑOA']
+
+
+def medir(funcion, repeticiones=5):
+    """Retorna el mejor tiempo (en ms) de varias ejecuciones"""
+    mejor = None
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        duracion = (time.perf_counter() - inicio) * 1000
+        mejor = duracion if mejor is None else min(mejor, duracion)
+    return mejor
+
+
+def poblar_inventario(conn, total):
+    random.seed(42)
+    filas = []
+    for i in range(total):
+        marca = random.choice(MARCAS)
+        codigo = f"COD-{i:06d}"
+        descripcion = ' '.join(random.choice(PALABRAS) for _ in range(4)).upper()
+        ubicacion = random.choice(UBICACIONES)
+        filas.append((
+            marca, codigo, descripcion, random.randint(0, 50), random.randint(0, 10),
+            ubicacion, '', 10.0, 12.0, 14.0, 15.0,
+            *inventario.campos_busqueda(codigo, descripcion, marca, ubicacion)
+        ))
+    conn.executemany("""
+        INSERT INTO inventario
+        (MARCA, CODIGO, DESCRIPCION, CANTIDAD, MINIMO, UBICACION, SERIAL,
+         PRECIO_COSTO, PRECIO_DIST, PRECIO_INT, PRECIO_GENERAL,
+         CODIGO_N, DESCRIPCION_N, MARCA_N, UBICACION_N)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, filas)
+    conn.commit()
+
+
+def buscar_con_udf(conn, busqueda):
+    """Búsqueda original: quitar_acentos por fila y LIKE '%termino%'"""
+    conn.create_function("quitar_acentos", 1, inventario.quitar_acentos)
+    termino = f"%{inventario.quitar_acentos(busqueda)}%"
+    return conn.execute("""
+        SELECT id FROM inventario
+        WHERE quitar_acentos(CODIGO) LIKE ? COLLATE NOCASE
+           OR quitar_acentos(DESCRIPCION) LIKE ? COLLATE NOCASE
+           OR quitar_acentos(MARCA) LIKE ? COLLATE NOCASE
+           OR quitar_acentos(UBICACION) LIKE ? COLLATE NOCASE
+    """, [termino] * 4).fetchall()
+
+
+def buscar_con_indice(conn, busqueda):
+    query, params, orden = inventario.consulta_busqueda(busqueda, "i.id")
+    return conn.execute(query + orden, params).fetchall()
+
+
+def benchmark_busqueda(total=100_000):
+    print("=" * 60)
+    print(f"   BÚSQUEDA ({total} productos)")
+    print("=" * 60)
+    print()
+
+    inventario.init_db()
+    conn = inventario.get_db_connection()
+    poblar_inventario(conn, total)
+
+    for busqueda in ['camara', 'VALVULA', 'muller', 'COD-0123', 'ñuñoa', 'ni']:
+        antes = {f['id'] for f in buscar_con_udf(conn, busqueda)}
+        despues = {f['id'] for f in buscar_con_indice(conn, busqueda)}
+        t_antes = medir(lambda: buscar_con_udf(conn, busqueda), 3)
+        t_despues = medir(lambda: buscar_con_indice(conn, busqueda), 3)
+        estado = "✅" if antes == despues else "❌ resultados distintos"
+        print(f"   '{busqueda}': {len(despues)} resultados | "
+              f"UDF {t_antes:.1f} ms -> índice {t_despues:.1f} ms "
+              f"(x{t_antes / max(t_despues, 0.001):.1f}) {estado}")
+
+    conn.close()
+    print()
+
+
+def generar_excel_proveedor(total):
+    random.seed(7)
+    filas = []
+    for i in range(total):
+        filas.append({
+            'MARCA': random.choice(MARCAS),
+            'CODIGO': f"PRV-{i:06d}" if i % 100 else None,
+            'DESCRIPCION': ' '.join(random.choice(PALABRAS) for _ in range(3)),
+            'CANTIDAD': random.choice([random.randint(0, 99), '12', None, 'N/D']),
+            'MINIMO': random.randint(0, 5),
+            'UBICACION': random.choice(UBICACIONES + [None]),
+            'SERIAL': None,
+            'PRECIO_COSTO': random.choice([9.5, '10,5', None]),
+            'PRECIO_DIST': 11.0,
+            'PRECIO_INT': 12.0,
+            'PRECIO_GENERAL': 13.0,
+        })
+    return inventario.pd.DataFrame(filas)
+
+
+def importar_fila_a_fila(conn, df):
+    """Importación original: iterrows, conversión por celda y un INSERT por fila"""
+    to_int, to_float = inventario.to_int, inventario.to_float
+    insertados = 0
+    for index, row in df.iterrows():
+        codigo = str(row.get('CODIGO', '')).strip()
+        descripcion = str(row.get('DESCRIPCION', '')).strip()
+        marca = str(row.get('MARCA', '')).strip()
+        if codigo == 'nan':
+            codigo = ''
+        if descripcion == 'nan':
+            descripcion = ''
+        if marca == 'nan':
+            marca = ''
+        ubicacion = str(row.get('UBICACION', 'BODEGA'))
+        serial = str(row.get('SERIAL', ''))
+        if ubicacion == 'nan':
+            ubicacion = 'BODEGA'
+        if serial == 'nan':
+            serial = ''
+        conn.execute("""
+            INSERT INTO inventario
+            (MARCA, CODIGO, DESCRIPCION, CANTIDAD, MINIMO, UBICACION, SERIAL,
+             PRECIO_COSTO, PRECIO_DIST, PRECIO_INT, PRECIO_GENERAL,
+             CODIGO_N, DESCRIPCION_N, MARCA_N, UBICACION_N)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            marca, codigo, descripcion, to_int(row.get('CANTIDAD', 0)), to_int(row.get('MINIMO', 0)),
+            ubicacion, serial, to_float(row.get('PRECIO_COSTO', 0)), to_float(row.get('PRECIO_DIST', 0)),
+            to_float(row.get('PRECIO_INT', 0)), to_float(row.get('PRECIO_GENERAL', 0)),
+            *inventario.campos_busqueda(codigo, descripcion, marca, ubicacion)
+        ))
+        insertados += 1
+    conn.commit()
+    return insertados
+
+
+def importar_vectorizado(conn, df):
+    validos, errores = inventario.preparar_importacion(df)
+    insertados, errores_insercion = inventario.insertar_productos(conn, validos)
+    conn.commit()
+    return insertados
+
+
+def benchmark_importacion(total=50_000):
+    print("=" * 60)
+    print(f"   IMPORTACIÓN EXCEL ({total} filas, ya leídas en un DataFrame)")
+    print("=" * 60)
+    print()
+
+    inventario.init_db()
+    conn = inventario.get_db_connection()
+    df = generar_excel_proveedor(total)
+
+    for nombre, funcion in [('fila a fila (iterrows)', importar_fila_a_fila),
+                            ('vectorizada (executemany)', importar_vectorizado)]:
+        conn.execute("DELETE FROM inventario")
+        conn.commit()
+        inicio = time.perf_counter()
+        insertados = funcion(conn, df)
+        duracion = time.perf_counter() - inicio
+        print(f"   {nombre}: {insertados} filas en {duracion:.2f} s "
+              f"-> {insertados / duracion:,.0f} filas/s")
+
+    conn.execute("DELETE FROM inventario")
+    conn.commit()
+    conn.close()
+    print()
+
+
+def medir_memoria(funcion):
+    """Retorna el pico de memoria (en MB) reservado durante una ejecución"""
+    tracemalloc.start()
+    funcion()
+    pico = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    tracemalloc.stop()
+    return pico
+
+
+def exportar_con_pandas(conn):
+    """Exportación original: fetchall, lista de dicts, DataFrame y BytesIO"""
+    items = conn.execute(
+        f"SELECT {', '.join(inventario.COLUMNAS_IMPORTACION)} FROM inventario ORDER BY id"
+    ).fetchall()
+    df = inventario.pd.DataFrame([dict(item) for item in items])
+    output = inventario.io.BytesIO()
+    with inventario.pd.ExcelWriter(output, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name='Inventario')
+    return len(df)
+
+
+def exportar_con_streaming(ruta):
+    with inventario.app.app_context():
+        return inventario.escribir_excel(inventario.consulta_plantilla(), ruta, 'Inventario')
+
+
+def primer_bloque_csv():
+    with inventario.app.app_context():
+        inicio = time.perf_counter()
+        next(inventario.generar_csv(inventario.consulta_plantilla()))
+        return (time.perf_counter() - inicio) * 1000
+
+
+def benchmark_exportacion(total=200_000):
+    print("=" * 60)
+    print(f"   EXPORTACIÓN ({total} productos)")
+    print("=" * 60)
+    print()
+
+    inventario.init_db()
+    conn = inventario.get_db_connection()
+    conn.execute("DELETE FROM inventario")
+    poblar_inventario(conn, total)
+
+    ruta = os.path.join(DIRECTORIO_TMP, "export.xlsx")
+    for nombre, funcion in [('pandas + BytesIO', lambda: exportar_con_pandas(conn)),
+                            ('streaming write_only', lambda: exportar_con_streaming(ruta))]:
+        inicio = time.perf_counter()
+        filas = funcion()
+        duracion = time.perf_counter() - inicio
+        print(f"   {nombre}: {filas} filas en {duracion:.2f} s")
+
+    # Round-trip: el archivo exportado debe volver a importarse sin rechazos
+    with open(ruta, 'rb') as archivo:
+        columnas, bloques = inventario.leer_bloques(archivo, ruta, 50_000)
+        rechazos = sum(len(inventario.preparar_importacion(df)[1]) for df in bloques)
+    estado = "✅" if columnas == inventario.COLUMNAS_IMPORTACION and rechazos == 0 else "❌"
+    print(f"   round-trip con la plantilla de importación: {rechazos} filas rechazadas {estado}")
+
+    print(f"   CSV: primer bloque listo en {primer_bloque_csv():.1f} ms")
+
+    # tracemalloc es lento: la memoria se mide sobre dos muestras más chicas para ver si crece
+    for muestra in (total // 10, total // 100):
+        conn.execute("DELETE FROM inventario WHERE id > ?", (muestra,))
+        conn.commit()
+        pico_pandas = medir_memoria(lambda: exportar_con_pandas(conn))
+        pico_streaming = medir_memoria(lambda: exportar_con_streaming(ruta))
+        print(f"   memoria con {muestra} filas: pandas {pico_pandas:,.1f} MB | "
+              f"streaming {pico_streaming:,.1f} MB")
+
+    conn.execute("DELETE FROM inventario")
+    conn.commit()
+    conn.close()
+    print()
+
+
+def asignar_leyendo_y_escribiendo(inventario_id, cantidad):
+    """Asignación original: lee el stock, lo chequea en Python y escribe el resultado"""
+    conn = inventario.abrir_conexion()
+    item = conn.execute("SELECT CANTIDAD FROM inventario WHERE id = ?", (inventario_id,)).fetchone()
+    if item['CANTIDAD'] >= cantidad:
+        time.sleep(0.001)  # el tiempo que la petición tarda en llegar a la escritura
+        conn.execute("UPDATE inventario SET CANTIDAD = ? WHERE id = ?", (item['CANTIDAD'] - cantidad, inventario_id))
+        conn.commit()
+        conn.close()
+        return cantidad
+    conn.close()
+    return 0
+
+
+def asignar_por_la_ruta(cliente, proyecto_id, inventario_id, cantidad):
+    respuesta = cliente.post(f"/asignar_items/{proyecto_id}", data={
+        'inventario_id': inventario_id, 'cantidad': cantidad, 'observacion': 'stress'
+    })
+    return cantidad if '/detalle_proyecto/' in respuesta.headers.get('Location', '') else 0
+
+
+def estresar(hilos, por_hilo, asignar):
+    """Lanza hilos que asignan 1-3 unidades a la vez; retorna las unidades asignadas"""
+    asignadas = []
+    lock = threading.Lock()
+
+    def trabajar(semilla):
+        generador = random.Random(semilla)
+        total = sum(asignar(generador.randint(1, 3)) for _ in range(por_hilo))
+        with lock:
+            asignadas.append(total)
+
+    lanzados = [threading.Thread(target=trabajar, args=(i,)) for i in range(hilos)]
+    for hilo in lanzados:
+        hilo.start()
+    for hilo in lanzados:
+        hilo.join()
+    return sum(asignadas)
+
+
+def benchmark_concurrencia(stock=300, hilos=16, por_hilo=20):
+    print("=" * 60)
+    print(f"   ASIGNACIONES CONCURRENTES ({hilos} hilos x {por_hilo}, stock {stock})")
+    print("=" * 60)
+    print()
+
+    inventario.init_db()
+    conn = inventario.get_db_connection()
+    conn.execute("INSERT INTO ubicaciones (nombre, tipo) VALUES ('STRESS', 'PROYECTO')")
+    proyecto_id = conn.execute("SELECT id FROM ubicaciones WHERE nombre = 'STRESS'").fetchone()[0]
+    conn.execute("INSERT INTO inventario (CODIGO, DESCRIPCION, CANTIDAD, MINIMO) VALUES ('STRESS', 'Stress', ?, 0)", (stock,))
+    inventario_id = conn.execute("SELECT MAX(id) FROM inventario").fetchone()[0]
+    conn.commit()
+
+    def stock_actual():
+        return conn.execute("SELECT CANTIDAD FROM inventario WHERE id = ?", (inventario_id,)).fetchone()[0]
+
+    # Lectura-chequeo-escritura: las asignaciones se pisan entre sí
+    asignadas = estresar(hilos, por_hilo, lambda cantidad: asignar_leyendo_y_escribiendo(inventario_id, cantidad))
+    perdidas = asignadas - (stock - stock_actual())
+    print(f"   leer y escribir: {asignadas} unidades entregadas, stock final {stock_actual()} "
+          f"-> {perdidas} unidades sin descontar {'❌' if perdidas else '✅'}")
+
+    # Ruta real: UPDATE condicional bajo BEGIN IMMEDIATE
+    conn.execute("UPDATE inventario SET CANTIDAD = ? WHERE id = ?", (stock, inventario_id))
+    conn.commit()
+    clientes = []
+    for _ in range(hilos):
+        cliente = inventario.app.test_client()
+        with cliente.session_transaction() as sesion:
+            sesion['user_id'] = 1
+            sesion['username'] = 'stress'
+            sesion['nombre_completo'] = 'Stress'
+            sesion['debe_cambiar_password'] = 0
+        clientes.append(cliente)
+    locales = threading.local()
+    siguiente = iter(clientes)
+    lock = threading.Lock()
+
+    def asignar(cantidad):
+        if not hasattr(locales, 'cliente'):
+            with lock:
+                locales.cliente = next(siguiente)
+        return asignar_por_la_ruta(locales.cliente, proyecto_id, inventario_id, cantidad)
+
+    inicio = time.perf_counter()
+    asignadas = estresar(hilos, por_hilo, asignar)
+    duracion = time.perf_counter() - inicio
+    final = stock_actual()
+    en_proyecto = conn.execute(
+        "SELECT COALESCE(SUM(cantidad_asignada), 0) FROM proyecto_items WHERE proyecto_id = ?", (proyecto_id,)
+    ).fetchone()[0]
+    correcto = final >= 0 and asignadas == stock - final == en_proyecto
+    print(f"   /asignar_items: {asignadas} unidades asignadas, stock final {final}, "
+          f"{en_proyecto} en el proyecto en {duracion:.2f} s {'✅' if correcto else '❌'}")
+    assert correcto, "El stock quedó inconsistente bajo concurrencia"
+
+    conn.close()
+    print()
+
+
+def benchmark_autocompletado(total=100_000):
+    print("=" * 60)
+    print(f"   AUTOCOMPLETADO DE ASIGNACIÓN ({total} productos)")
+    print("=" * 60)
+    print()
+
+    inventario.init_db()
+    conn = inventario.get_db_connection()
+    poblar_inventario(conn, total)
+
+    # Antes: la página cargaba todo el catálogo con stock en el <select>
+    catalogo = conn.execute("SELECT * FROM inventario WHERE CANTIDAD > 0 ORDER BY DESCRIPCION").fetchall()
+    t_catalogo = medir(lambda: conn.execute(
+        "SELECT * FROM inventario WHERE CANTIDAD > 0 ORDER BY DESCRIPCION").fetchall(), 3)
+    print(f"   catálogo completo: {len(catalogo)} productos en {t_catalogo:.1f} ms (solo la consulta)")
+
+    cliente = inventario.app.test_client()
+    with cliente.session_transaction() as sesion:
+        sesion['user_id'] = 1
+        sesion['username'] = 'bench'
+        sesion['nombre_completo'] = 'Bench'
+        sesion['debe_cambiar_password'] = 0
+
+    for busqueda in ['', 'c', 'COD-01', 'cod-0999', 'cam', 'camara', 'muller', 'ñuñoa', 'valvula metalico', 'xyz']:
+        respuesta = cliente.get("/productos/buscar", query_string={'q': busqueda})
+        t = medir(lambda: cliente.get("/productos/buscar", query_string={'q': busqueda}), 5)
+        estado = "✅" if t < 20 else "❌ sobre 20 ms"
+        print(f"   '{busqueda}': {len(respuesta.get_json())} resultados, "
+              f"{len(respuesta.data) / 1024:.1f} KB en {t:.2f} ms {estado}")
+
+    conn.close()
+    print()
+
+
+def benchmark_detalle_proyecto(niveles=(10_000, 100_000, 500_000)):
+    print("=" * 60)
+    print("   DETALLE DE PROYECTO VS. TAMAÑO DEL HISTORIAL")
+    print("=" * 60)
+    print()
+
+    inventario.init_db()
+    conn = inventario.get_db_connection()
+    poblar_inventario(conn, 5_000)
+    productos = [f['id'] for f in conn.execute("SELECT id FROM inventario")]
+    conn.executemany("INSERT INTO ubicaciones (nombre, tipo, fecha_inicio) VALUES (?, 'PROYECTO', '2025-01-01')",
+                     [(f"HIST {n}",) for n in range(200)])
+    proyectos = [f['id'] for f in conn.execute("SELECT id FROM ubicaciones WHERE nombre LIKE 'HIST %'")]
+    conn.execute("INSERT INTO ubicaciones (nombre, tipo, fecha_inicio) VALUES ('MEDIDO', 'PROYECTO', '2025-01-01')")
+    medido = conn.execute("SELECT id FROM ubicaciones WHERE nombre = 'MEDIDO'").fetchone()[0]
+    conn.executemany("""
+        INSERT INTO proyecto_items (proyecto_id, inventario_id, cantidad_asignada, fecha_asignacion, observacion)
+        VALUES (?, ?, 1, '2025-01-01 10:00:00', '')
+    """, [(medido, random.choice(productos)) for _ in range(50)])
+    conn.commit()
+
+    cliente = inventario.app.test_client()
+    with cliente.session_transaction() as sesion:
+        sesion['user_id'] = 1
+        sesion['username'] = 'bench'
+        sesion['nombre_completo'] = 'Bench'
+        sesion['debe_cambiar_password'] = 0
+
+    cargadas = 0
+    for nivel in niveles:
+        # Cada asignación histórica deja su línea en proyecto_items y su movimiento
+        lote = [(random.choice(proyectos), random.choice(productos)) for _ in range(nivel - cargadas)]
+        conn.executemany("""
+            INSERT INTO proyecto_items (proyecto_id, inventario_id, cantidad_asignada, fecha_asignacion, observacion)
+            VALUES (?, ?, 1, '2025-01-01 10:00:00', '')
+        """, lote)
+        conn.executemany("""
+            INSERT INTO movimientos (inventario_id, tipo, cantidad, fecha, observacion, proyecto)
+            VALUES (?, 'salida', 1, '2025-01-01 10:00:00', '', 'HIST')
+        """, [(inventario_id,) for _, inventario_id in lote])
+        conn.commit()
+        cargadas = nivel
+
+        con_indices = medir(lambda: cliente.get(f"/detalle_proyecto/{medido}"), 5)
+        conn.execute("DROP INDEX idx_proyecto_items_proyecto")
+        sin_indices = medir(lambda: cliente.get(f"/detalle_proyecto/{medido}"), 3)
+        conn.execute("""
+            CREATE INDEX idx_proyecto_items_proyecto
+            ON proyecto_items(proyecto_id, fecha_asignacion, inventario_id, cantidad_asignada, observacion)
+        """)
+        print(f"   {nivel:>9} asignaciones/movimientos: sin índice {sin_indices:.1f} ms -> "
+              f"con índice {con_indices:.1f} ms")
+
+    conn.close()
+    print()
+
+
+def benchmark_movimientos(niveles=(10_000, 100_000, 300_000)):
+    print("=" * 60)
+    print("   HISTORIAL DE MOVIMIENTOS DE UN PRODUCTO")
+    print("=" * 60)
+    print()
+
+    inventario.init_db()
+    conn = inventario.get_db_connection()
+    conn.execute("INSERT INTO inventario (CODIGO, DESCRIPCION, CANTIDAD, MINIMO) VALUES ('HIST', 'Historial', 0, 0)")
+    producto = conn.execute("SELECT MAX(id) FROM inventario").fetchone()[0]
+    conn.commit()
+
+    cliente = inventario.app.test_client()
+    with cliente.session_transaction() as sesion:
+        sesion['user_id'] = 1
+        sesion['username'] = 'bench'
+        sesion['nombre_completo'] = 'Bench'
+        sesion['debe_cambiar_password'] = 0
+
+    def fecha_al_azar():
+        return f"2025-{random.randint(1, 12):02d}-{random.randint(1, 28):02d} {random.randint(0, 23):02d}:00:00"
+
+    cargados = 0
+    for nivel in niveles:
+        conn.executemany("""
+            INSERT INTO movimientos (inventario_id, tipo, cantidad, fecha, observacion, proyecto)
+            VALUES (?, 'salida', 1, ?, '', ?)
+        """, [(producto, fecha_al_azar(), f"OBRA {random.randint(1, 50)}") for _ in range(nivel - cargados)])
+        conn.commit()
+        cargados = nivel
+
+        # Página profunda: el cursor de la fila que está a la mitad del historial
+        mitad = conn.execute("""
+            SELECT fecha, id FROM movimientos WHERE inventario_id = ?
+            ORDER BY fecha DESC, id DESC LIMIT 1 OFFSET ?
+        """, (producto, nivel // 2)).fetchone()
+        cursor = inventario.codificar_cursor(mitad['fecha'], mitad['id'])
+
+        urls = {
+            'primera página': f"/movimientos/{producto}",
+            'mitad del historial': f"/movimientos/{producto}?despues={cursor}",
+            'proyecto + mes': f"/movimientos/{producto}?proyecto=OBRA 7&desde=2025-06-01&hasta=2025-06-30",
+        }
+        tiempos = ", ".join(f"{nombre} {medir(lambda: cliente.get(url), 3):.1f} ms" for nombre, url in urls.items())
+        print(f"   {nivel:>7} movimientos: {tiempos}")
+
+    conn.close()
+    print()
+
+
+def top_movidos_sin_acumulados(conn, dias=30, limite=10):
+    return conn.execute("""
+        SELECT inventario_id, SUM(cantidad) AS total
+        FROM movimientos
+        WHERE fecha >= ?
+        GROUP BY inventario_id
+        ORDER BY total DESC
+        LIMIT ?
+    """, (inventario.inicio_periodo(dias), limite)).fetchall()
+
+
+def consumo_sin_acumulados(conn, meses=12):
+    return conn.execute("""
+        SELECT proyecto, SUM(CASE WHEN tipo = 'salida' THEN cantidad ELSE -cantidad END) AS neto
+        FROM movimientos
+        WHERE fecha >= ? AND proyecto != ''
+        GROUP BY proyecto
+    """, (inventario.inicio_meses(meses),)).fetchall()
+
+
+def benchmark_reportes(niveles=(100_000, 500_000, 1_000_000), productos=2_000):
+    print("=" * 60)
+    print("   REPORTES DE MOVIMIENTOS (ACUMULADOS VS. HISTORIAL CRUDO)")
+    print("=" * 60)
+    print()
+
+    inventario.init_db()
+    conn = inventario.get_db_connection()
+    poblar_inventario(conn, productos)
+    ids = [f['id'] for f in conn.execute("SELECT id FROM inventario")]
+
+    cliente = inventario.app.test_client()
+    with cliente.session_transaction() as sesion:
+        sesion['user_id'] = 1
+        sesion['username'] = 'bench'
+        sesion['nombre_completo'] = 'Bench'
+        sesion['debe_cambiar_password'] = 0
+
+    # Historial de tres años; los últimos 30 días siempre tienen el mismo volumen.
+    # Cada obra consume de su propio grupo de productos, como en la práctica
+    hoy = datetime.now()
+    obras = {n: random.sample(ids, 30) for n in range(1, 41)}
+    cargados = 0
+    for nivel in niveles:
+        inicio = time.perf_counter()
+        filas = []
+        for n in range(nivel - cargados):
+            dias_atras = random.randint(0, 29) if n % 50 == 0 else random.randint(30, 3 * 365)
+            fecha = (hoy - timedelta(days=dias_atras)).strftime("%Y-%m-%d %H:%M:%S")
+            obra = random.randint(1, 40)
+            filas.append((random.choice(obras[obra]), random.choice(['entrada', 'salida']), random.randint(1, 5),
+                          fecha, f"OBRA {obra}"))
+        conn.executemany("""
+            INSERT INTO movimientos (inventario_id, tipo, cantidad, fecha, observacion, proyecto)
+            VALUES (?, ?, ?, ?, '', ?)
+        """, filas)
+        conn.commit()
+        carga = (nivel - cargados) / (time.perf_counter() - inicio)
+        cargados = nivel
+
+        crudo_top = medir(lambda: top_movidos_sin_acumulados(conn), 3)
+        acum_top = medir(lambda: inventario.top_movidos(conn), 3)
+        crudo_proy = medir(lambda: consumo_sin_acumulados(conn), 3)
+        acum_proy = medir(lambda: inventario.consumo_por_proyecto(conn), 3)
+        ruta = medir(lambda: cliente.get("/reportes"), 3)
+        print(f"   {nivel:>9} movimientos ({carga:,.0f} filas/s con el trigger):")
+        print(f"      top 30 días: crudo {crudo_top:.1f} ms -> acumulados {acum_top:.1f} ms")
+        print(f"      consumo por proyecto 12 meses: crudo {crudo_proy:.1f} ms -> acumulados {acum_proy:.1f} ms")
+        print(f"      /reportes completo: {ruta:.1f} ms")
+
+    conn.close()
+    print()
+
+
+def cookie_de_sesion():
+    """Cookie de sesión firmada con la clave de la app (evita pasar por el login)"""
+    serializador = inventario.app.session_interface.get_signing_serializer(inventario.app)
+    sesion = {'user_id': 1, 'username': 'carga', 'nombre_completo': 'Carga', 'debe_cambiar_password': 0}
+    return f"{inventario.app.config['SESSION_COOKIE_NAME']}={serializador.dumps(sesion)}"
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def esperar_servidor(puerto, segundos=60):
+    limite = time.time() + segundos
+    while time.time() < limite:
+        try:
+            conexion = http.client.HTTPConnection("127.0.0.1", puerto, timeout=2)
+            conexion.request("GET", "/login")
+            conexion.getresponse().read()
+            conexion.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"El servidor no respondió en el puerto {puerto}")
+
+
+def cliente_de_carga(puerto, rutas, hilos, duracion, cookie):
+    """Un proceso cliente: varios hilos con conexiones keep-alive pidiendo las rutas en ronda"""
+    contador = {'ok': 0, 'error': 0}
+    lock = threading.Lock()
+    limite = time.perf_counter() + duracion
+
+    def pedir():
+        conexion = http.client.HTTPConnection("127.0.0.1", puerto, timeout=30)
+        ok = error = 0
+        n = 0
+        while time.perf_counter() < limite:
+            try:
+                conexion.request("GET", rutas[n % len(rutas)], headers={'Cookie': cookie})
+                respuesta = conexion.getresponse()
+                respuesta.read()
+                if respuesta.status == 200:
+                    ok += 1
+                else:
+                    error += 1
+            except (OSError, http.client.HTTPException):
+                error += 1
+                conexion.close()
+                conexion = http.client.HTTPConnection("127.0.0.1", puerto, timeout=30)
+            n += 1
+        conexion.close()
+        with lock:
+            contador['ok'] += ok
+            contador['error'] += error
+
+    lanzados = [threading.Thread(target=pedir) for _ in range(hilos)]
+    for hilo in lanzados:
+        hilo.start()
+    for hilo in lanzados:
+        hilo.join()
+    return contador['ok'], contador['error']
+
+
+def benchmark_servidor(procesos=(1, 2, 4), clientes=4, hilos_por_cliente=4, duracion=10, total=20_000):
+    print("=" * 60)
+    print(f"   CARGA HTTP CON GUNICORN ({clientes * hilos_por_cliente} clientes, {duracion} s por nivel)")
+    print("=" * 60)
+    print()
+
+    if importlib.util.find_spec("gunicorn") is None:
+        print("   gunicorn no está instalado (solo Linux): se omite la prueba")
+        print()
+        return
+
+    inventario.init_db()
+    conn = inventario.get_db_connection()
+    poblar_inventario(conn, total)
+    conn.close()
+
+    rutas = ["/", "/?busqueda=cable", "/productos/buscar?q=cam", "/?solo_bajo_stock=1"]
+    cookie = cookie_de_sesion()
+    print(f"   CPUs disponibles: {os.cpu_count()}")
+    for workers in procesos:
+        puerto = puerto_libre()
+        entorno = dict(
+            os.environ,
+            INVENTARIO_DB=os.path.abspath(inventario.app.config["DB_PATH"]),
+            SERVIDOR_HOST="127.0.0.1",
+            SERVIDOR_PUERTO=str(puerto),
+            SERVIDOR_PROCESOS=str(workers),
+            SERVIDOR_HILOS="4",
+        )
+        servidor = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--log-level", "warning"],
+            cwd=DIRECTORIO_APP, env=entorno
+        )
+        try:
+            esperar_servidor(puerto)
+            with ProcessPoolExecutor(max_workers=clientes) as ejecutor:
+                futuros = [ejecutor.submit(cliente_de_carga, puerto, rutas, hilos_por_cliente, duracion, cookie)
+                           for _ in range(clientes)]
+                resultados = [f.result() for f in futuros]
+            ok = sum(r[0] for r in resultados)
+            errores = sum(r[1] for r in resultados)
+            print(f"   {workers} worker(s): {ok / duracion:,.0f} peticiones/s ({errores} errores)")
+        finally:
+            servidor.terminate()
+            servidor.wait(timeout=30)
+
+    print()
+
+
+def foto_de_telefono(ancho=4032, alto=3024):
+    """JPEG del tamaño de una foto de teléfono (12 MP, varios MB)"""
+    from PIL import Image
+    imagen = Image.merge("RGB", [Image.effect_noise((ancho, alto), sigma) for sigma in (20, 30, 40)])
+    salida = io.BytesIO()
+    imagen.save(salida, "JPEG", quality=90)
+    return salida.getvalue()
+
+
+def benchmark_imagenes(fotos=5):
+    print("=" * 60)
+    print(f"   IMÁGENES DE PRODUCTOS ({fotos} fotos de 12 MP)")
+    print("=" * 60)
+    print()
+
+    if inventario.Image is None:
+        print("   Pillow no está instalado: se omite la prueba")
+        print()
+        return
+
+    from PIL import Image
+    inventario.app.config["UPLOAD_FOLDER"] = os.path.join(DIRECTORIO_TMP, "uploads")
+    datos = [foto_de_telefono() for _ in range(fotos)]
+
+    class Subida:
+        def __init__(self, contenido):
+            self.filename = "IMG_0001.JPG"
+            self.stream = io.BytesIO(contenido)
+
+    # Sin draft(): el JPEG se decodifica completo antes de reducirlo
+    inicio = time.perf_counter()
+    for contenido in datos:
+        with Image.open(io.BytesIO(contenido)) as original:
+            imagen = original.convert("RGB")
+            for lado in (800, 160):
+                imagen.thumbnail((lado, lado), Image.LANCZOS)
+    sin_draft = (time.perf_counter() - inicio) / fotos * 1000
+
+    inicio = time.perf_counter()
+    nombres = [inventario.guardar_imagen(Subida(contenido)) for contenido in datos]
+    con_draft = (time.perf_counter() - inicio) / fotos * 1000
+    print(f"   versiones por foto: decodificando completa {sin_draft:.0f} ms -> con draft() {con_draft:.0f} ms "
+          f"(incluye hash y escritura)")
+
+    repetida = inventario.guardar_imagen(Subida(datos[0]))
+    print(f"   misma foto subida otra vez: {'reutiliza el archivo ✅' if repetida == nombres[0] else 'archivo nuevo ❌'}")
+
+    pesos = {tamano: sum(os.path.getsize(inventario.ruta_imagen(n, tamano)) for n in nombres) / fotos
+             for tamano in ('original', 'mediana', 'miniatura')}
+    print(f"   detalle: original {pesos['original'] / 1024:,.0f} KB -> mediana {pesos['mediana'] / 1024:,.0f} KB")
+    print(f"   50 fotos en el listado: {50 * pesos['miniatura'] / 1024:,.0f} KB en miniaturas "
+          f"(con los originales serían {50 * pesos['original'] / 1024 / 1024:,.0f} MB)")
+
+    cliente = inventario.app.test_client()
+    with cliente.session_transaction() as sesion:
+        sesion['user_id'] = 1
+        sesion['username'] = 'bench'
+        sesion['nombre_completo'] = 'Bench'
+        sesion['debe_cambiar_password'] = 0
+    primera = cliente.get(f"/imagenes/mediana/{nombres[0]}")
+    repetida = cliente.get(f"/imagenes/mediana/{nombres[0]}", headers={'If-None-Match': primera.headers['ETag']})
+    print(f"   revalidación con ETag: {repetida.status_code} y {len(repetida.data)} bytes "
+          f"(Cache-Control: {primera.headers['Cache-Control']})")
+    print()
+
+
+def benchmark_limpieza_imagenes(total=100_000, archivos=20_000):
+    print("=" * 60)
+    print(f"   IMÁGENES SIN USO ({total} productos, {archivos} archivos)")
+    print("=" * 60)
+    print()
+
+    inventario.init_db()
+    carpeta = os.path.join(DIRECTORIO_TMP, "uploads_gc")
+    os.makedirs(carpeta, exist_ok=True)
+    inventario.app.config["UPLOAD_FOLDER"] = carpeta
+    conn = inventario.get_db_connection()
+    poblar_inventario(conn, total)
+
+    # La mitad de los archivos la usa algún producto (varios productos por archivo)
+    nombres = [f"{i:032x}.jpg" for i in range(archivos)]
+    viejo = time.time() - 2 * 3600
+    for nombre in nombres:
+        ruta = os.path.join(carpeta, nombre)
+        with open(ruta, "wb") as destino:
+            destino.write(b"\0" * 2048)
+        os.utime(ruta, (viejo, viejo))
+    ids = [f['id'] for f in conn.execute("SELECT id FROM inventario")]
+    conn.executemany("UPDATE inventario SET IMAGEN = ? WHERE id = ?",
+                     [(nombres[i % (archivos // 2)], id_) for i, id_ in enumerate(ids)])
+    conn.commit()
+
+    # ¿Alguien más usa la imagen? Antes se recorría inventario, ahora es el contador
+    nombre = nombres[0]
+    t_recorrido = medir(lambda: conn.execute(
+        "SELECT 1 FROM inventario WHERE IMAGEN = ? LIMIT 1", (nombres[-1],)).fetchone())
+    t_contador = medir(lambda: conn.execute(
+        "SELECT referencias FROM imagenes WHERE nombre = ?", (nombre,)).fetchone())
+    print(f"   imagen sin otros usos: recorriendo inventario {t_recorrido:.2f} ms -> contador {t_contador:.3f} ms")
+
+    inicio = time.perf_counter()
+    resultado = inventario.recolectar_imagenes(conn, limite=1000)
+    pasada = (time.perf_counter() - inicio) * 1000
+    print(f"   pasada incremental (límite 1000): {resultado['borrados']} borrados, "
+          f"{resultado['pendientes']} pendientes en {pasada:.0f} ms")
+    inicio = time.perf_counter()
+    resultado = inventario.recolectar_imagenes(conn)
+    completa = (time.perf_counter() - inicio) * 1000
+    print(f"   pasada completa: {resultado['borrados']} borrados, "
+          f"{resultado['bytes'] / 1024 / 1024:.1f} MB liberados en {completa:.0f} ms")
+    conn.close()
+    print()
+
+
+def benchmark_cache_http(total=100_000):
+    print("=" * 60)
+    print(f"   CACHÉ HTTP: ETAG Y EXPORTACIONES REPETIDAS ({total} productos)")
+    print("=" * 60)
+    print()
+
+    inventario.init_db()
+    conn = inventario.get_db_connection()
+    poblar_inventario(conn, total)
+    conn.execute("INSERT INTO ubicaciones (nombre, tipo) VALUES ('CACHE HTTP', 'PROYECTO')")
+    proyecto_id = conn.execute("SELECT id FROM ubicaciones WHERE nombre = 'CACHE HTTP'").fetchone()[0]
+    conn.execute("""
+        INSERT INTO proyecto_items (proyecto_id, inventario_id, cantidad_asignada, fecha_asignacion, observacion)
+        SELECT ?, id, 1, '2025-01-01 00:00:00', '' FROM inventario ORDER BY id LIMIT 2000
+    """, (proyecto_id,))
+    conn.commit()
+
+    cliente = inventario.app.test_client()
+    with cliente.session_transaction() as sesion:
+        sesion['user_id'] = 1
+        sesion['username'] = 'bench'
+        sesion['nombre_completo'] = 'Bench'
+        sesion['debe_cambiar_password'] = 0
+
+    for nombre, url in (("inventario (/?busqueda=cable)", "/?busqueda=cable"),
+                        ("detalle de proyecto (2000 líneas)", f"/detalle_proyecto/{proyecto_id}")):
+        etag = cliente.get(url).headers['ETag']
+        completa = medir(lambda: cliente.get(url))
+        revalidada = medir(lambda: cliente.get(url, headers={'If-None-Match': etag}))
+        print(f"   {nombre}: 200 en {completa:.1f} ms -> 304 en {revalidada:.2f} ms")
+
+    def exportar_todo():
+        ubicacion = cliente.get("/exportar").headers['Location']
+        trabajo_id = ubicacion.rsplit("/", 1)[-1]
+        while True:
+            estado = cliente.get(f"/trabajos/{trabajo_id}/estado").get_json()['estado']
+            if estado in inventario.ESTADOS_FINALES:
+                return trabajo_id
+            time.sleep(0.05)
+
+    inicio = time.perf_counter()
+    primero = exportar_todo()
+    t_primero = time.perf_counter() - inicio
+    inicio = time.perf_counter()
+    segundo = exportar_todo()
+    t_segundo = (time.perf_counter() - inicio) * 1000
+    print(f"   'Exportar todo': primera vez {t_primero:.1f} s -> repetido {t_segundo:.1f} ms "
+          f"({'mismo archivo ✅' if primero == segundo else 'generó otro ❌'})")
+    conn.close()
+    print()
+
+
+def benchmark_api(total=100_000, lineas=200):
+    print("=" * 60)
+    print(f"   API JSON EN LOTE VS. FORMULARIOS ({total} productos, {lineas} líneas)")
+    print("=" * 60)
+    print()
+
+    inventario.init_db()
+    conn = inventario.get_db_connection()
+    poblar_inventario(conn, total)
+    conn.execute("UPDATE inventario SET CANTIDAD = 1000, MINIMO = 0")
+    token = inventario.crear_token_api(conn, 1, 'BENCH')
+    conn.commit()
+    api = {'Authorization': f'Bearer {token}'}
+
+    cliente = inventario.app.test_client()
+    with cliente.session_transaction() as sesion:
+        sesion['user_id'] = 1
+        sesion['username'] = 'bench'
+        sesion['nombre_completo'] = 'Bench'
+        sesion['debe_cambiar_password'] = 0
+    ids = [fila[0] for fila in conn.execute("SELECT id FROM inventario ORDER BY random() LIMIT ?", (lineas,))]
+
+    inicio = time.perf_counter()
+    for inventario_id in ids:
+        cliente.get(f"/detalle/{inventario_id}")
+    t_paginas = (time.perf_counter() - inicio) * 1000
+    t_lote = medir(lambda: cliente.get(f"/api/v1/productos/lote?ids={','.join(map(str, ids))}", headers=api))
+    print(f"   leer {lineas} productos: {lineas} páginas de detalle {t_paginas:.0f} ms -> un lote {t_lote:.1f} ms")
+
+    inicio = time.perf_counter()
+    for inventario_id in ids:
+        cliente.post(f"/salida/{inventario_id}", data={'cantidad': '1', 'observacion': 'BENCH'})
+    t_formularios = (time.perf_counter() - inicio) * 1000
+    ajustes = {'ajustes': [{'inventario_id': i, 'tipo': 'salida', 'cantidad': 1, 'observacion': 'BENCH'} for i in ids]}
+    inicio = time.perf_counter()
+    respuesta = cliente.post("/api/v1/stock/ajustes", headers=api, json=ajustes)
+    t_ajustes = (time.perf_counter() - inicio) * 1000
+    print(f"   {lineas} salidas: un formulario por producto {t_formularios:.0f} ms -> un lote {t_ajustes:.1f} ms "
+          f"({len(respuesta.get_json()['ajustes'])} movimientos)")
+
+    def sincronizar(campos, encoding):
+        cursor, pagina, enviados = None, 0, 0
+        while True:
+            url = f"/api/v1/productos?limite=1000&campos={campos}" + (f"&cursor={cursor}" if cursor else "")
+            respuesta = cliente.get(url, headers={**api, 'Accept-Encoding': encoding})
+            enviados += len(respuesta.data)
+            pagina += 1
+            cuerpo = gzip.decompress(respuesta.data) if encoding == 'gzip' else respuesta.data
+            cursor = json.loads(cuerpo)['siguiente']
+            if not cursor:
+                return pagina, enviados
+
+    for campos, encoding in ((",".join(inventario.COLUMNAS_API), 'identity'),
+                             ("CODIGO,CANTIDAD", 'identity'),
+                             ("CODIGO,CANTIDAD", 'gzip')):
+        inicio = time.perf_counter()
+        paginas, enviados = sincronizar(campos, encoding)
+        print(f"   catálogo completo ({campos[:20]}, {encoding}): {paginas} páginas, "
+              f"{enviados / 1024 / 1024:.1f} MB en {time.perf_counter() - inicio:.1f} s")
+    conn.close()
+    print()
+
+
+if __name__ == "__main__":
+    benchmark_busqueda()
+    benchmark_importacion()
+    benchmark_exportacion()
+    benchmark_concurrencia()
+    benchmark_autocompletado()
+    benchmark_detalle_proyecto()
+    benchmark_movimientos()
+    benchmark_reportes()
+    benchmark_servidor()
+    benchmark_imagenes()
+    benchmark_limpieza_imagenes()
+    benchmark_cache_http()
+    benchmark_api()
@@ -0,0 +1,50 @@
+import sys
+
+from app import app, abrir_conexion, aplicar_migraciones, crear_token_api
+
+def crear_token():
+    print("=" * 50)
+    print("   TOKEN DE ACCESO A LA API")
+    print("   Inventario LSI")
+    print("=" * 50)
+    print()
+    
+    conn = abrir_conexion()
+    
+    try:
+        # Crea la tabla de tokens si la base todavía no tiene la migración
+        aplicar_migraciones(conn)
+        
+        username = sys.argv[1] if len(sys.argv) > 1 else input("Usuario: ").strip()
+        nombre = sys.argv[2] if len(sys.argv) > 2 else input("Nombre del cliente (ej. LECTOR BODEGA): ").strip()
+        usuario = conn.execute(
+            "SELECT id FROM usuarios WHERE username = ? AND activo = 1", (username,)
+        ).fetchone()
+        if not usuario:
+            print(f"❌ El usuario '{username}' no existe o está inactivo")
+        else:
+            token = crear_token_api(conn, usuario['id'], nombre.upper())
+            conn.commit()
+            print(f"Base de datos: {app.config['DB_PATH']}")
+            print(f"✅ Token creado para {username}:")
+            print()
+            print(f"   {token}")
+            print()
+            print("⚠️  Guárdalo ahora: no se vuelve a mostrar. Se envía como")
+            print("   Authorization: Bearer <token>")
+            print("   Para revocarlo: UPDATE api_tokens SET activo = 0 WHERE nombre = '...'")
+        
+        print()
+        print("=" * 50)
+        print()
+    
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+    
+    input("Presiona Enter para cerrar...")
+
+if __name__ == "__main__":
+    crear_token()
@@ -0,0 +1,61 @@
+import time
+
+from app import app, abrir_conexion, aplicar_migraciones, normalizar_imagen, Image
+
+def generar_miniaturas():
+    print("=" * 50)
+    print("   MINIATURAS DE IMÁGENES DE PRODUCTOS")
+    print("   Inventario LSI")
+    print("=" * 50)
+    print()
+    
+    if Image is None:
+        print("❌ Pillow no está instalado: ejecuta pip install -r requirements.txt")
+        print()
+        input("Presiona Enter para cerrar...")
+        return
+    
+    conn = abrir_conexion()
+    
+    try:
+        aplicar_migraciones(conn)
+        
+        nombres = [fila[0] for fila in conn.execute(
+            "SELECT DISTINCT IMAGEN FROM inventario WHERE IMAGEN IS NOT NULL AND IMAGEN != ''"
+        )]
+        print(f"Carpeta: {app.config['UPLOAD_FOLDER']}")
+        print(f"⚙️  Procesando {len(nombres)} imágenes usadas por productos...")
+        
+        inicio = time.perf_counter()
+        renombradas = versiones = faltantes = 0
+        for n, nombre in enumerate(nombres, 1):
+            nuevo, generadas = normalizar_imagen(conn, nombre)
+            if nuevo is None:
+                faltantes += 1
+                print(f"⚠️  No existe el archivo {nombre}")
+                continue
+            renombradas += nuevo != nombre
+            versiones += generadas
+            if n % 100 == 0:
+                print(f"   {n}/{len(nombres)}")
+        
+        print(f"✅ Renombradas al hash de su contenido: {renombradas}")
+        print(f"✅ Versiones generadas: {versiones}")
+        if faltantes:
+            print(f"⚠️  Archivos que no existen: {faltantes}")
+        print(f"   ({time.perf_counter() - inicio:.1f} s)")
+        print()
+        print("=" * 50)
+        print("   PROCESO COMPLETADO")
+        print("=" * 50)
+        print()
+        
+    except Exception as e:
+        print(f"❌ Error: {e}")
+    finally:
+        conn.close()
+    
+    input("Presiona Enter para cerrar...")
+
+if __name__ == "__main__":
+    generar_miniaturas()
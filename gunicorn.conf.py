@@ -0,0 +1,12 @@
+# Configuración de gunicorn: toma host, puerto, procesos e hilos de la configuración
+# de la aplicación (variables SERVIDOR_HOST, SERVIDOR_PUERTO, SERVIDOR_PROCESOS y SERVIDOR_HILOS)
+from app import app
+
+wsgi_app = "wsgi:app"
+bind = f"{app.config['SERVIDOR_HOST']}:{app.config['SERVIDOR_PUERTO']}"
+workers = app.config["SERVIDOR_PROCESOS"]
+threads = app.config["SERVIDOR_HILOS"]
+
+# La aplicación se carga (y la base se migra e inicializa) una sola vez en el proceso
+# maestro; cada worker creado después abre su propio pool de conexiones
+preload_app = True
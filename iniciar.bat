@@ -39,6 +39,6 @@ echo ============================================
 echo.
 
 REM Iniciar aplicación
-python app.py --production
+python app.py
 
 pause
\ No newline at end of file
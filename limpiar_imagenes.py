@@ -0,0 +1,45 @@
+import sys
+
+from app import app, abrir_conexion, aplicar_migraciones, recolectar_imagenes
+
+def limpiar_imagenes():
+    print("=" * 50)
+    print("   LIMPIEZA DE IMÁGENES SIN USO")
+    print("   Inventario LSI")
+    print("=" * 50)
+    print()
+    
+    # python limpiar_imagenes.py 500 -> borra como máximo 500 archivos en esta pasada
+    limite = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    
+    conn = abrir_conexion()
+    
+    try:
+        aplicar_migraciones(conn)
+        
+        print(f"Carpeta: {app.config['UPLOAD_FOLDER']}")
+        print(f"⚙️  Buscando archivos que ningún producto usa (se respetan los de los últimos "
+              f"{app.config['IMAGENES_GRACIA_MIN']} minutos)...")
+        
+        resultado = recolectar_imagenes(conn, limite)
+        
+        print(f"✅ Archivos revisados: {resultado['revisados']}")
+        print(f"✅ Imágenes borradas: {resultado['borrados']}")
+        print(f"✅ Espacio liberado: {resultado['bytes'] / 1024 / 1024:.1f} MB")
+        if resultado['pendientes']:
+            print(f"ℹ️  Quedan {resultado['pendientes']} para la próxima pasada")
+        print()
+        print("=" * 50)
+        print("   LIMPIEZA COMPLETADA")
+        print("=" * 50)
+        print()
+        
+    except Exception as e:
+        print(f"❌ Error: {e}")
+    finally:
+        conn.close()
+    
+    input("Presiona Enter para cerrar...")
+
+if __name__ == "__main__":
+    limpiar_imagenes()
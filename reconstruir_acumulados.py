@@ -0,0 +1,43 @@
+import time
+
+from app import app, abrir_conexion, aplicar_migraciones, reconstruir_acumulados
+
+def reconstruir():
+    print("=" * 50)
+    print("   RECONSTRUCCIÓN DE ACUMULADOS DE MOVIMIENTOS")
+    print("   Inventario LSI")
+    print("=" * 50)
+    print()
+    
+    conn = abrir_conexion()
+    
+    try:
+        # Crea las tablas y triggers si la base todavía no tiene la migración
+        aplicar_migraciones(conn)
+        
+        total = conn.execute("SELECT COUNT(*) FROM movimientos").fetchone()[0]
+        print(f"Base de datos: {app.config['DB_PATH']}")
+        print(f"⚙️  Agrupando {total} movimientos por día y por mes...")
+        
+        inicio = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        filas = reconstruir_acumulados(conn)
+        conn.commit()
+        
+        print(f"✅ Filas diarias: {filas} ({time.perf_counter() - inicio:.1f} s)")
+        print()
+        print("=" * 50)
+        print("   RECONSTRUCCIÓN COMPLETADA")
+        print("=" * 50)
+        print()
+        
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+    
+    input("Presiona Enter para cerrar...")
+
+if __name__ == "__main__":
+    reconstruir()
@@ -0,0 +1,11 @@
+"""Punto de entrada WSGI para servidores de producción.
+
+Windows (waitress, un proceso con varios hilos):
+    waitress-serve --host 0.0.0.0 --port 5000 --threads 8 wsgi:app
+
+Linux (gunicorn, varios procesos; lee host, puerto y workers de la configuración):
+    gunicorn -c gunicorn.conf.py
+"""
+from app import create_app
+
+app = create_app()